@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 import sys
+from datetime import timedelta
 from pathlib import Path
 
 IS_IN_DOCKER = Path("/.dockerenv").is_file()
@@ -27,6 +28,8 @@ if IS_IN_DOCKER:
     pass
 
 GRIB_PATH = Path("/home/balloon/data") if IS_IN_DOCKER else BASE_PATH / 'data'
+if 'BALLOON_GRIB_PATH' in os.environ:  # E.g. synthetic datasets of `benchmarks.dataset`
+    GRIB_PATH = Path(os.environ['BALLOON_GRIB_PATH'])
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.0/howto/deployment/checklist/
@@ -55,6 +58,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',  # First, so that it measures every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -136,6 +140,33 @@ PREPROCESS_BOX = {
 
 ACTIVE_MODELS = ["ARPEGE_0.5"]
 
+# Maximum number of forecast files downloaded simultaneously
+DOWNLOAD_THREADS = 4
+
+# Maximum cumulated size of the memory-mapped forecast arrays kept open by each process
+FORECAST_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Maximum number of atmospheric columns kept built by each process
+COLUMN_CACHE_SIZE = 10000
+
+# Valid dates of preprocessed forecasts, for every model
+FORECAST_CATALOG_PATH = GRIB_PATH / "catalog.sqlite"
+
+# Computed trajectories, shared by all server processes
+TRAJECTORY_CACHE_PATH = GRIB_PATH / "trajectories.sqlite"
+TRAJECTORY_CACHE_TTL = timedelta(days=1)
+TRAJECTORY_CACHE_BYTES = 256 * 1024 * 1024
+
+# Latency histograms, flushed by each server process at most every METRICS_FLUSH_INTERVAL seconds
+METRICS_PATH = GRIB_PATH / "metrics"
+METRICS_FLUSH_INTERVAL = 10
+
+# Default number of processes computing the trajectories of a `trajectory_sweep` command
+SWEEP_JOBS = 4
+
+# Maximum number of launch dates of a sweep view, whose trajectories are computed by the server's process
+SWEEP_MAX_DATES = 48
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
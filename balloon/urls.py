@@ -23,7 +23,11 @@ from core import views as core_views
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('forecast/list/<str:grib_model>/', forecast_views.list_files, name='list'),
+    path('forecast/tile/<str:grib_model>/', forecast_views.tile, name='tile'),
     path('ground_altitude/<str:grib_model>/', forecast_views.altitude, name='ground_altitude'),
     path('trajectory/', core_views.trajectory, name='trajectory'),
-    path('column/', core_views.column, name='column')
+    path('ensemble/', core_views.ensemble, name='ensemble'),
+    path('sweep/', core_views.sweep, name='sweep'),
+    path('column/', core_views.column, name='column'),
+    path('metrics/', core_views.metrics, name='metrics')
 ]
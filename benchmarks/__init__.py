@@ -0,0 +1,34 @@
+"""
+Performance and accuracy benchmarks, run on a dataset generated by `benchmarks.dataset` in a
+temporary directory, so that results don't depend on which forecasts happen to be downloaded:
+
+    python -m benchmarks.run [case ...] [--real-data] [--save-baseline] [--tolerance RATIO]
+
+With `--real-data`, they rather run on the forecasts preprocessed in `GRIB_PATH`, except for
+the cases registered with `@writes_data`, which would write into its caches and catalog.
+
+Each case is a function registered with `@case`, which returns a dict of measures
+and a list of failure messages; the runner exits with an error status if any case failed.
+Numeric measures are costs, times or sizes with their unit in their name, lower being better:
+they're compared to those of a baseline file (`baseline-synthetic.json`, or `baseline.json`
+with `--real-data`), and exceeding them by more than the tolerance is a failure.
+Other measures, as strings, are only informative. Baselines depend on the machine, so none
+is committed: `--save-baseline` records it, and the runner refuses to run without one,
+and fails cases missing from it.
+"""
+from collections import OrderedDict
+
+CASES = OrderedDict()  # name => function
+WRITING_CASES = set()  # names of the cases which write into GRIB_PATH
+
+
+def case(function):
+    """Register a benchmark case under its function's name."""
+    CASES[function.__name__] = function
+    return function
+
+
+def writes_data(function):
+    """Mark a benchmark case as writing into `GRIB_PATH`, so that it only runs on synthetic datasets."""
+    WRITING_CASES.add(function.__name__)
+    return function
@@ -0,0 +1,61 @@
+"""
+Cost of building `Column`s with `ColumnExtractor.extract`, in time and memory,
+and of getting them from the column cache.
+"""
+import time
+import tracemalloc
+
+from forecast.cache import column_cache
+from forecast.extract import ColumnExtractor
+from forecast.models import grib_models
+from . import case
+
+MODEL_NAME = 'ARPEGE_0.5'
+POSITION = (2.5, 48.5)
+REPEAT = 1000
+
+
+@case
+def column_build():
+    model = grib_models[MODEL_NAME]
+    extractor = ColumnExtractor(model, extrapolated_pressures=range(1, 20))
+    date = min(extractor.list_files())
+    position = model.round_position(POSITION)
+    extractor.extract(date, position)  # Warm caches up
+
+    t0 = time.perf_counter()
+    for _ in range(REPEAT):
+        extractor.extract(date, position)
+    cached_s = (time.perf_counter() - t0) / REPEAT
+    t0 = time.perf_counter()
+    for _ in range(REPEAT):
+        column_cache.invalidate(extractor.model_name)
+        extractor.extract(date, position)
+    build_s = (time.perf_counter() - t0) / REPEAT
+    t0 = time.perf_counter()
+    for _ in range(REPEAT):
+        column_cache.invalidate(extractor.model_name)
+        extractor.extract(date, position).cells
+    cells_s = (time.perf_counter() - t0) / REPEAT
+
+    column_cache.invalidate(extractor.model_name)
+    tracemalloc.start()
+    snapshot0 = tracemalloc.take_snapshot()
+    column = extractor.extract(date, position)
+    snapshot1 = tracemalloc.take_snapshot()
+    column.cells
+    snapshot2 = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def allocated(before, after):
+        return sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+    measures = {
+        'levels': str(len(column)),
+        'build time per column (µs)': round(build_s * 1e6, 1),
+        'build time per column, with cells (µs)': round(cells_s * 1e6, 1),
+        'time per cached column (µs)': round(cached_s * 1e6, 1),
+        'memory per column (bytes)': allocated(snapshot0, snapshot1),
+        'memory per column, with cells (bytes)': allocated(snapshot0, snapshot2),
+    }
+    return measures, []
@@ -0,0 +1,153 @@
+"""
+Synthetic forecasts and terrain, so that benchmarks run without downloading anything:
+
+    python -m benchmarks.dataset PATH [--lons N] [--lats N] [--levels N] [--dates N] [--derived]
+
+Forecasts are made of GRIB-like messages fed to `forecast.preprocess.preprocess_messages`, so
+preprocessed files have exactly the layout of real ones; the terrain is written as `forecast_terrain`
+does. The atmosphere is a standard one, with smooth horizontal and temporal variations, and
+a westerly jet stream around 250hPa. Generation is deterministic: datasets with the same
+parameters are identical, whatever the date they're generated at.
+
+Files are written in `GRIB_PATH`, which `BALLOON_GRIB_PATH` must point to (the command sets it),
+so that the forecast catalog and caches updated by preprocessing are those of the dataset.
+"""
+import io
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+
+MODEL_NAME = 'ARPEGE_0.5'
+ANALYSIS_DATE = datetime(2020, 1, 1)
+LEVELS = (10, 20, 30, 50, 70, 100, 150, 200, 250, 300, 400, 500, 600, 700, 800, 850, 900, 950, 1000)
+DEFAULT_LONS = 19
+DEFAULT_LATS = 21
+DEFAULT_DATES = 8
+G = 9.81
+
+
+class SyntheticMessage(object):
+    """
+    Field of a GRIB message, with the subset of the `pygrib.gribmessage` API used by `forecast.preprocess`.
+    Values are computed upon access, as GRIB fields are decoded.
+    """
+    def __init__(self, shortName, level, validDate, analDate, lons, lats):
+        self.shortName = shortName
+        self.level = level
+        self.validDate = validDate
+        self.analDate = analDate
+        self.lons = lons
+        self.lats = lats
+
+    def latlons(self):
+        (lons, lats) = np.meshgrid(self.lons, self.lats)
+        return lats, lons
+
+    @property
+    def values(self):
+        (lats, lons) = self.latlons()
+        hours = (self.validDate - self.analDate).total_seconds() / 3600
+        # Standard atmosphere, with pressure levels slightly moving across the grid and along time
+        z = 44330.8 * (1 - (self.level / 1013.25) ** 0.190263)
+        z = z * (1 + 0.01 * np.sin(np.radians(lons * 7 + hours * 5)) * np.cos(np.radians(lats * 5)))
+        if self.shortName == 'z':
+            return z * G  # Geopotential, in m²/s²
+        elif self.shortName == 't':
+            return np.where(z < 11000, 288.15 - 0.0065 * z, 216.65)
+        elif self.shortName == 'u':
+            jet = 30 * np.exp(-((z - 10500) / 3500) ** 2)
+            return 5 + jet + 3 * np.sin(np.radians(lats * 20 + hours * 10))
+        elif self.shortName == 'v':
+            return 4 * np.cos(np.radians(lons * 15 - hours * 8)) - 1
+        elif self.shortName == 'r':
+            return np.clip(80 - z / 150 + 10 * np.sin(np.radians(lons * 30)), 5, 100)
+        raise ValueError(f"Unknown variable {self.shortName}")
+
+
+def grid(model, lon1, lat1, n_lons, n_lats):
+    """
+    :return: `(lons, lats)` axes of a grid of `n_lons` × `n_lats` points at the model's pitch,
+        from `(lon1, lat1)` eastward and northward. Latitudes are decreasing, as in ARPEGE files.
+    """
+    lons = lon1 + model.grid_pitch * np.arange(n_lons)
+    lats = (lat1 + model.grid_pitch * np.arange(n_lats))[::-1]
+    return np.round(lons, 6), np.round(lats, 6)
+
+
+def synthetic_messages(lons, lats, levels=LEVELS, analysis_date=ANALYSIS_DATE, valid_dates=(ANALYSIS_DATE,)):
+    """
+    :return: list of `SyntheticMessage`s, for every valid date, level and variable
+    """
+    return [SyntheticMessage(name, level, valid_date, analysis_date, lons, lats)
+            for valid_date in valid_dates for level in levels for name in "tuvzr"]
+
+
+def terrain(lons, lats):
+    """
+    :return: ground altitudes in meters, as an `int16` array indexed by lon, lat
+    """
+    (lat_grid, lon_grid) = np.meshgrid(lats, lons)
+    hills = 600 * np.maximum(np.sin(np.radians(lon_grid * 40)) * np.cos(np.radians(lat_grid * 30)), 0)
+    return (50 + hills).astype(np.int16)
+
+
+def generate(model, n_lons=DEFAULT_LONS, n_lats=DEFAULT_LATS, n_levels=len(LEVELS), n_dates=DEFAULT_DATES,
+             derived=False):
+    """
+    Write a synthetic dataset for `model` in `GRIB_PATH`: `n_dates` valid dates from `ANALYSIS_DATE`
+    at the model's time pitch, on a grid starting at the south-west corner of `PREPROCESS_BOX`.
+    :param n_levels: number of pressure levels, the lowest altitude ones being kept
+    :return: the dataset's description, as a dict
+    """
+    from balloon.settings import GRIB_PATH, PREPROCESS_BOX
+    from forecast.preprocess import preprocess_messages, replace_file
+
+    (lon1, lat1) = (PREPROCESS_BOX['lon1'], PREPROCESS_BOX['lat1'])
+    (lons, lats) = grid(model, lon1, lat1, n_lons, n_lats)
+    levels = LEVELS[-n_levels:]
+    valid_dates = [ANALYSIS_DATE + i * model.time_pitch for i in range(n_dates)]
+    output_path = GRIB_PATH / f"{model.name}_{model.grid_pitch}"
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    messages = synthetic_messages(lons, lats, levels, ANALYSIS_DATE, valid_dates)
+    box = dict(lat1=float(lats.min()), lat2=float(lats.max()), lon1=float(lons.min()), lon2=float(lons.max()))
+    with redirect_stdout(io.StringIO()):  # Progress messages, not relevant here
+        preprocess_messages(messages, output_path, force=True, derived=derived, **box)
+    replace_file(output_path / "terrain.np", 'wb', lambda f: np.save(f, terrain(lons, lats)))
+    replace_file(output_path / "terrain.json", 'w',
+                 lambda f: json.dump({'lats': lats.tolist(), 'lons': lons.tolist()}, f))
+    return {'model': f"{model.name}_{model.grid_pitch}", 'lons': n_lons, 'lats': n_lats, 'levels': len(levels),
+            'dates': n_dates, 'derived': derived, 'path': str(output_path)}
+
+
+def main():
+    parser = ArgumentParser(description="Generate a synthetic dataset of preprocessed forecasts and terrain")
+    parser.add_argument('path', help="root directory of the dataset, used as GRIB_PATH")
+    parser.add_argument('-m', '--model', default=MODEL_NAME, help="name of the weather model")
+    parser.add_argument('--lons', type=int, default=DEFAULT_LONS, help="number of grid longitudes")
+    parser.add_argument('--lats', type=int, default=DEFAULT_LATS, help="number of grid latitudes")
+    parser.add_argument('--levels', type=int, default=len(LEVELS), help=f"number of pressure levels, at most {len(LEVELS)}")
+    parser.add_argument('--dates', type=int, default=DEFAULT_DATES, help="number of valid dates")
+    parser.add_argument('-d', '--derived', action='store_true', default=False, help="also store derived variables")
+    args = parser.parse_args()
+    if not 2 <= args.levels <= len(LEVELS):
+        parser.error(f"--levels must be between 2 and {len(LEVELS)}")
+
+    os.environ['BALLOON_GRIB_PATH'] = os.path.abspath(args.path)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "balloon.settings")
+    import django
+    django.setup()
+    from forecast.models import grib_models
+
+    description = generate(grib_models[args.model], args.lons, args.lats, args.levels, args.dates, args.derived)
+    json.dump(description, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Throughput of `forecast.preprocess.preprocess_messages`, on synthetic messages whose fields are
+decoded beforehand, so that only preprocessing itself is measured. Files are written in a
+temporary directory, but preprocessing updates the catalog of `GRIB_PATH`: the case only runs
+on synthetic datasets.
+"""
+import io
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+
+from forecast.catalog import forecast_catalog
+from forecast.models import grib_models
+from forecast.preprocess import preprocess_messages
+from . import case, dataset, writes_data
+
+MODEL_NAME = 'ARPEGE_0.5'
+N_LONS = 80
+N_LATS = 60
+N_DATES = 4
+REPEAT = 3
+OUTPUT_NAME = "BENCHMARK_0.5"  # Not a model name, so that no model's catalog is affected
+
+
+def _decoded(messages):
+    """:return: copies of messages, with their values computed once and for all"""
+    return [SimpleNamespace(shortName=m.shortName, level=m.level, validDate=m.validDate, analDate=m.analDate,
+                            values=m.values, latlons=m.latlons)
+            for m in messages]
+
+
+@case
+@writes_data
+def preprocess_throughput():
+    model = grib_models[MODEL_NAME]
+    (lons, lats) = dataset.grid(model, 0., 40., N_LONS, N_LATS)
+    valid_dates = [dataset.ANALYSIS_DATE + i * model.time_pitch for i in range(N_DATES)]
+    messages = _decoded(dataset.synthetic_messages(lons, lats, dataset.LEVELS, dataset.ANALYSIS_DATE, valid_dates))
+    box = dict(lat1=float(lats.min()), lat2=float(lats.max()), lon1=float(lons.min()), lon2=float(lons.max()))
+
+    measures = {'fields': str(len(messages)), 'grid': f"{N_LONS}×{N_LATS} points × {len(dataset.LEVELS)} levels"}
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = Path(tmp) / OUTPUT_NAME
+        output_path.mkdir()
+        for derived in (False, True):
+            times = []
+            for _ in range(REPEAT):
+                t0 = time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    preprocess_messages(messages, output_path, force=True, derived=derived, **box)
+                times.append(time.perf_counter() - t0)
+            suffix = ", with derived variables" if derived else ""
+            measures[f'time per valid date{suffix} (ms)'] = round(min(times) / N_DATES * 1000, 1)
+            measures[f'time per field{suffix} (µs)'] = round(min(times) / len(messages) * 1e6, 1)
+    forecast_catalog.forget(OUTPUT_NAME)
+    return measures, []
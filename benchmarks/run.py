@@ -0,0 +1,110 @@
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+SYNTHETIC_BASELINE_PATH = Path(__file__).parent / "baseline-synthetic.json"
+DEFAULT_TOLERANCE = 0.5
+
+
+def compare(name, measures, baseline, tolerance):
+    """
+    :param baseline: numeric measures of case `name` in the baseline, or None if there's none
+    :return: failure messages for numeric measures exceeding their baseline by more than `tolerance`
+    """
+    failures = []
+    for (key, value) in measures.items():
+        reference = (baseline or {}).get(key)
+        if isinstance(value, (int, float)) and reference:
+            ratio = value / reference
+            print(f"    {key}: {value} ({ratio:.2f}× baseline)")
+            if ratio > 1 + tolerance:
+                failures.append(f"regression of {key}: {value}, baseline {reference}")
+        else:
+            print(f"    {key}: {value}")
+    return failures
+
+
+def main():
+    # The dataset must be chosen before Django's settings are loaded, and cases are only known after
+    dataset_parser = ArgumentParser(add_help=False)
+    dataset_parser.add_argument('--real-data', action='store_true', default=False,
+                                help="run on the forecasts of GRIB_PATH, rather than on a synthetic dataset generated "
+                                     "in a temporary directory; cases writing into GRIB_PATH are skipped")
+    (known_args, _) = dataset_parser.parse_known_args()
+    dataset_path = None
+    if not known_args.real_data:
+        dataset_path = tempfile.mkdtemp(prefix="balloon-benchmark-")
+        atexit.register(shutil.rmtree, dataset_path, ignore_errors=True)
+        os.environ['BALLOON_GRIB_PATH'] = dataset_path
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "balloon.settings")
+    import django
+    django.setup()
+
+    from benchmarks import CASES, WRITING_CASES, dataset
+    from benchmarks import column, trajectory, preprocess, views  # noqa: F401 Registers cases
+    from forecast.models import grib_models
+
+    parser = ArgumentParser(description="Run performance and accuracy benchmarks", parents=[dataset_parser])
+    parser.add_argument('cases', nargs='*', choices=[[]] + list(CASES),
+                        help="cases to run, all of them by default")
+    parser.add_argument('--baseline', type=Path, default=None,
+                        help=f"baseline file, default {SYNTHETIC_BASELINE_PATH.name}, or {BASELINE_PATH.name} with --real-data")
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help="record numeric measures of the cases run as the new baseline, rather than comparing them")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="relative increase of a numeric measure over its baseline considered as a regression")
+    args = parser.parse_args()
+    baseline_path = args.baseline or (BASELINE_PATH if args.real_data else SYNTHETIC_BASELINE_PATH)
+    if not args.save_baseline and not baseline_path.is_file():
+        parser.error(f"no baseline file {baseline_path} to compare measures with: "
+                     "record one on this machine with --save-baseline, or choose one with --baseline")
+    cases = args.cases or list(CASES)
+    if args.real_data:
+        writing_cases = [name for name in cases if name in WRITING_CASES]
+        if args.cases and writing_cases:
+            parser.error(f"cases writing into GRIB_PATH only run on synthetic data: {', '.join(writing_cases)}")
+        for name in writing_cases:
+            print(f"{name} skipped: it would write into GRIB_PATH")
+        cases = [name for name in cases if name not in WRITING_CASES]
+    try:
+        with baseline_path.open() as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = {}  # Only when saving a new baseline
+
+    failed = False
+    if dataset_path is not None:
+        description = dataset.generate(grib_models[dataset.MODEL_NAME])
+        print(f"Synthetic dataset: {description}")
+    for name in cases:
+        t0 = time.perf_counter()
+        (measures, failures) = CASES[name]()
+        elapsed = time.perf_counter() - t0
+        print(f"{name} ({elapsed:.1f}s)")
+        if args.save_baseline:
+            baselines[name] = {k: v for (k, v) in measures.items() if isinstance(v, (int, float))}
+            compare(name, measures, None, args.tolerance)
+        else:
+            if name not in baselines:
+                failures.append(f"no baseline in {baseline_path.name}, record one with --save-baseline")
+            failures += compare(name, measures, baselines.get(name), args.tolerance)
+        for failure in failures:
+            print(f"    FAILED: {failure}")
+        failed |= bool(failures)
+
+    if args.save_baseline:
+        with baseline_path.open('w') as f:
+            json.dump(baselines, f, indent=1, ensure_ascii=False)
+        print(f"Baseline saved in {baseline_path}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
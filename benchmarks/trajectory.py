@@ -0,0 +1,117 @@
+"""
+Comparison of the level-stepping trajectory engine of `core.trajectory` with the
+batch integrator of `core.integrator` used by ensembles, on the earliest preprocessed
+valid date, and of the formats trajectories are served in.
+"""
+import json
+import time
+from datetime import timedelta
+from math import radians, sin, cos, asin, sqrt
+
+import numpy as np
+from dateutil.parser import parse
+
+from forecast.extract import ColumnExtractor
+from forecast.models import grib_models
+from core import models as m
+from core import trajectory as core_trajectory
+from core import integrator
+from . import case
+
+MODEL_NAME = 'ARPEGE_0.5'
+LAUNCH_POSITION = (2.5, 48.5)
+BALLOON = {'ground_volume_m3': 4., 'balloon_mass_kg': 1.2, 'payload_mass_kg': 1.}
+TIME_STEP = timedelta(seconds=60)
+BATCH_SIZE = 1000
+REPEAT = 5
+
+# Tolerances of the integrator relatively to the level-stepping engine
+MAX_LANDING_DISTANCE_KM = 10
+MAX_DURATION_DIFFERENCE = timedelta(minutes=10)
+
+
+def _distance_km(p1, p2):
+    """Haversine distance between two `(lon, lat)` positions."""
+    (lon1, lat1, lon2, lat2) = map(radians, (*p1, *p2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * asin(sqrt(a))
+
+
+def _best_time(function):
+    """:return: the shortest of `REPEAT` runs of `function`, in seconds, once caches are warm"""
+    function()
+    times = []
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+@case
+def trajectory_engines():
+    model = grib_models[MODEL_NAME]
+    extractor = ColumnExtractor(model, extrapolated_pressures=range(1, 20))
+    t0 = min(extractor.list_files())
+    p0 = model.round_position(LAUNCH_POSITION)
+    column = extractor.extract(t0, p0)
+    balloon = m.Balloon(ground_pressure_hPa=column.ground_pressure, **BALLOON)
+
+    def integrate(size):
+        """:return: the steps of `size` balloons launched from the same place"""
+        return list(integrator.integrate(balloon, model, np.full(size, p0[0]), np.full(size, p0[1]), t0, TIME_STEP))
+
+    levels = core_trajectory.trajectory(balloon, extractor, p0, t0)
+    steps = integrate(1)
+    levels_time = _best_time(lambda: core_trajectory.trajectory(balloon, extractor, p0, t0))
+    steps_time = _best_time(lambda: integrate(1))
+    batch_time = _best_time(lambda: integrate(BATCH_SIZE))
+
+    levels_landing = (levels[-1]['position']['x'], levels[-1]['position']['y'])
+    levels_duration = parse(levels[-1]['time']) - parse(levels[0]['time']) + timedelta(seconds=levels[0]['move']['t'])
+    steps_landing = (float(steps[-1]['lon'][0]), float(steps[-1]['lat'][0]))
+    steps_duration = timedelta(seconds=round(float(sum(step['duration'][0] for step in steps))))
+    distance_km = _distance_km(levels_landing, steps_landing)
+    duration_difference = abs(steps_duration - levels_duration)
+    flight_s = levels_duration.total_seconds()
+
+    measures = {
+        'launch': f"{p0} at {t0.isoformat()}",
+        'levels: steps': str(len(levels)),
+        'integrator: steps': str(len(steps)),
+        'levels: time (ms)': round(levels_time * 1000, 2),
+        'integrator, single balloon: time (ms)': round(steps_time * 1000, 2),
+        f'integrator, batch of {BATCH_SIZE}: time (ms)': round(batch_time * 1000, 1),
+        'µs per simulated second, levels': round(levels_time / flight_s * 1e6, 3),
+        'µs per simulated second, integrator': round(steps_time / flight_s * 1e6, 3),
+        'µs per simulated second, integrator batch (per balloon)': round(batch_time / BATCH_SIZE / flight_s * 1e6, 3),
+        'landing distance': f"{distance_km:.2f}km",
+        'flight duration difference': str(duration_difference),
+    }
+    failures = []
+    if distance_km > MAX_LANDING_DISTANCE_KM:
+        failures.append(f"landing points {distance_km:.2f}km apart, more than {MAX_LANDING_DISTANCE_KM}km")
+    if duration_difference > MAX_DURATION_DIFFERENCE:
+        failures.append(f"flight durations differ by {duration_difference}, more than {MAX_DURATION_DIFFERENCE}")
+    return measures, failures
+
+
+@case
+def trajectory_formats():
+    """Payload size and serialization time of trajectories, as GeoJSON and as NumPy archives."""
+    model = grib_models[MODEL_NAME]
+    extractor = ColumnExtractor(model, extrapolated_pressures=range(1, 20))
+    t0 = min(extractor.list_files())
+    p0 = model.round_position(LAUNCH_POSITION)
+    column = extractor.extract(t0, p0)
+    balloon = m.Balloon(ground_pressure_hPa=column.ground_pressure, **BALLOON)
+    metadata = {'model': MODEL_NAME, 'launch': {'lon': p0[0], 'lat': p0[1], 'date': t0.isoformat()}}
+
+    points = core_trajectory.trajectory(balloon, extractor, p0, t0)
+    geojson = json.dumps(core_trajectory.to_geojson(points))
+    npz = core_trajectory.to_npz(points, metadata)
+    geojson_time = _best_time(lambda: json.dumps(core_trajectory.to_geojson(points)))
+    npz_time = _best_time(lambda: core_trajectory.to_npz(points, metadata))
+    return {'points': str(len(points)),
+            'geojson (bytes)': len(geojson), 'geojson (ms)': round(geojson_time * 1000, 3),
+            'npz (bytes)': len(npz), 'npz (ms)': round(npz_time * 1000, 3)}, []
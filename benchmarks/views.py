@@ -0,0 +1,59 @@
+"""
+Response times of the main views through Django's test client, middlewares included.
+
+Trajectories are requested twice: with the same parameters, served by the trajectory cache,
+and with a different payload mass at each request, so that they're computed. Masses are
+drawn from a seeded generator, so that every run computes the same trajectories.
+
+Requests write into the trajectory cache and the metrics of `GRIB_PATH`: the case only runs
+on synthetic datasets.
+"""
+import random
+import time
+
+from django.test import Client
+
+from forecast.extract import ColumnExtractor
+from forecast.models import grib_models
+from . import case, writes_data
+
+MODEL_NAME = 'ARPEGE_0.5'
+LAUNCH_POSITION = (2.5, 48.5)
+REPEAT = 5
+SEED = 20200101
+
+
+@case
+@writes_data
+def views():
+    model = grib_models[MODEL_NAME]
+    rng = random.Random(SEED)
+    client = Client()
+    date = min(ColumnExtractor(model).list_files()).isoformat() + "Z"
+    (lon, lat) = LAUNCH_POSITION
+    launch = f"model={MODEL_NAME}&longitude={lon}&latitude={lat}&date={date}"
+    balloon = "balloon_mass_kg=1.2&ground_volume_m3=4"
+    requests = {
+        'column': lambda i: f"/column/?{launch}",
+        'trajectory, cached': lambda i: f"/trajectory/?{launch}&{balloon}&payload_mass_kg=1",
+        'trajectory, computed': lambda i: f"/trajectory/?{launch}&{balloon}&payload_mass_kg={1 + rng.random():.9f}",
+        'forecast list': lambda i: f"/forecast/list/{MODEL_NAME}/",
+        'ground altitude': lambda i: f"/ground_altitude/{MODEL_NAME}/?longitude={lon}&latitude={lat}",
+        'tile': lambda i: f"/forecast/tile/{MODEL_NAME}/?date={date}&lon1={lon - 2}&lon2={lon + 2}&lat1={lat - 2}&lat2={lat + 2}&format=npz",
+    }
+
+    measures = {}
+    failures = []
+    for (name, url) in requests.items():
+        client.get(url(-1))  # Warm caches up
+        times = []
+        for i in range(REPEAT):
+            request_url = url(i)
+            t0 = time.perf_counter()
+            response = client.get(request_url)
+            times.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                failures.append(f"{name}: status {response.status_code} for {request_url}")
+                break
+        measures[f'{name} (ms)'] = round(min(times) * 1000, 2)
+    return measures, failures
@@ -0,0 +1,121 @@
+"""
+Cache of computed trajectories, shared by every server process through an SQLite file.
+
+Trajectories are keyed by their quantized launch parameters: GRIB model,
+analysis date of the launch forecast, launch position and time rounded to the
+model's grid, and balloon parameters. Each entry stores the serialized GeoJSON
+and the range of valid dates the trajectory went through, so that entries
+are deleted whenever one of those valid dates is preprocessed again, by the
+commands which run preprocessings.
+
+Entries expire after a TTL, and least recently used ones are evicted when the
+cumulated size of the cached GeoJSON exceeds a byte budget.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from balloon.settings import TRAJECTORY_CACHE_PATH, TRAJECTORY_CACHE_TTL, TRAJECTORY_CACHE_BYTES
+
+
+class TrajectoryCache(object):
+
+    def __init__(self, path, ttl, max_bytes):
+        """
+        :param path: SQLite database file, created if missing
+        :param ttl: `timedelta` after which entries expire
+        :param max_bytes: maximum cumulated size of cached GeoJSON strings
+        """
+        self.path = path
+        self.ttl_s = ttl.total_seconds()
+        self.max_bytes = max_bytes
+        self.initialized = False
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(str(self.path), timeout=10)
+        try:
+            with connection:  # Commits upon success, rolls back upon exception
+                self._initialize(connection)
+                yield connection
+        finally:
+            connection.close()
+
+    def _initialize(self, connection):
+        if not self.initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS trajectories (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    date_from TEXT NOT NULL,
+                    date_to TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    geojson TEXT NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS trajectories_dates ON trajectories (model, date_from)")
+            connection.execute("CREATE INDEX IF NOT EXISTS trajectories_accessed ON trajectories (accessed)")
+            self.initialized = True
+
+    @staticmethod
+    def key(model, analysis_date, position, launch_date, ground_volume_m3, balloon_mass_kg, payload_mass_kg):
+        """
+        :param position: launch `(lon, lat)`, rounded with `model.round_position`
+        :param launch_date: launch date, rounded with `model.round_time`
+        :return: a string identifying a trajectory
+        """
+        params = [model.name, model.grid_pitch, analysis_date.isoformat(),
+                  [round(x, 6) for x in position], launch_date.isoformat(),
+                  ground_volume_m3, balloon_mass_kg, payload_mass_kg]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        :return: the cached GeoJSON string, or None if it isn't in cache or has expired
+        """
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("SELECT geojson FROM trajectories WHERE key=? AND created>?",
+                                     (key, now - self.ttl_s)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE trajectories SET accessed=? WHERE key=?", (now, key))
+        return row[0]
+
+    def put(self, key, model_name, date_from, date_to, geojson):
+        """
+        :param model_name: name of the model's directory, such as `"ARPEGE_0.1"`
+        :param date_from: first valid date used by the trajectory
+        :param date_to: last valid date used by the trajectory
+        :param geojson: serialized GeoJSON string
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO trajectories VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, model_name, date_from.isoformat(), date_to.isoformat(),
+                                now, now, len(geojson), geojson))
+            connection.execute("DELETE FROM trajectories WHERE created<=?", (now - self.ttl_s,))
+            (total_bytes,) = connection.execute("SELECT COALESCE(SUM(size), 0) FROM trajectories").fetchone()
+            if total_bytes > self.max_bytes:
+                # Only keep the most recently accessed entries within half the budget, to evict by batches
+                cumulated_bytes = 0
+                for (accessed, size) in connection.execute(
+                        "SELECT accessed, size FROM trajectories ORDER BY accessed DESC").fetchall():
+                    cumulated_bytes += size
+                    if cumulated_bytes > self.max_bytes // 2:
+                        connection.execute("DELETE FROM trajectories WHERE accessed<=?", (accessed,))
+                        break
+
+    def invalidate(self, model_name, valid_date):
+        """
+        Delete every trajectory of model `model_name` which went through `valid_date`.
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM trajectories WHERE model=? AND date_from<=? AND ?<=date_to",
+                               (model_name, valid_date.isoformat(), valid_date.isoformat()))
+
+
+trajectory_cache = TrajectoryCache(TRAJECTORY_CACHE_PATH, TRAJECTORY_CACHE_TTL, TRAJECTORY_CACHE_BYTES)
@@ -0,0 +1,156 @@
+"""
+Monte-Carlo estimation of landing zones.
+
+A nominal balloon is turned into an ensemble of variants with randomly perturbed lift,
+burst volume, Cx and winds, whose flights are all integrated at once by
+`core.integrator.integrate`. Landing points are then summarized as a density grid,
+and as ellipses containing a given share of them, assuming they're normally distributed.
+"""
+import math
+from datetime import timedelta
+
+import numpy as np
+
+from .integrator import integrate, DEFAULT_TIME_STEP
+from .models import BalloonEnsemble, EARTH_RADIUS
+
+DEFAULT_SIZE = 200
+MAX_SIZE = 2000
+
+# Standard deviations of perturbations, relatively to nominal values except for wind bias
+LIFT_SD = 0.05
+BURST_VOLUME_SD = 0.1
+CX_SD = 0.1
+WIND_FACTOR_SD = 0.1
+WIND_BIAS_SD_MS = 1.
+
+PROBABILITIES = (0.5, 0.9, 0.99)
+ELLIPSE_POINTS = 36
+
+
+def perturb(balloon, size, rng, lift_sd=LIFT_SD, burst_volume_sd=BURST_VOLUME_SD, cx_sd=CX_SD):
+    """
+    :param balloon: the nominal `Balloon`
+    :param size: number of variants
+    :param rng: a `numpy.random.Generator`
+    :return: a `BalloonEnsemble` of `size` variants, normally distributed around `balloon`
+    """
+    def spread(nominal, sd):
+        # Keep features physically meaningful, even for large standard deviations
+        return nominal * np.maximum(rng.normal(1., sd, size), 0.1)
+
+    return BalloonEnsemble(balloon,
+                           lift_N=spread(balloon.lift_N, lift_sd),
+                           burst_volume_m3=spread(balloon.burst_volume_m3, burst_volume_sd),
+                           cx=spread(balloon.cx, cx_sd))
+
+
+def simulate(balloons, model, p0, t0, rng, time_step=DEFAULT_TIME_STEP,
+             wind_factor_sd=WIND_FACTOR_SD, wind_bias_sd_ms=WIND_BIAS_SD_MS):
+    """
+    Integrate the flights of an ensemble of balloons launched together, each under its own wind perturbation.
+
+    :param balloons: a `BalloonEnsemble`
+    :param model: a `GribModel`
+    :param p0: launch position `(lon, lat)`
+    :param t0: launch date
+    :param rng: a `numpy.random.Generator`
+    :return: a dict of arrays with one value per balloon: landing `lon`, `lat`,
+        flight `duration_s` and `burst_altitude_m`
+    :raise ValueError: if balloons don't lift off, or flights leave the forecasts' box or last too long
+    """
+    if np.any(balloons.lift_N <= 0):
+        raise ValueError("The balloon's volume is too small for it to lift off")
+    size = len(balloons)
+    wind_factor = np.maximum(rng.normal(1., wind_factor_sd, size), 0.)
+    wind_bias_ms = (rng.normal(0., wind_bias_sd_ms, size), rng.normal(0., wind_bias_sd_ms, size))
+    duration_s = np.zeros(size)
+    burst_altitude_m = np.full(size, np.nan)
+    for step in integrate(balloons, model, np.full(size, p0[0]), np.full(size, p0[1]), t0, time_step,
+                          wind_factor=wind_factor, wind_bias_ms=wind_bias_ms):
+        duration_s += step['duration']
+        bursting = ~step['ascending'] & np.isnan(burst_altitude_m)
+        burst_altitude_m[bursting] = step['z'][bursting] - step['speed'][2][bursting] * step['duration'][bursting]
+    return {'lon': step['lon'], 'lat': step['lat'], 'duration_s': duration_s, 'burst_altitude_m': burst_altitude_m}
+
+
+def _to_meters(lons, lats, origin):
+    """Project positions on a plane tangent at `origin`; accurate enough over a landing zone."""
+    (lon0, lat0) = origin
+    k = math.pi * EARTH_RADIUS / 180
+    return (lons - lon0) * k * math.cos(math.radians(lat0)), (lats - lat0) * k
+
+
+def _to_degrees(xs, ys, origin):
+    """Inverse of `_to_meters`."""
+    (lon0, lat0) = origin
+    k = math.pi * EARTH_RADIUS / 180
+    return lon0 + xs / (k * math.cos(math.radians(lat0))), lat0 + ys / k
+
+
+def density_grid(lons, lats, pitch):
+    """
+    :param lons: array of landing longitudes
+    :param lats: array of landing latitudes
+    :param pitch: size of grid cells, in degrees
+    :return: a dict with the `lons` and `lats` of cell edges, and the share of landings
+        in each cell as `density`, indexed by longitude then latitude
+    """
+    def edges(xs):
+        first = math.floor(xs.min() / pitch)
+        last = math.floor(xs.max() / pitch) + 1
+        return np.arange(first, last + 1) * pitch
+
+    (lon_edges, lat_edges) = (edges(lons), edges(lats))
+    (counts, _, _) = np.histogram2d(lons, lats, bins=(lon_edges, lat_edges))
+    return {'lons': lon_edges.round(6).tolist(),
+            'lats': lat_edges.round(6).tolist(),
+            'density': (counts / len(lons)).round(4).tolist()}
+
+
+def percentile_ellipses(lons, lats, probabilities=PROBABILITIES):
+    """
+    Fit a bivariate normal distribution on landing points, and compute the ellipses which
+    contain each of the `probabilities`: with `λ` the eigenvalues of the covariance matrix,
+    their semi-axes are `√(λ·r²)`, where `r² = -2·ln(1-p)` is the p-quantile of a χ² with two degrees of freedom.
+
+    :param lons: array of landing longitudes
+    :param lats: array of landing latitudes
+    :param probabilities: sequence of probabilities, within 0...1
+    :return: list of dicts, one per probability: `probability`, `center` as `(lon, lat)`,
+        `semi_axes_m` (major first), `azimuth_deg` of the major axis, and `polygon` of `(lon, lat)` points
+    """
+    center = (float(lons.mean()), float(lats.mean()))
+    (xs, ys) = _to_meters(lons, lats, center)
+    (eigenvalues, eigenvectors) = np.linalg.eigh(np.cov(np.stack((xs, ys))))
+    (eigenvalues, eigenvectors) = (np.maximum(eigenvalues[::-1], 0), eigenvectors[:, ::-1])  # Major axis first
+    angles = np.linspace(0, 2 * math.pi, ELLIPSE_POINTS + 1)
+    circle = np.stack((np.cos(angles), np.sin(angles)))
+    ellipses = []
+    for p in probabilities:
+        semi_axes = np.sqrt(eigenvalues * -2 * math.log(1 - p))
+        (polygon_xs, polygon_ys) = eigenvectors @ (semi_axes[:, None] * circle)
+        (polygon_lons, polygon_lats) = _to_degrees(polygon_xs, polygon_ys, center)
+        (major_x, major_y) = eigenvectors[:, 0]
+        ellipses.append({
+            'probability': p,
+            'center': [round(center[0], 4), round(center[1], 4)],
+            'semi_axes_m': [round(float(a)) for a in semi_axes],
+            'azimuth_deg': round(math.degrees(math.atan2(major_x, major_y)) % 180, 1),
+            'polygon': [[round(lon, 4), round(lat, 4)] for (lon, lat) in zip(polygon_lons, polygon_lats)]
+        })
+    return ellipses
+
+
+def flight_summary(landings):
+    """
+    :param landings: result of `simulate`
+    :return: percentiles 10, 50 and 90 of flight durations and burst altitudes
+    """
+    percentiles = (10, 50, 90)
+    return {
+        'duration': {f"p{q}": str(timedelta(seconds=round(float(x))))
+                     for (q, x) in zip(percentiles, np.percentile(landings['duration_s'], percentiles))},
+        'burst_altitude_m': {f"p{q}": round(float(x))
+                             for (q, x) in zip(percentiles, np.nanpercentile(landings['burst_altitude_m'], percentiles))}
+    }
@@ -0,0 +1,244 @@
+"""
+Trajectory integration with a fixed time step, on interpolated forecast fields.
+
+Unlike `core.trajectory.trajectory`, which moves the balloon one whole model
+level at a time in the nearest grid column, this engine advances batches of
+balloons, such as the ensembles of `core.ensemble`, by configurable time steps,
+and samples the atmosphere at their exact positions:
+
+* vertically, wind and temperature are interpolated linearly in altitude
+  between the two surrounding levels, while pressure and air density are
+  interpolated (or extrapolated above the model's ceiling) exponentially;
+* horizontally, values are interpolated bilinearly between the four
+  surrounding grid columns;
+* in time, values are interpolated linearly between the two surrounding
+  valid dates.
+
+Fields are read directly from the memory-mapped forecast arrays, and every
+computation is vectorized over the balloons of a batch. A lone balloon is
+better served by `core.trajectory`: its steps cost less than the NumPy calls
+of a single time step.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from forecast.cache import forecast_cache
+from forecast.terrain import get_terrain
+from .models import air_density_kg_m3
+from .trajectory import volume_m3, speed_up_ms, speed_down_ms, apply_drift
+
+
+DEFAULT_TIME_STEP = timedelta(seconds=60)
+MAX_FLIGHT_DURATION = timedelta(hours=12)
+
+
+class Sample(object):
+    """
+    Atmosphere interpolated at a batch of points. Fields are NumPy arrays, named
+    as those of `core.models.Cell`, so that the balloon physics functions of
+    `core.trajectory` apply to samples as well as to cells.
+    """
+    def __init__(self, u_ms, v_ms, t_K, p_hPa, rho_kg_m3):
+        self.u_ms = u_ms
+        self.v_ms = v_ms
+        self.t_K = t_K
+        self.p_hPa = p_hPa
+        self.rho_kg_m3 = rho_kg_m3
+
+
+class _Block(object):
+    """
+    Decoded sub-box of a forecast, around the points being sampled, with the values needed
+    by interpolations precomputed for every column and level. Levels are sorted by increasing altitude.
+    """
+    MARGIN = 4  # Grid points decoded around sampled points, so that blocks are seldom rebuilt
+    U, V, T, LOG_P, LOG_RHO = range(5)
+
+    def __init__(self, forecast, lon_idx, lat_idx):
+        (lons, lats) = (forecast.grid.lons, forecast.grid.lats)
+        self.lon0 = max(int(lon_idx.min()) - self.MARGIN, 0)
+        self.lon1 = min(int(lon_idx.max()) + self.MARGIN + 2, lons.count)
+        self.lat0 = max(int(lat_idx.min()) - self.MARGIN, 0)
+        self.lat1 = min(int(lat_idx.max()) + self.MARGIN + 2, lats.count)
+        (ii, jj) = np.meshgrid(np.arange(self.lon0, self.lon1), np.arange(self.lat0, self.lat1), indexing='ij')
+        columns = forecast.columns(ii, jj)  # name => values indexed by lon, lat, level
+        p = np.asarray(forecast.shape['alts'], dtype=np.float64)[::-1]
+        (t, r) = (columns['t'][..., ::-1], columns['r'][..., ::-1])
+        self.z = np.ascontiguousarray(columns['z'][..., ::-1], dtype=np.float64)  # Indexed by lon, lat, level
+        self.values = np.stack([
+            columns['u'][..., ::-1],
+            columns['v'][..., ::-1],
+            t,
+            np.broadcast_to(np.log(p), t.shape),
+            np.log(columns['rho'][..., ::-1] if 'rho' in columns else air_density_kg_m3(p, t, r))],
+            axis=3)  # Indexed by lon, lat, level, value
+
+    def contains(self, lon_idx, lat_idx):
+        return self.lon0 <= lon_idx.min() and lon_idx.max() + 1 < self.lon1 and \
+            self.lat0 <= lat_idx.min() and lat_idx.max() + 1 < self.lat1
+
+
+class FieldSampler(object):
+    """
+    Interpolates forecast fields of a GRIB model at arbitrary positions, altitudes and dates.
+    A sampler keeps the forecasts and blocks it has decoded, and is meant to serve a single integration.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.forecasts = {}  # valid_date => Forecast
+        self.blocks = {}  # valid_date => _Block
+
+    def _date_weights(self, date):
+        """
+        :return: list of `(valid_date, weight)` of the valid dates surrounding `date`
+        """
+        pitch = self.model.time_pitch
+        midnight = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        date0 = midnight + ((date - midnight) // pitch) * pitch
+        weight1 = (date - date0) / pitch
+        if weight1 == 0:
+            return [(date0, 1.)]
+        return [(date0, 1. - weight1), (date0 + pitch, weight1)]
+
+    def _forecast(self, valid_date):
+        forecast = self.forecasts.get(valid_date)
+        if forecast is None:
+            forecast = self.forecasts[valid_date] = forecast_cache.get(self.model, valid_date)
+        return forecast
+
+    def _block(self, valid_date, lon_idx, lat_idx):
+        """
+        :return: a `_Block` of the forecast valid at `valid_date`, containing the given columns
+        """
+        block = self.blocks.get(valid_date)
+        if block is None or not block.contains(lon_idx, lat_idx):
+            block = self.blocks[valid_date] = _Block(self._forecast(valid_date), lon_idx, lat_idx)
+        return block
+
+    def sample(self, lons, lats, zs, date):
+        """
+        :param lons: array of longitudes
+        :param lats: array of latitudes
+        :param zs: array of altitudes above MSL in meters
+        :param date: UTC date, common to every point
+        :return: a `Sample`
+        """
+        return self.interpolate(lons, lats, zs, self._date_weights(date))
+
+    def interpolate(self, lons, lats, zs, date_weights):
+        """
+        :param lons: array of longitudes
+        :param lats: array of latitudes
+        :param zs: array of altitudes above MSL in meters
+        :param date_weights: list of `(valid_date, weight)`, weights being either scalars
+            or arrays with one value per point, which sum up to 1 for every point
+        :return: a `Sample`
+        """
+        grid = self._forecast(date_weights[0][0]).grid
+        try:
+            (lon_idx, lon_frac) = grid.lons.locate(lons)
+            (lat_idx, lat_frac) = grid.lats.locate(lats)
+        except ValueError:
+            raise ValueError("No preprocessed weather data for this position")
+        n = len(zs)
+
+        # Gather the four surrounding columns of every point, in every surrounding valid date, at once:
+        # those corners are stacked along the first axis, with the weights of the bilinear and time interpolations.
+        corner_lon_idx = np.concatenate((lon_idx, lon_idx + 1, lon_idx, lon_idx + 1))
+        corner_lat_idx = np.concatenate((lat_idx, lat_idx, lat_idx + 1, lat_idx + 1))
+        corner_weights = np.concatenate(((1 - lon_frac) * (1 - lat_frac), lon_frac * (1 - lat_frac),
+                                         (1 - lon_frac) * lat_frac, lon_frac * lat_frac))
+        blocks = [self._block(valid_date, lon_idx, lat_idx) for (valid_date, _) in date_weights]
+        weights = np.concatenate([corner_weights * (np.tile(weight, 4) if np.ndim(weight) else weight)
+                                  for (_, weight) in date_weights])
+
+        # Locate target altitudes between two levels of each column, and only gather the values of those levels
+        targets = np.tile(zs, 4)
+        (z0, z1, v0, v1) = ([], [], [], [])
+        for block in blocks:
+            (ii, jj) = (corner_lon_idx - block.lon0, corner_lat_idx - block.lat0)
+            z = block.z[ii, jj]
+            lower = np.minimum(np.maximum((z <= targets[:, None]).sum(axis=1) - 1, 0), z.shape[1] - 2)
+            rows = np.arange(len(lower))
+            z0.append(z[rows, lower])
+            z1.append(z[rows, lower + 1])
+            v0.append(block.values[ii, jj, lower])
+            v1.append(block.values[ii, jj, lower + 1])
+        if len(blocks) == 1:
+            (z0, z1, v0, v1) = (z0[0], z1[0], v0[0], v1[0])
+        else:
+            (z0, z1, v0, v1) = (np.concatenate(x) for x in (z0, z1, v0, v1))
+            targets = np.tile(targets, len(blocks))
+
+        # Wind and temperature are kept constant beyond the model's levels, whereas
+        # pressure and density keep following their exponential law.
+        fraction = (targets - z0) / (z1 - z0)
+        fractions = np.empty_like(v0)
+        fractions[:, :_Block.LOG_P] = np.minimum(np.maximum(fraction, 0), 1)[:, None]
+        fractions[:, _Block.LOG_P:] = fraction[:, None]
+        values = (v0 + fractions * (v1 - v0)) * weights[:, None]
+        (u, v, t, log_p, log_rho) = values.reshape(-1, n, values.shape[1]).sum(axis=0).T
+        return Sample(u_ms=u, v_ms=v, t_K=t, p_hPa=np.exp(log_p), rho_kg_m3=np.exp(log_rho))
+
+
+def integrate(balloon, model, lons, lats, t0, time_step=DEFAULT_TIME_STEP,
+              max_duration=MAX_FLIGHT_DURATION, wind_factor=1., wind_bias_ms=(0., 0.)):
+    """
+    Integrate the flights of a batch of balloons, launched from the ground at the same time,
+    until they've all landed.
+
+    Every balloon goes up until its volume exceeds its burst volume, then down under parachute
+    until it reaches the ground; the last step of each flight is shortened to end exactly on ground.
+
+    :param balloon: a `Balloon`, or a `BalloonEnsemble` with one value per balloon
+    :param model: a `GribModel`
+    :param lons: array of launch longitudes
+    :param lats: array of launch latitudes
+    :param t0: launch date
+    :param time_step: integration step, as a `timedelta`
+    :param max_duration: flights still going after that duration are considered as not bursting
+    :param wind_factor: factor applied to forecast winds, either a scalar or an array with one value per balloon
+    :param wind_bias_ms: `(east, north)` wind added to forecast winds, scalars or arrays with one value per balloon
+    :return: a generator of one dict per step, with arrays for every balloon (balloons already
+        landed don't move anymore): `time` (end of step), `duration` of the step for each balloon
+        in seconds, resulting `lon`, `lat` & `z`, `speed` as `(u, v, w)` in m/s,
+        `sample` at the start of the step, `volume` in m³ and `ascending`.
+    """
+    sampler = FieldSampler(model)
+    terrain = get_terrain(model)
+    lons = np.array(lons, dtype=np.float64)
+    lats = np.array(lats, dtype=np.float64)
+    zs = terrain.altitudes(lons, lats).astype(np.float64)
+    ascending = np.ones(len(lons), dtype=bool)
+    landed = np.zeros(len(lons), dtype=bool)
+    dt = time_step.total_seconds()
+    time = t0
+
+    while not np.all(landed):
+        if time - t0 > max_duration:
+            raise ValueError(f"The flight lasts longer than {max_duration}, the flight duration limit")
+        sample = sampler.sample(lons, lats, zs, time)
+        volume = volume_m3(balloon, sample)
+        ascending &= volume <= balloon.burst_volume_m3
+        w = np.where(ascending, speed_up_ms(balloon, sample), -speed_down_ms(balloon, sample))
+
+        # Shorten steps which would end underground, and freeze landed balloons
+        # (ground altitudes are only needed once some balloons are going down)
+        if np.all(ascending):
+            durations = np.full(len(zs), dt)
+        else:
+            ground = terrain.altitudes(lons, lats)
+            durations = np.where(ascending, dt, np.clip((zs - ground) / (-w * dt), 0, 1) * dt)
+            durations[landed] = 0
+            landed |= ~ascending & (zs + w * dt <= ground)
+
+        u = sample.u_ms * wind_factor + wind_bias_ms[0]
+        v = sample.v_ms * wind_factor + wind_bias_ms[1]
+        (lons, lats) = apply_drift((lons, lats), (u * durations, v * durations))
+        zs = zs + w * durations
+        time += time_step
+        yield {'time': time, 'duration': durations, 'lon': lons, 'lat': lats, 'z': zs,
+               'speed': (u, v, w), 'sample': sample, 'volume': volume,
+               'ascending': ascending.copy()}
+
@@ -0,0 +1,55 @@
+import json
+
+from dateutil.parser import parse as parse_date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forecast.models import grib_models
+from balloon.settings import SWEEP_JOBS
+from core.models import BALLOON_FEATURES
+from core.sweep import launch_dates, sweep
+
+
+class Command(BaseCommand):
+    help = "Compute the landing points of a balloon launched at every forecast date of a time range"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-m", "--model", default="ARPEGE_0.5", type=str, help="Name of the weather model")
+        parser.add_argument("longitude", type=float, help="Launch longitude")
+        parser.add_argument("latitude", type=float, help="Launch latitude")
+        parser.add_argument("date_from", type=str, help="First launch date")
+        parser.add_argument("date_to", type=str, help="Last launch date")
+        parser.add_argument("--balloon-mass", type=float, default=1.2, help="Envelope mass in kg")
+        parser.add_argument("--payload-mass", type=float, default=1.0, help="Payload mass in kg")
+        parser.add_argument("--ground-volume", type=float, default=4.0, help="Volume of helium at ground level in m³")
+        parser.add_argument("-j", "--jobs", type=int, default=SWEEP_JOBS,
+                            help="Number of trajectories computed in parallel, by as many processes")
+        parser.add_argument("--json", action='store_true', default=False, help="Output the table as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            model = grib_models[options['model']]
+        except KeyError:
+            raise CommandError(f"Unknown GRIB model name {options['model']}, valid names are " +
+                               ", ".join(grib_models.keys()))
+        try:
+            date_from = parse_date(options['date_from']).replace(tzinfo=None)
+            date_to = parse_date(options['date_to']).replace(tzinfo=None)
+        except ValueError:
+            raise CommandError("Cannot decode date")
+        if options['balloon_mass'] not in BALLOON_FEATURES:
+            raise CommandError(f"Unsupported balloon mass {options['balloon_mass']}, valid masses are " +
+                               ", ".join(str(mass) for mass in sorted(BALLOON_FEATURES)))
+        balloon_params = {'balloon_mass_kg': options['balloon_mass'],
+                          'payload_mass_kg': options['payload_mass'],
+                          'ground_volume_m3': options['ground_volume']}
+        position = model.round_position((options['longitude'], options['latitude']))
+        dates = launch_dates(model, date_from, date_to)
+        table = sweep(options['model'], position, balloon_params, dates, jobs=options['jobs'])
+
+        if options['json']:
+            print(json.dumps(table))
+        else:
+            print("\t".join(table['columns']))
+            for row in table['rows']:
+                print("\t".join("" if x is None else str(x) for x in row))
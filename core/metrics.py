@@ -0,0 +1,235 @@
+"""
+Per-request timings and counters, and their aggregation into latency histograms.
+
+Code on the hot path records the duration of its stages with `timer(stage)`, and counts events
+with `count(name)`. Both only record anything within a request handled by `MetricsMiddleware`,
+and otherwise cost a context variable lookup: commands, sweeps and benchmarks aren't affected.
+Stages may be nested, e.g. `trajectory` includes the `forecast`, `ground` and `column` stages
+of the columns it extracts; each stage's duration is the total over the request.
+
+`MetricsMiddleware` returns each request's stages and counters in a `Server-Timing` header,
+and adds them to the histograms of its process. Server processes don't share memory, so each
+of them periodically flushes its histograms into a JSON file of `METRICS_PATH`, named after
+its PID, which `core.views.metrics` merges; files of processes which have exited are deleted.
+Requests from the local host with `?profile=1` are answered with a cProfile summary of their
+processing instead of their normal response.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from django.http import HttpResponse
+
+from balloon.settings import METRICS_PATH, METRICS_FLUSH_INTERVAL
+
+# Upper bounds of histogram buckets, in milliseconds; the last bucket is unbounded
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+PROFILE_LINES = 40
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics(object):
+    """
+    Durations and counters of the request being processed.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {}  # stage => cumulated seconds
+        self.counts = {}  # counter name => count
+
+    def to_server_timing(self):
+        """
+        :return: the value of a `Server-Timing` header, with counters as descriptions of duration-less metrics
+        """
+        metrics = [f"{stage};dur={seconds * 1000:.2f}" for (stage, seconds) in self.durations.items()]
+        metrics += [f'{name};desc="{n}"' for (name, n) in self.counts.items()]
+        metrics.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+@contextmanager
+def timer(stage):
+    """
+    Add the duration of the enclosed code to `stage`, if a request is being measured.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.durations[stage] = metrics.durations.get(stage, 0.) + time.perf_counter() - t0
+
+
+def count(name, n=1):
+    """
+    Add `n` to counter `name`, if a request is being measured.
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.counts[name] = metrics.counts.get(name, 0) + n
+
+
+class Histograms(object):
+    """
+    Latency histograms of views and stages, and cumulated counters, of a process. Thread-safe.
+    """
+    def __init__(self, path, flush_interval):
+        """
+        :param path: directory where histograms are flushed, one file per process
+        :param flush_interval: minimum delay between flushes, in seconds
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.latencies = {}  # "view:<name>" or "stage:<name>" => list of bucket counts
+        self.sums_ms = {}  # same keys => cumulated milliseconds
+        self.counts = {}  # counter name => count
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pruned = False
+
+    def add(self, view_name, metrics, total_s):
+        with self.lock:
+            self._add_latency(f"view:{view_name}", total_s)
+            for (stage, seconds) in metrics.durations.items():
+                self._add_latency(f"stage:{stage}", seconds)
+            for (name, n) in metrics.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            must_flush = time.monotonic() - self.last_flush > self.flush_interval
+        if must_flush:
+            self.flush()
+
+    def _add_latency(self, key, seconds):
+        """Must be called with `self.lock` held."""
+        ms = seconds * 1000
+        buckets = self.latencies.get(key)
+        if buckets is None:
+            buckets = self.latencies[key] = [0] * (len(BUCKETS_MS) + 1)
+            self.sums_ms[key] = 0.
+        buckets[bisect_left(BUCKETS_MS, ms)] += 1
+        self.sums_ms[key] += ms
+
+    def to_json(self):
+        with self.lock:
+            return {'latencies': {k: list(v) for (k, v) in self.latencies.items()},
+                    'sums_ms': dict(self.sums_ms), 'counts': dict(self.counts)}
+
+    def flush(self):
+        """
+        Write this process' histograms into its file, atomically so that they can be read at any time.
+        """
+        with self.flush_lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            if not self.pruned:  # Files of the processes this one replaces, typically
+                self.prune()
+                self.pruned = True
+            file_path = self.path / f"{os.getpid()}.json"
+            tmp_path = self.path / f"{os.getpid()}.json.tmp"
+            with tmp_path.open('w') as f:
+                json.dump(self.to_json(), f)
+            os.replace(tmp_path, file_path)
+            self.last_flush = time.monotonic()
+
+    def prune(self):
+        """
+        Delete the files of processes which aren't running anymore, such as those of restarted servers.
+        """
+        for file_path in self.path.glob("*.json*"):
+            try:
+                os.kill(int(file_path.name.split(".")[0]), 0)
+            except ProcessLookupError:
+                file_path.unlink(missing_ok=True)
+            except (ValueError, PermissionError):  # Not a process' file, or a process of another user
+                pass
+
+    def merged(self):
+        """
+        :return: the sum of the histograms flushed by every running process, this one being flushed first
+        """
+        self.flush()
+        self.prune()
+        result = {'latencies': {}, 'sums_ms': {}, 'counts': {}, 'processes': 0}
+        for file_path in self.path.glob("*.json"):
+            try:
+                with file_path.open() as f:
+                    histograms = json.load(f)
+            except (IOError, ValueError):
+                continue
+            result['processes'] += 1
+            for (key, buckets) in histograms['latencies'].items():
+                total = result['latencies'].setdefault(key, [0] * len(buckets))
+                result['latencies'][key] = [a + b for (a, b) in zip(total, buckets)]
+            for (field, values) in (('sums_ms', histograms['sums_ms']), ('counts', histograms['counts'])):
+                for (key, value) in values.items():
+                    result[field][key] = result[field].get(key, 0) + value
+        return result
+
+
+histograms = Histograms(METRICS_PATH, METRICS_FLUSH_INTERVAL)
+
+
+def is_local(request):
+    return request.META.get('REMOTE_ADDR') in LOCAL_ADDRESSES
+
+
+class MetricsMiddleware(object):
+    """
+    Measure every request: see the module's documentation.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.GET.get('profile') == '1' and is_local(request):
+            return self._profile(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            _current.reset(token)
+            raise
+        view_name = request.resolver_match.url_name if request.resolver_match else 'unresolved'
+        response['Server-Timing'] = metrics.to_server_timing()
+        if response.streaming:
+            # Stages go on while the content is streamed: only record them once it's complete
+            response.streaming_content = self._measure_stream(response.streaming_content, metrics, view_name)
+            _current.reset(token)
+        else:
+            _current.reset(token)
+            histograms.add(view_name, metrics, time.perf_counter() - metrics.start)
+        return response
+
+    @staticmethod
+    def _measure_stream(content, metrics, view_name):
+        token = _current.set(metrics)
+        try:
+            yield from content
+        finally:
+            _current.reset(token)
+            histograms.add(view_name, metrics, time.perf_counter() - metrics.start)
+
+    def _profile(self, request):
+        profile = cProfile.Profile()
+        profile.enable()
+        response = self.get_response(request)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        profile.disable()
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return HttpResponse(output.getvalue(), content_type='text/plain')
+
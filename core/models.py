@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 # Physical constants
 EARTH_RADIUS = 6367445      # in metres
 G = 9.81                    # Gravitational acceleration, m/s²
@@ -18,6 +20,29 @@ BALLOON_FEATURES = {  # Envelope mass in kg => { Suggested lift force in N, burs
 }
 
 
+def sat_vapor_pressure_hPa(t_K):
+    """
+    Return the partial water pressure at which t_K is the dew point
+    (water vapor saturation = 100%). Works on scalars as well as NumPy arrays.
+
+    Formula taken from somewhere on the Internets (https://www.omnicalculator.com/physics/air-density).
+    """
+    t_C = t_K - 273.15
+    return 6.1078 * 10 ** ((7.5 * t_C) / (t_C + 237.3))
+
+
+def air_density_kg_m3(p_hPa, t_K, rh_percents):
+    """
+    Compute air density, in kg/m³, according to pressure, temperature and
+    relative humidity (water weights around 18g/mol whereas air is around 30).
+    Works on scalars as well as NumPy arrays.
+    """
+    p_vapor_hPa = sat_vapor_pressure_hPa(t_K) * rh_percents / 100  # partial vapor pressure
+    p_dry_hPa = p_hPa - p_vapor_hPa  # partial dry air pressure
+    return p_dry_hPa * 100 / (R_DRY_J_kgK * t_K) + \
+        p_vapor_hPa * 100 / (R_VAPOR_J_kgK * t_K)
+
+
 class Balloon(object):
     """
     Features of a balloon with its gas filling and payload.
@@ -48,11 +73,39 @@ class Balloon(object):
         # Archimede's force is the same although the volume and pressure change.
         self.lift_N = (self.ground_volume_m3 * HE_LIFT_KG_M3 - mass) * G
 
+        self.cx = CX_BALLOON
+
+
+class BalloonEnsemble(object):
+    """
+    A batch of variants of a balloon, whose lift, burst volume and Cx differ, as NumPy arrays
+    with one value per variant. It can be used wherever a `Balloon` is, by batch computations.
+    """
+    def __init__(self, balloon, lift_N, burst_volume_m3, cx):
+        """
+        :param balloon: the nominal `Balloon`
+        :param lift_N: array of lifts; ground volumes are deduced from them
+        :param burst_volume_m3: array of burst volumes
+        :param cx: array of Cx while going up
+        """
+        self.balloon_mass_kg = balloon.balloon_mass_kg
+        self.payload_mass_kg = balloon.payload_mass_kg
+        self.ground_pressure_hPa = balloon.ground_pressure_hPa
+        self.lift_N = lift_N
+        self.ground_volume_m3 = (lift_N / G + balloon.balloon_mass_kg + balloon.payload_mass_kg) / HE_LIFT_KG_M3
+        self.burst_volume_m3 = burst_volume_m3
+        self.cx = cx
+
+    def __len__(self):
+        return len(self.lift_N)
+
 
 class Cell(object):
     """
     Description of atmosphere at a given lat/lon/alt/time point, extracted from a GRIB model.
     """
+    __slots__ = ('u_ms', 'v_ms', 't_K', 'z_m', 'p_hPa', 'rho_kg_m3', 'height_m', 'z0_m')
+
     def __init__(self, u, v, t, p=None, z=None, r=None, rho=None):
         """
         :param u: east-ward speed of wind (m/s)
@@ -106,23 +159,15 @@ class Cell(object):
         (water vapor saturation = 100%).
 
         Allows to convert relative humidity and pressure into an accurate air density.
-
-        Formula taken from somewhere on the Internets (https://www.omnicalculator.com/physics/air-density).
-         """
-        t_C = t_K - 273.15
-        p_dew_hPa = 6.1078 * 10 ** ((7.5 * t_C) / (t_C + 237.3))
-        return p_dew_hPa
+        """
+        return sat_vapor_pressure_hPa(t_K)
 
     def rho(self, p_hPa, t_K, rh_percents):
         """
         Compute air density, in kg/m³, according to pressure, temperature and
-        relative humidity (water weights around 18g/mol whereas air is around 30).
+        relative humidity.
         """
-        p_vapor_hPa = self.sat_vapor_pressure(t_K) * rh_percents / 100  # partial vapor pressure
-        p_dry_hPa = p_hPa - p_vapor_hPa  # partial dry air pressure
-        rho = p_dry_hPa * 100 / (R_DRY_J_kgK * t_K) + \
-              p_vapor_hPa * 100 / (R_VAPOR_J_kgK * t_K)  # density
-        return rho
+        return air_density_kg_m3(p_hPa, t_K, rh_percents)
 
     def __str__(self):
         """
@@ -144,26 +189,37 @@ class Cell(object):
 class Column(object):
     """
     Stack of cells at a given (lon, lat) grid position.
-    In addition to storing cells in a pressure-indexed dictionary `self.cell`,
-    this class offers a couple of interpolation / extrapolation features for missing points,
-    most notably the exact launch altitude and the stratospheric levels.
+    Levels are stored as NumPy arrays, sorted by increasing altitude, and only turned into
+    `Cell` objects on demand. This class also offers a couple of interpolation / extrapolation
+    features for missing points, most notably the exact launch altitude and the stratospheric levels.
 
     Public fields include:
     * `grib_model`
     * `position`: `(longitude, latitude)`
     * `valid_date`, `analysis_date` always in UTC
     * `ground_altitude` in meters
-    * `cells` a sorted list by  increasing altitude
+    * `p_hPa`, `z_m`, `u_ms`, `v_ms`, `t_K`, `rho_kg_m3`, `height_m`, `z0_m`: arrays of the values
+      of over-ground levels, model levels then extrapolated ones. The height of the last extrapolated
+      level is unknown, and set to NaN.
+    * `underground_levels`: number of model levels below ground, which aren't in the arrays
+    * `cells` a list of `Cell`s, `None` for underground levels, then every over-ground level
     """
     def __init__(self, grib_model, position, valid_date, analysis_date,
-                 ground_altitude, cells, extrapolated_pressures=()):
+                 ground_altitude, p, z, u, v, t, r=None, rho=None, z_boundaries=None, extrapolated_pressures=()):
         """
         :param grib_model:
         :param position:
         :param valid_date:
         :param analysis_date:
         :param ground_altitude:
-        :param cells:
+        :param p: array of model levels' pressures, in hPa
+        :param z: array of model levels' altitudes, in meters
+        :param u: array of model levels' east-ward wind speeds, in m/s
+        :param v: array of model levels' north-ward wind speeds, in m/s
+        :param t: array of model levels' temperatures, in °K
+        :param r: array of model levels' relative humidities, in percents, needed if `rho` isn't given
+        :param rho: array of model levels' air densities, in kg/m³
+        :param z_boundaries: array of model levels' upper boundary altitudes, in meters, if precomputed
         :param extrapolated_pressures:
         """
         self.grib_model = grib_model
@@ -171,43 +227,93 @@ class Column(object):
         self.valid_date = valid_date
         self.analysis_date = analysis_date
         self.ground_altitude = ground_altitude
-
-        # Sort cells and remove cells below ground surface
-        sorted_cells = sorted(cells, key=lambda l: l.p_hPa, reverse=True)
-        i = next(i for (i, l) in enumerate(sorted_cells) if l.z_m > ground_altitude)
-        sorted_cells = sorted_cells[i:]
+        self._cells = None  # Built lazily
+
+        # Sort levels by increasing altitude, and remove those below ground surface
+        p = np.asarray(p)
+        order = np.argsort(-p, kind='stable')
+        z = np.asarray(z, dtype=np.float64)[order]
+        overground = z > ground_altitude
+        if not overground.any():
+            raise ValueError("The ground is above every level of the model")
+        i = int(overground.argmax())
+        self.underground_levels = i
+        (p, z) = (p[order][i:], z[i:])
+        (u, v, t) = (np.asarray(x, dtype=np.float64)[order][i:] for x in (u, v, t))
+        if rho is None:
+            rho = air_density_kg_m3(p, t, np.asarray(r, dtype=np.float64)[order][i:])
+        else:
+            rho = np.asarray(rho, dtype=np.float64)[order][i:]
+        if z_boundaries is not None:
+            z_boundaries = np.asarray(z_boundaries, dtype=np.float64)[order][i:]
 
         # Interpolated ground pressure (needed to compute balloon dilatation according to pressure)
-        (la, lb) = sorted_cells[:2]
-        self.ground_pressure = self._interpolate_altitude_pressure(Pa=la.p_hPa, Pb=lb.p_hPa, Za=la.z_m, Zb=lb.z_m,
+        self.ground_pressure = self._interpolate_altitude_pressure(Pa=p[0].item(), Pb=p[1].item(),
+                                                                   Za=z[0].item(), Zb=z[1].item(),
                                                                    Zc=ground_altitude)
 
-        # Extrapolated stratospheric cells (sometimes the balloon bursts above the top model cell)
-        (ly, lz) = sorted_cells[-2:]
-        sorted_extrapolated_pressures = sorted((p for p in extrapolated_pressures if p < lz.p_hPa), reverse=True)
-        extrapolated_cells = [self._extrapolate_stratospheric_cell(ly, lz, p) for p in sorted_extrapolated_pressures]
-
-        # Add heights to cells
-        all_overground_cells = sorted_cells + extrapolated_cells
-        for (l0, l1, l2) in zip(all_overground_cells[0:], all_overground_cells[1:], all_overground_cells[2:]):
-            # Boundaries for l1 are at (Z2+Z1)/2 and (Z1+Z0)/2, height is therefore (Z2-Z0)/2
-            l1.height_m = (l2.z_m - l0.z_m) / 2
-
-        # First cell goes from ground_altitude to La/Lb boundary
-        la.height_m = (la.z_m + lb.z_m)/2 - ground_altitude
-
-        # For  last cell, we consider that z_m is in the middle of the cell.
-        # The height is therefor twice the distance from last boundary (Zy+Zz)/2 to Zz.
-        lz.height_m = lz.z_m - ly.z_m
-
-        # Add z limits z0 & z1
-        z = self.ground_altitude
-        for c in all_overground_cells:
-            c.z0_m = z
-            z = z + c.height_m if c.height_m else None
+        # Extrapolated stratospheric levels (sometimes the balloon bursts above the top model level).
+        # Temperatures have a limited gradient in the stratosphere, winds are kept as on the top level.
+        top = len(p) - 1
+        extrapolated_p = np.array(sorted((x for x in extrapolated_pressures if x < p[top]), reverse=True))
+        extrapolated_p = extrapolated_p.astype(np.result_type(p, extrapolated_p) if len(extrapolated_p) else p.dtype)
+        n = len(extrapolated_p)
+        K = math.log(p[top - 1] / p[top]) / (z[top] - z[top - 1])
+        P = p[top] * math.exp(K * z[top])
+        self.p_hPa = np.concatenate((p, extrapolated_p))
+        self.z_m = np.concatenate((z, np.log(P / extrapolated_p) / K))
+        self.u_ms = np.concatenate((u, np.full(n, u[top])))
+        self.v_ms = np.concatenate((v, np.full(n, v[top])))
+        self.t_K = np.concatenate((t, np.full(n, t[top])))
+        self.rho_kg_m3 = np.concatenate((rho, rho[top] * extrapolated_p / p[top]))
+
+        # Boundaries between levels are half-way between their altitudes:
+        # boundaries for level k are at (Zk+1 + Zk)/2 and (Zk + Zk-1)/2, height is therefore (Zk+1 - Zk-1)/2.
+        z = self.z_m
+        height = np.full(len(z), np.nan)
+        height[1:-1] = (z[2:] - z[:-2]) / 2
+        if z_boundaries is None:
+            # First level goes from ground_altitude to the boundary with the second one
+            height[0] = (z[0] + z[1]) / 2 - ground_altitude
+            # For the top model level, we consider that z_m is in the middle of the level.
+            # The height is therefore twice the distance from last boundary (Zy+Zz)/2 to Zz.
+            height[top] = z[top] - z[top - 1]
+        else:  # Same boundaries, precomputed by `forecast.preprocess`
+            height[0] = z_boundaries[0] - ground_altitude
+            height[1:top + 1] = z_boundaries[1:] - z_boundaries[:-1]
+        self.height_m = height
+
+        # Lower limits z0
+        self.z0_m = np.cumsum(np.concatenate(([ground_altitude], height[:-1])))
+
+    def __len__(self):
+        """
+        :return: number of levels, including underground ones
+        """
+        return self.underground_levels + len(self.z_m)
 
-        underground_cells = i * [None]
-        self.cells = underground_cells + all_overground_cells
+    def cell(self, i):
+        """
+        :param i: level index, as in `cells`
+        :return: a `Cell` describing level `i`, or None if it's underground
+        """
+        if self._cells is not None:
+            return self._cells[i]
+        k = i - self.underground_levels
+        if k < 0:
+            return None
+        cell = Cell(u=self.u_ms[k].item(), v=self.v_ms[k].item(), t=self.t_K[k].item(),
+                    p=self.p_hPa[k].item(), z=self.z_m[k].item(), rho=self.rho_kg_m3[k].item())
+        height = self.height_m[k].item()
+        cell.height_m = None if math.isnan(height) else height
+        cell.z0_m = self.z0_m[k].item() if k > 0 else self.ground_altitude
+        return cell
+
+    @property
+    def cells(self):
+        if self._cells is None:
+            self._cells = [self.cell(i) for i in range(len(self))]
+        return self._cells
 
     def does_contain_point(self, position):
         """
@@ -256,24 +362,6 @@ class Column(object):
         else:
             raise ValueError("One of Pc/Zc must be None")
 
-    def _extrapolate_stratospheric_cell(self, cell0, cell1, p):
-        """
-        Create an extrapolated cell in the stratosphere, in case the balloon goes beyond
-        the forecast model's ceiling.
-        :param cell0: second highest cell from the model
-        :param cell1: highest cell from the model
-        :param p: pressure cell to extrapolate
-        :return: a cell object
-        """
-        return Cell(
-            u=cell1.u_ms,
-            v=cell1.v_ms,
-            t=cell1.t_K,  # Temperatures have a limited gradient in the stratosphere
-            p=p,
-            z=self._interpolate_altitude_pressure(Pa=cell1.p_hPa, Pb=cell0.p_hPa, Za=cell1.z_m,
-                                                  Zb=cell0.z_m, Pc=p),
-            rho=cell1.rho_kg_m3 * p / cell1.p_hPa)
-
     def to_json(self):
         return {
             'model': self.grib_model.name,
@@ -282,5 +370,5 @@ class Column(object):
             'analysis_date': self.analysis_date.isoformat(),
             'valid_date': self.valid_date.isoformat(),
             'ground': {'pressure': self.ground_pressure, 'z': self.ground_altitude},
-            'cells': [cell.to_json() for cell in self.cells]
+            'cells': [cell.to_json() if cell is not None else None for cell in self.cells]
         }
@@ -0,0 +1,73 @@
+"""
+Launch-window sweeps: the trajectories of a same balloon, launched from a same
+position at every valid date of a time range, summarized as a compact table.
+
+Dates are split into runs of contiguous dates, one per worker process: a
+trajectory launched at a given hour goes through the same valid dates as those
+launched at neighbouring hours, so each worker reuses the forecast arrays
+already mapped by its `forecast_cache` rather than reloading them. The sweep view
+computes them sequentially in the server's process, which reuses its own cache.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from dateutil.parser import parse
+
+from forecast.extract import ColumnExtractor
+from forecast.models import grib_models
+from .models import Balloon
+from .trajectory import trajectory
+
+COLUMNS = ('launch', 'landing_lon', 'landing_lat', 'landing_altitude_m', 'flight_s', 'burst_altitude_m', 'error')
+
+
+def launch_dates(model, date_from, date_to):
+    """
+    :return: sorted list of the valid dates between `date_from` and `date_to` included,
+        for which `model` has preprocessed forecasts
+    """
+    return sorted(d for d in ColumnExtractor(model).list_files(date_from) if d <= date_to)
+
+
+def _sweep_dates(model_name, position, balloon_params, dates):
+    """
+    Compute the table rows of contiguous launch dates, in a worker process.
+    :param model_name: key of the model in `grib_models`
+    """
+    model = grib_models[model_name]
+    extractor = ColumnExtractor(model=model, extrapolated_pressures=range(1, 20))
+    rows = []
+    for date in dates:
+        try:
+            column = extractor.extract(date, position)
+            balloon = Balloon(ground_pressure_hPa=column.ground_pressure, **balloon_params)
+            points = trajectory(balloon=balloon, column_extractor=extractor, p0=position, t0=date)
+        except ValueError as e:
+            rows.append([date.isoformat(), None, None, None, None, None, e.args[0]])
+            continue
+        landing = points[-1]['position']
+        flight_s = (parse(points[-1]['time']).replace(tzinfo=None) - date).total_seconds()
+        burst_altitude_m = max(p['position']['z'] for p in points)
+        rows.append([date.isoformat(), landing['x'], landing['y'], landing['z'], round(flight_s),
+                     burst_altitude_m, None])
+    return rows
+
+
+def sweep(model_name, position, balloon_params, dates, jobs=1):
+    """
+    :param model_name: key of the model in `grib_models`, such as `"ARPEGE_0.5"`
+    :param position: launch `(lon, lat)`, rounded with `model.round_position`
+    :param balloon_params: dict of `Balloon` parameters, except for the ground pressure
+    :param dates: sorted launch dates, as returned by `launch_dates`
+    :param jobs: number of worker processes
+    :return: a dict with the `columns` names and the `rows` of the table, one per launch date.
+        Launches whose trajectory can't be computed have their `error` column set.
+    """
+    if jobs <= 1 or len(dates) <= 1:
+        rows = _sweep_dates(model_name, position, balloon_params, dates)
+    else:
+        jobs = min(jobs, len(dates))
+        runs = [dates[i * len(dates) // jobs:(i + 1) * len(dates) // jobs] for i in range(jobs)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_sweep_dates, model_name, position, balloon_params, run) for run in runs]
+            rows = [row for future in futures for row in future.result()]
+    return {'columns': COLUMNS, 'rows': rows}
@@ -1,8 +1,12 @@
+import io
+import json
 import math
-from datetime import timedelta
+from datetime import datetime, timedelta
 import logging
 
-from .models import CX_PARACHUTE, CX_BALLOON, R_PARACHUTE_M, G, EARTH_RADIUS
+import numpy as np
+
+from .models import CX_PARACHUTE, R_PARACHUTE_M, G, EARTH_RADIUS
 
 
 logger = logging.getLogger('balloon')
@@ -21,6 +25,7 @@ def volume_m3(balloon, cell):
 def speed_up_ms(balloon, cell):
     """
     Speed of the balloon going up in a given cell, in m/s.
+    Also works on NumPy arrays of cell values, such as `core.integrator.Sample`s.
     The drag force is `½·ρ·S·Cx·V²`, with `S` the frontal area.
     At equilibrium, drag force equals lift, which gives:
 
@@ -34,7 +39,7 @@ def speed_up_ms(balloon, cell):
     :return: speed going up in this cell (s)
     """
     balloon_frontal_aera_m2 = math.pi * (3 / 4 * volume_m3(balloon, cell) / math.pi) ** (2 / 3)
-    return math.sqrt((2 * balloon.lift_N) / (cell.rho_kg_m3 * balloon_frontal_aera_m2 * CX_BALLOON))
+    return np.sqrt((2 * balloon.lift_N) / (cell.rho_kg_m3 * balloon_frontal_aera_m2 * balloon.cx))
 
 
 def speed_down_ms(balloon, cell):
@@ -49,7 +54,7 @@ def speed_down_ms(balloon, cell):
     """
     f = G * balloon.payload_mass_kg
     area = math.pi * R_PARACHUTE_M**2
-    return math.sqrt((2*f) / (cell.rho_kg_m3 * area * CX_PARACHUTE))
+    return np.sqrt((2*f) / (cell.rho_kg_m3 * area * CX_PARACHUTE))
 
 
 def apply_drift(position, drift):
@@ -60,15 +65,15 @@ def apply_drift(position, drift):
     Meters `m` are converted in angle degrees `d` with `m / 2πR = d / 360 ⇒ d = 180m / πR`,
     with `R` the Earth radius for latitudes, and the meridian's radius `R·cos(latitude)` for longitudes
 
-    :param position: position in degrees
-    :param drift: drift to apply in meters
+    :param position: position in degrees, either floats or NumPy arrays
+    :param drift: drift to apply in meters, either floats or NumPy arrays
     :return: resulting (lon, lat) position in degrees.
     """
     (lon, lat) = position
     (east_m, north_m) = drift
 
     north_d = (180 * north_m) / (math.pi * EARTH_RADIUS)
-    east_d = (180 * east_m) / (math.pi * EARTH_RADIUS * math.cos(math.radians(lat)))
+    east_d = (180 * east_m) / (math.pi * EARTH_RADIUS * np.cos(np.radians(lat)))
 
     return lon + east_d, lat + north_d
 
@@ -97,7 +102,7 @@ def make_trajectory_point(column, cell, position, time, speed_ms, volume=None):
                  't': column.valid_date.isoformat()},
         'pressure': cell.p_hPa,
         'rho': r(cell.rho_kg_m3, 3),
-        'temp': r(cell.t_K + 273.15),
+        'temp': r(cell.t_K - 273.15),
         'time': time.isoformat().split(".", 1)[0]+"Z"
     }
     if volume is not None:
@@ -114,8 +119,15 @@ def trajectory(balloon, column_extractor, p0, t0):
     :param column_extractor:
     :param p0: initial position `(lon, lat)`
     :param t0: date of launch
-    :return: a list of `(eastward drift, northward drift, altitude, time)` tuples,
-        in meters and seconds, for each cell.
+    :return: a list of trajectory points, as generated by `make_trajectory_point`, for each cell.
+    """
+    return list(iter_trajectory(balloon, column_extractor, p0, t0))
+
+
+def iter_trajectory(balloon, column_extractor, p0, t0):
+    """
+    Generator version of `trajectory`, yielding points as soon as they're computed.
+    If the balloon doesn't burst, `ValueError` is raised once the way up has been yielded.
     """
 
     # In this first version, we simply go up then down the cells in the column.
@@ -125,7 +137,6 @@ def trajectory(balloon, column_extractor, p0, t0):
 
     # Compute the drifts north-ward and east-ward, in each cell, of the ascending balloon.
 
-    points = []
     time = t0
     position = p0
     burst = False
@@ -133,13 +144,13 @@ def trajectory(balloon, column_extractor, p0, t0):
     i = 0
 
     # Skip underground cells
-    while column.cells[i] is None:
+    while column.cell(i) is None:
         i += 1
 
     # Way up; we keep index `i` rather than iterating directly on the column,
     # because there might be column changes due to drift and/or time passing.
-    while i < len(column.cells) and not burst:
-        cell = column.cells[i]
+    while i < len(column) and not burst:
+        cell = column.cell(i)
         v_m3 = volume_m3(balloon, cell)
         logger.info(f"({i:02d}) {pos_string(position, cell.z_m)}, {cell.p_hPa:>4d}hPa, volume = {int(v_m3)}m³")
         if v_m3 > balloon.burst_volume_m3:
@@ -147,7 +158,7 @@ def trajectory(balloon, column_extractor, p0, t0):
             burst = True
             break
         (point, position, time) = make_trajectory_point(column, cell, position, time, speed_up_ms(balloon, cell), volume=v_m3)
-        points.append(point)
+        yield point
         i += 1
         if not column.does_contain_point(position) or not column.is_closest_to_date(time):
             column = column_extractor.extract(time, position)
@@ -158,19 +169,17 @@ def trajectory(balloon, column_extractor, p0, t0):
 
     # Way down, at parachute speed. Index `i` is still at the cell index where the balloon burst.
     while i >= 0:
-        cell = column.cells[i]
+        cell = column.cell(i)
         if cell is None:  # On ground
             break
         logger.info(f"({i:02d}) back to {pos_string(position, cell.z_m)}, {cell.p_hPa: 4d}hPa")
         (point, position, time) = make_trajectory_point(column, cell, position, time, -speed_down_ms(balloon, cell))
-        points.append(point)
+        yield point
         if not column.does_contain_point(position) or not column.is_closest_to_date(time):
             column = column_extractor.extract(time, position)
             logger.info(f"(**) Switching to column {column.position[0]}, {column.position[1]}")
         i -= 1
 
-    return points
-
 
 def to_geojson(trajectory):
     """
@@ -182,12 +191,49 @@ def to_geojson(trajectory):
     :return: dictionary ready to seraialize into geojson.
     """
     # TODO start from ground not MSL
-    features = []
-    for p in trajectory:
-        ftr = {"type": "Feature",
-               "geometry": {"type": "Point",
-                            "coordinates": [round(p['position']['x'], 4), round(p['position']['y'], 4)]},
-               "properties": p}
-        features.append(ftr)
-
+    features = [to_geojson_feature(p) for p in trajectory]
     return {"type": "FeatureCollection", "properties": {}, "features": features}
+
+
+def to_geojson_feature(point):
+    """
+    Convert a trajectory point into a geojson point feature.
+    """
+    return {"type": "Feature",
+            "geometry": {"type": "Point",
+                         "coordinates": [round(point['position']['x'], 4), round(point['position']['y'], 4)]},
+            "properties": point}
+
+
+def to_arrays(trajectory):
+    """
+    Convert trajectory points into columnar arrays, one value per point.
+
+    :param trajectory: list of trajectory points
+    :return: dict of NumPy arrays: `time` in seconds since the Unix epoch, `lon` & `lat` in degrees,
+        `z` in meters above MSL, and speed `u`, `v`, `w` in m/s
+    """
+    epoch = datetime(1970, 1, 1)
+    return {
+        'time': np.array([(datetime.fromisoformat(p['time'].rstrip("Z")) - epoch).total_seconds()
+                          for p in trajectory], dtype=np.int64),
+        'lon': np.array([p['position']['x'] for p in trajectory], dtype=np.float32),
+        'lat': np.array([p['position']['y'] for p in trajectory], dtype=np.float32),
+        'z': np.array([p['position']['z'] for p in trajectory], dtype=np.float32),
+        'u': np.array([p['speed']['x'] for p in trajectory], dtype=np.float32),
+        'v': np.array([p['speed']['y'] for p in trajectory], dtype=np.float32),
+        'w': np.array([p['speed']['z'] for p in trajectory], dtype=np.float32),
+    }
+
+
+def to_npz(trajectory, metadata):
+    """
+    Serialize a trajectory as a compressed NumPy `.npz` archive, for consumers which only need its arrays.
+
+    :param trajectory: list of trajectory points
+    :param metadata: JSON-serializable dict, stored as a JSON string in the archive's `metadata` entry
+    :return: the archive's bytes, which `numpy.load` reads back
+    """
+    f = io.BytesIO()
+    np.savez_compressed(f, metadata=np.array(json.dumps(metadata)), **to_arrays(trajectory))
+    return f.getvalue()
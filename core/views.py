@@ -1,11 +1,23 @@
+import json
+
+import numpy as np
 from dateutil.parser import parse
 
-from django.http import HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 
+from balloon.settings import SWEEP_MAX_DATES
 from forecast.models import grib_models
 from forecast import extract
+from forecast.cache import column_cache, forecast_cache
 from core import models as m
+from .cache import trajectory_cache
+from . import metrics as core_metrics
 from . import trajectory as core_trajectory
+from . import ensemble as core_ensemble
+from . import sweep as core_sweep
+
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
 
 
 def _parse_date(date_string):
@@ -13,6 +25,24 @@ def _parse_date(date_string):
     return parse(date_string).astimezone().replace(tzinfo=None)
 
 
+def _ndjson_lines(points, on_complete):
+    """
+    Serialize trajectory points as soon as they're computed, one geojson feature per line.
+    Since the response status has already been sent, errors are reported by a last `{"error": message}` line.
+    :param points: iterable of trajectory points
+    :param on_complete: called with the list of every point, once they've all been serialized without error
+    """
+    trajectory = []
+    try:
+        for point in points:
+            trajectory.append(point)
+            yield json.dumps(core_trajectory.to_geojson_feature(point)) + "\n"
+    except ValueError as e:
+        yield json.dumps({'error': e.args[0]}) + "\n"
+    else:
+        on_complete(trajectory)
+
+
 def column(request):
     params = request.GET
     try:
@@ -29,7 +59,8 @@ def column(request):
 
     column = extract.ColumnExtractor(model).extract(date, (longitude, latitude))
 
-    return JsonResponse(column.to_json())
+    with core_metrics.timer("serialize"):
+        return JsonResponse(column.to_json())
 
 
 def trajectory(request):
@@ -42,6 +73,11 @@ def trajectory(request):
         balloon_mass_kg = float(params['balloon_mass_kg'])
         payload_mass_kg = float(params['payload_mass_kg'])
         ground_volume_m3 = float(params['ground_volume_m3'])
+        # `ndjson` streams one geojson feature per line, as points are computed;
+        # `npz` is a NumPy archive of columnar arrays, see `core.trajectory.to_npz`
+        output_format = params.get('format', 'geojson')
+        if output_format not in ('geojson', 'ndjson', 'npz'):
+            raise ValueError(f"unknown format {output_format}")
     except KeyError as e:
         field = e.args[0]
         return HttpResponseBadRequest(f"Parameter {field} missing or invalid")
@@ -49,21 +85,171 @@ def trajectory(request):
         msg = e.args[0]
         return HttpResponseBadRequest(f"Invalid parameter: {msg}")
 
+    # Launch parameters are quantized, so that trajectories can be reused across requests
     position = model.round_position((longitude, latitude))
+    date = model.round_time(date)
 
     extractor = extract.ColumnExtractor(
         model=model,
         extrapolated_pressures=range(1, 20))
     column = extractor.extract(date, position)
+    cache_key = trajectory_cache.key(model, column.analysis_date, position, date,
+                                     ground_volume_m3, balloon_mass_kg, payload_mass_kg)
+    metadata = {
+        'model': params['model'],
+        'analysis_date': column.analysis_date.isoformat(),
+        'launch': {'lon': position[0], 'lat': position[1], 'date': date.isoformat()},
+        'balloon': {'ground_volume_m3': ground_volume_m3, 'balloon_mass_kg': balloon_mass_kg,
+                    'payload_mass_kg': payload_mass_kg}}
+
+    def npz_response(traj):
+        with core_metrics.timer("serialize"):
+            response = HttpResponse(core_trajectory.to_npz(traj, metadata), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="trajectory.npz"'
+        return response
+
+    with core_metrics.timer("trajectory_cache"):
+        geojson = trajectory_cache.get(cache_key)
+    if geojson is not None:
+        core_metrics.count("trajectory_cache_hits")
+        if output_format == 'ndjson':
+            features = json.loads(geojson)['features']
+            return StreamingHttpResponse((json.dumps(f) + "\n" for f in features), content_type=NDJSON_CONTENT_TYPE)
+        if output_format == 'npz':
+            return npz_response([f['properties'] for f in json.loads(geojson)['features']])
+        return HttpResponse(geojson, content_type='application/json')
+
     balloon = m.Balloon(
         ground_volume_m3=ground_volume_m3,
         balloon_mass_kg=balloon_mass_kg,
         payload_mass_kg=payload_mass_kg,
         ground_pressure_hPa=column.ground_pressure)
-    traj = core_trajectory.trajectory(
+    points = core_trajectory.iter_trajectory(
         balloon=balloon,
         column_extractor=extractor,
         p0=position,
         t0=date)
-    geojson = core_trajectory.to_geojson(traj)
-    return JsonResponse(geojson, safe=False)
+
+    def cache(traj, geojson=None):
+        if geojson is None:
+            geojson = json.dumps(core_trajectory.to_geojson(traj))
+        with core_metrics.timer("trajectory_cache"):
+            trajectory_cache.put(cache_key, f"{model.name}_{model.grid_pitch}",
+                                 date_from=date, date_to=parse(traj[-1]['cell']['t']), geojson=geojson)
+
+    if output_format == 'ndjson':
+        return StreamingHttpResponse(_ndjson_lines(points, on_complete=cache), content_type=NDJSON_CONTENT_TYPE)
+    with core_metrics.timer("trajectory"):
+        traj = list(points)
+    with core_metrics.timer("serialize"):
+        geojson = json.dumps(core_trajectory.to_geojson(traj))
+    cache(traj, geojson)
+    if output_format == 'npz':
+        return npz_response(traj)
+    return HttpResponse(geojson, content_type='application/json')
+
+
+def ensemble(request):
+    """
+    Landing zone of a balloon, estimated by simulating an ensemble of randomly perturbed flights.
+    Returns either percentile ellipses (`output=ellipses`, the default) or a density grid (`output=density`).
+    """
+    params = request.GET
+    try:
+        model = grib_models[params['model']]
+        latitude = float(params['latitude'])
+        longitude = float(params['longitude'])
+        date = _parse_date(params['date'])
+        balloon_mass_kg = float(params['balloon_mass_kg'])
+        if balloon_mass_kg not in m.BALLOON_FEATURES:
+            raise ValueError(f"unsupported balloon_mass_kg {balloon_mass_kg}")
+        payload_mass_kg = float(params['payload_mass_kg'])
+        ground_volume_m3 = float(params['ground_volume_m3'])
+        size = int(params.get('size', core_ensemble.DEFAULT_SIZE))
+        if not 2 <= size <= core_ensemble.MAX_SIZE:
+            raise ValueError(f"size must be between 2 and {core_ensemble.MAX_SIZE}")
+        seed = int(params['seed']) if 'seed' in params else None
+        output = params.get('output', 'ellipses')
+        if output not in ('ellipses', 'density'):
+            raise ValueError(f"unknown output {output}")
+        density_pitch = float(params.get('density_pitch', model.grid_pitch / 10))
+        if density_pitch <= 0:
+            raise ValueError("density_pitch must be positive")
+    except KeyError as e:
+        field = e.args[0]
+        return HttpResponseBadRequest(f"Parameter {field} missing or invalid")
+    except ValueError as e:
+        msg = e.args[0]
+        return HttpResponseBadRequest(f"Invalid parameter: {msg}")
+
+    position = model.round_position((longitude, latitude))
+    date = model.round_time(date)
+    try:
+        column = extract.ColumnExtractor(model).extract(date, position)
+        balloon = m.Balloon(
+            ground_volume_m3=ground_volume_m3,
+            balloon_mass_kg=balloon_mass_kg,
+            payload_mass_kg=payload_mass_kg,
+            ground_pressure_hPa=column.ground_pressure)
+        rng = np.random.default_rng(seed)
+        balloons = core_ensemble.perturb(balloon, size, rng)
+        with core_metrics.timer("trajectory"):
+            landings = core_ensemble.simulate(balloons, model, position, date, rng)
+    except ValueError as e:  # E.g. no forecast for this date, flights out of the forecasts' box, or not landing
+        msg = e.args[0]
+        return HttpResponseBadRequest(f"Cannot simulate the flight: {msg}")
+
+    result = {'size': size, **core_ensemble.flight_summary(landings)}
+    if output == 'density':
+        result['density'] = core_ensemble.density_grid(landings['lon'], landings['lat'], density_pitch)
+    else:
+        result['ellipses'] = core_ensemble.percentile_ellipses(landings['lon'], landings['lat'])
+    return JsonResponse(result)
+
+
+def sweep(request):
+    """
+    Landing points of a balloon launched at every valid date between `date_from` and `date_to`.
+    """
+    params = request.GET
+    try:
+        model_name = params['model']
+        model = grib_models[model_name]
+        latitude = float(params['latitude'])
+        longitude = float(params['longitude'])
+        date_from = _parse_date(params['date_from'])
+        date_to = _parse_date(params['date_to'])
+        balloon_params = {
+            'balloon_mass_kg': float(params['balloon_mass_kg']),
+            'payload_mass_kg': float(params['payload_mass_kg']),
+            'ground_volume_m3': float(params['ground_volume_m3'])}
+        if balloon_params['balloon_mass_kg'] not in m.BALLOON_FEATURES:
+            raise ValueError(f"unsupported balloon_mass_kg {balloon_params['balloon_mass_kg']}")
+    except KeyError as e:
+        field = e.args[0]
+        return HttpResponseBadRequest(f"Parameter {field} missing or invalid")
+    except ValueError as e:
+        msg = e.args[0]
+        return HttpResponseBadRequest(f"Invalid parameter: {msg}")
+
+    dates = core_sweep.launch_dates(model, date_from, date_to)
+    if len(dates) > SWEEP_MAX_DATES:
+        return HttpResponseBadRequest(f"Too many launch dates ({len(dates)}), at most {SWEEP_MAX_DATES} are swept")
+    position = model.round_position((longitude, latitude))
+    # Computed in the server's process: worker processes are for `trajectory_sweep`
+    table = core_sweep.sweep(model_name, position, balloon_params, dates)
+    return JsonResponse(table)
+
+
+def metrics(request):
+    """
+    Latency histograms and counters merged over every server process, and the caches of this process.
+    Only served to the local host.
+    """
+    if not core_metrics.is_local(request):
+        return HttpResponseForbidden("Metrics are only served locally")
+    result = core_metrics.histograms.merged()
+    result['buckets_ms'] = list(core_metrics.BUCKETS_MS) + [None]
+    result['column_cache'] = column_cache.stats()
+    result['forecast_cache'] = {'size': len(forecast_cache.entries), 'bytes': forecast_cache.nbytes}
+    return JsonResponse(result)
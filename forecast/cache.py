@@ -0,0 +1,220 @@
+"""
+Process-wide caches of preprocessed forecast arrays, and of the columns built from them.
+
+Arrays are opened memory-mapped rather than read in memory: every uwsgi worker
+then shares the same OS page-cache pages, and only the pages actually
+accessed by column extractions are loaded from disk.
+
+Entries are keyed by `(model_name, valid_date)`, evicted in least-recently-used
+order once the cumulated size of mapped arrays exceeds a byte budget, and
+reloaded when `forecast_preprocess` rewrites the shape file of a valid date
+(which it only does for a newer analysis date, unless forced).
+
+Columns are cached by grid indexes rather than positions, so that every position
+rounded to the same grid point shares them. They are checked against the analysis
+date of the forecast they've been built from, which therefore invalidates them.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+from dateutil.parser import parse
+
+from balloon.settings import GRIB_PATH, FORECAST_CACHE_BYTES, COLUMN_CACHE_SIZE
+from core.metrics import count
+from forecast.grid import GridIndex
+
+LOAD_ATTEMPTS = 5
+LOAD_RETRY_DELAY = 0.05  # seconds
+
+
+class Forecast(object):
+    """
+    A preprocessed forecast for a given model and valid date: its array and
+    its indexing description, as stored in the `.np` / `.json` files.
+    """
+    def __init__(self, array, shape, mtime_ns):
+        self.array = array
+        self.shape = shape
+        self.grid = GridIndex.from_shape(shape)
+        self.analysis_date = parse(shape['analysis_date'])
+        self.mtime_ns = mtime_ns  # Modification time of the shape file when it's been loaded
+        self.format = shape.get('format', 1)
+        if self.format == 1:  # Recarray of tuples indexed by lon, lat, level
+            self.variables = tuple(array.dtype.names)
+        else:  # One quantized array per variable, each indexed by lon, lat, level
+            self.variables = tuple(shape['variables'])
+            self.scales = np.array([shape['scales'][name] for name in self.variables])
+            self.offsets = np.array([shape['offsets'][name] for name in self.variables])
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def column(self, lon_idx, lat_idx):
+        """
+        :return: a dict variable name => array of its physical values on every level of the column
+        """
+        return self.columns(lon_idx, lat_idx)
+
+    def columns(self, lon_indexes, lat_indexes):
+        """
+        Vectorized version of `column`.
+        :param lon_indexes: integer array of longitude indexes
+        :param lat_indexes: integer array of latitude indexes, same shape as `lon_indexes`
+        :return: a dict variable name => array of physical values, indexed by column then level
+        """
+        # Copied out of the memory-mapped array at once, so that values are plain, independent arrays
+        if self.format == 1:
+            records = np.array(self.array[lon_indexes, lat_indexes])
+            return {name: records[name].astype(np.float64) for name in self.variables}
+        else:
+            values = np.array(self.array[:, lon_indexes, lat_indexes, :], dtype=np.float64)
+            broadcast = (-1,) + (1,) * (values.ndim - 1)
+            values *= self.scales.reshape(broadcast)
+            values += self.offsets.reshape(broadcast)
+            return dict(zip(self.variables, values))
+
+
+class ForecastCache(object):
+    """
+    LRU cache of memory-mapped `Forecast`s, bounded by the total size in bytes of their arrays.
+    Thread-safe, but not shared between processes: the sharing happens at the OS page-cache level.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()  # (model_name, valid_date) => Forecast, least recently used first
+        self.lock = Lock()
+
+    def get(self, model, valid_date):
+        """
+        Return the forecast of `model` for `valid_date`, loading it if it isn't cached yet
+        or if its files have been rewritten since they've been loaded.
+        :param model: a `GribModel`
+        :param valid_date: a valid date, already rounded to the model's time pitch
+        :return: a `Forecast`
+        """
+        model_name = f"{model.name}_{model.grid_pitch}"
+        key = (model_name, valid_date)
+        basename = valid_date.strftime("%Y%m%d%H%M")
+        shape_file_path = GRIB_PATH / model_name / (basename + ".json")
+        np_file_path = GRIB_PATH / model_name / (basename + ".np")
+        try:
+            mtime_ns = os.stat(shape_file_path).st_mtime_ns
+        except IOError:
+            self.invalidate(model_name, valid_date)
+            raise ValueError("No preprocessed data for this date")
+
+        with self.lock:
+            forecast = self.entries.get(key)
+            if forecast is not None and forecast.mtime_ns == mtime_ns:
+                self.entries.move_to_end(key)
+                return forecast
+
+        # `forecast_preprocess` replaces the array, then the shape file: load them in the same order,
+        # and retry while the shape file is replaced meanwhile (the array may then be older than it),
+        # or while the array is newer than the shape file (it may then not match it yet).
+        for attempt in range(LOAD_ATTEMPTS):
+            try:
+                array = np.load(np_file_path, mmap_mode='r')
+                with shape_file_path.open('r') as f:
+                    shape = json.load(f)
+                shape_mtime_ns = os.stat(shape_file_path).st_mtime_ns
+                array_mtime_ns = os.stat(np_file_path).st_mtime_ns
+            except IOError:
+                raise ValueError("No preprocessed data for this date")
+            if shape_mtime_ns == mtime_ns:
+                # Files copied out of order stay newer than their shape: don't wait for them forever
+                if array_mtime_ns <= mtime_ns or attempt == LOAD_ATTEMPTS - 1:
+                    break
+            mtime_ns = shape_mtime_ns
+            time.sleep(LOAD_RETRY_DELAY)
+        else:
+            raise ValueError("Preprocessed data for this date is being rewritten")
+        forecast = Forecast(array, shape, mtime_ns)
+        count("forecasts_loaded")
+
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = forecast
+            self.nbytes += forecast.nbytes
+            # Evict least recently used entries, but always keep the one just loaded
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+        return forecast
+
+    def invalidate(self, model_name, valid_date=None):
+        """
+        Forget the cached forecast of `model_name` (such as `"ARPEGE_0.1"`) for `valid_date`,
+        or every cached forecast of that model if `valid_date` is None.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == model_name and valid_date in (None, key[1]):
+                    self._remove(key)
+
+    def _remove(self, key):
+        """Remove an entry if present; must be called with `self.lock` held."""
+        forecast = self.entries.pop(key, None)
+        if forecast is not None:
+            self.nbytes -= forecast.nbytes
+
+
+class ColumnCache(object):
+    """
+    LRU cache of atmospheric columns, bounded by their number. Thread-safe.
+    Columns must be treated as read-only, since they're shared between callers.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (model_name, valid_date, lon_idx, lat_idx, extrapolated_pressures) => Column
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, analysis_date):
+        """
+        :param key: `(model_name, valid_date, lon_idx, lat_idx, extrapolated_pressures)` tuple
+        :param analysis_date: analysis date of the forecast currently on disk
+        :return: the cached column, or None if it isn't cached or has been built from another analysis
+        """
+        with self.lock:
+            column = self.entries.get(key)
+            if column is not None and column.analysis_date == analysis_date:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return column
+            self.misses += 1
+            return None
+
+    def put(self, key, column):
+        with self.lock:
+            self.entries[key] = column
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, model_name, valid_date=None):
+        """
+        Forget cached columns of `model_name` (such as `"ARPEGE_0.1"`) for `valid_date`,
+        or for every valid date if `valid_date` is None.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == model_name and valid_date in (None, key[1]):
+                    del self.entries[key]
+
+    def stats(self):
+        """
+        :return: a dict with the number of cached columns, hits and misses since the process started
+        """
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+forecast_cache = ForecastCache(FORECAST_CACHE_BYTES)
+column_cache = ColumnCache(COLUMN_CACHE_SIZE)
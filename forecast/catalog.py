@@ -0,0 +1,132 @@
+"""
+Catalog of the preprocessed valid dates of each model, in an SQLite file shared by every process.
+
+It maps each `(model_name, valid_date)` to the analysis date of its preprocessed files, so that
+listing available forecasts is an indexed query, instead of a scan of the model's directory
+parsing every shape file. `forecast.preprocess` updates it whenever it writes a valid date.
+
+A model which has never been cataloged, typically because its files have been preprocessed
+before the catalog existed, is cataloged from its shape files upon its first listing.
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from balloon.settings import GRIB_PATH, FORECAST_CATALOG_PATH
+
+
+class ForecastCatalog(object):
+
+    def __init__(self, path, grib_path):
+        """
+        :param path: SQLite database file, created if missing
+        :param grib_path: root directory of preprocessed files, with one sub-directory per model
+        """
+        self.path = path
+        self.grib_path = grib_path
+        self.initialized = False
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(str(self.path), timeout=10)
+        try:
+            with connection:  # Commits upon success, rolls back upon exception
+                self._initialize(connection)
+                yield connection
+        finally:
+            connection.close()
+
+    def _initialize(self, connection):
+        if not self.initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    model TEXT NOT NULL,
+                    valid_date TEXT NOT NULL,
+                    analysis_date TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (model, valid_date))""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS models (
+                    model TEXT PRIMARY KEY,
+                    cataloged REAL NOT NULL)""")
+            self.initialized = True
+
+    def put(self, model_name, valid_date, analysis_date):
+        """
+        Record that `valid_date` has been preprocessed from the analysis of `analysis_date`.
+        :param model_name: name of the model's directory, such as `"ARPEGE_0.1"`
+        :param valid_date: valid date, as a `datetime`
+        :param analysis_date: analysis date, as a `datetime` or an ISO string
+        """
+        if isinstance(analysis_date, datetime):
+            analysis_date = analysis_date.isoformat()
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?)",
+                               (model_name, valid_date.isoformat(), analysis_date, time.time()))
+
+    def list(self, model_name, date_from=None, date_to=None, n=None):
+        """
+        :param model_name: name of the model's directory, such as `"ARPEGE_0.1"`
+        :param date_from: optional first valid date
+        :param date_to: optional last valid date
+        :param n: optional maximum number of valid dates; the most recent ones are kept
+        :return: `valid_date -> analysis_date` dict, sorted by valid date
+        """
+        query = "SELECT valid_date, analysis_date FROM forecasts WHERE model=?"
+        params = [model_name]
+        if date_from is not None:
+            query += " AND valid_date>=?"
+            params.append(date_from.isoformat())
+        if date_to is not None:
+            query += " AND valid_date<=?"
+            params.append(date_to.isoformat())
+        query += " ORDER BY valid_date DESC"
+        if n is not None:
+            query += " LIMIT ?"
+            params.append(n)
+        with self._connect() as connection:
+            if connection.execute("SELECT 1 FROM models WHERE model=?", (model_name,)).fetchone() is None:
+                self._catalog_files(connection, model_name)
+            rows = connection.execute(query, params).fetchall()
+        return {datetime.fromisoformat(valid_date): datetime.fromisoformat(analysis_date)
+                for (valid_date, analysis_date) in reversed(rows)}
+
+    def rebuild(self, model_name):
+        """
+        Replace the catalog of `model_name` with the valid dates of its shape files.
+        """
+        with self._connect() as connection:
+            self._catalog_files(connection, model_name)
+
+    def forget(self, model_name):
+        """
+        Remove `model_name` from the catalog, e.g. once its directory has been deleted.
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM forecasts WHERE model=?", (model_name,))
+            connection.execute("DELETE FROM models WHERE model=?", (model_name,))
+
+    def _catalog_files(self, connection, model_name):
+        """Catalog the shape files of `model_name`, within the transaction of `connection`."""
+        now = time.time()
+        rows = []
+        for shape_file in (self.grib_path / model_name).glob("*.json"):
+            try:
+                valid_date = datetime.strptime(shape_file.stem, '%Y%m%d%H%M')
+            except ValueError:
+                continue  # Not a forecast file
+            try:
+                with shape_file.open() as f:
+                    analysis_date = json.load(f)['analysis_date']
+            except Exception:
+                continue
+            rows.append((model_name, valid_date.isoformat(), analysis_date, now))
+        connection.execute("DELETE FROM forecasts WHERE model=?", (model_name,))
+        connection.executemany("INSERT INTO forecasts VALUES (?, ?, ?, ?)", rows)
+        connection.execute("INSERT OR REPLACE INTO models VALUES (?, ?)", (model_name, now))
+
+
+forecast_catalog = ForecastCatalog(FORECAST_CATALOG_PATH, GRIB_PATH)
@@ -1,15 +1,9 @@
-import numpy as np
-import json
-from datetime import datetime
-from dateutil.parser import parse
-
-from balloon.settings import GRIB_PATH
-from core.models import Column, Cell
+from core.metrics import count, timer
+from core.models import Column
+from forecast.cache import forecast_cache, column_cache
+from forecast.catalog import forecast_catalog
 from forecast.models import GribModel, grib_models
-from forecast.preprocess import SHORT_NAMES
-
-
-EPSILON = 1e-5  # EPSILON° < 1m
+from forecast.terrain import get_terrain
 
 
 class ColumnExtractor(object):
@@ -20,30 +14,31 @@ class ColumnExtractor(object):
         else:
             model_name = model
             self.model = grib_models[model_name]
-        self.model = model
         self.extrapolated_pressures = extrapolated_pressures
+        self.model_name = f"{self.model.name}_{self.model.grid_pitch}"
+        self.extrapolated_pressures_key = tuple(extrapolated_pressures)
 
         # Those will be filled by `update_array_and_shape` lazily.
         self.date = None
+        self.forecast = None
         self.array = None
         self.shape = None
+        self.grid = None
 
     def _update_array_and_shape(self, date):
         """
         Ensures that self.array and self.shape contain the atmosphere's description for that date.
-        Won't reload if the previous extraction request was for the same date.
+        Won't reload if the previous extraction request was for the same date; arrays are
+        otherwise shared with other extractors through the process-wide `forecast_cache`.
         """
         date = self.model.round_time(date)
         if self.array is None or self.date != date:  # TODO perform rounding here?
-            basename = date.strftime("%Y%m%d%H%M")
-            model_name = f"{self.model.name}_{self.model.grid_pitch}"
-            try:
-                with (GRIB_PATH / model_name / (basename + ".json")).open('r') as f:
-                    self.shape = json.load(f)
-                with (GRIB_PATH / model_name / (basename + ".np")).open('rb') as f:
-                    self.array = np.load(f)
-            except IOError:
-                raise ValueError("No preprocessed data for this date")
+            with timer("forecast"):
+                forecast = forecast_cache.get(self.model, date)
+            self.forecast = forecast
+            self.array = forecast.array
+            self.shape = forecast.shape
+            self.grid = forecast.grid
             self.date = date
 
     def extract_ground_altitude(self, position):
@@ -52,24 +47,7 @@ class ColumnExtractor(object):
         :param position: (lon, lat)
         :return: altitude above MSL in meters
         """
-        model_name = f"{self.model.name}_{self.model.grid_pitch}"
-        (lon, lat) = self.model.round_position(position)
-        try:
-            with (GRIB_PATH / model_name / "terrain.json").open('r') as f:
-                shape = json.load(f)
-            with (GRIB_PATH / model_name / "terrain.np").open('rb') as f:
-                array = np.load(f)
-        except IOError:
-            raise ValueError("No preprocessed terrain for this date")
-
-        try:
-            # TODO Round both coords to grid instead of testing up to epsilon?
-            lon_idx = next(idx for (idx, lon2) in enumerate(shape['lons']) if abs(lon-lon2)<EPSILON)
-            lat_idx = next(idx for (idx, lat2) in enumerate(shape['lats']) if abs(lat-lat2)<EPSILON)
-        except StopIteration:
-            raise ValueError("No preprocessed data for this position")
-
-        return int(array[lon_idx][lat_idx])
+        return get_terrain(self.model).altitude(position)
 
     def extract(self, date, position):
         """
@@ -82,28 +60,33 @@ class ColumnExtractor(object):
         self._update_array_and_shape(date)
 
         try:
-            lon_idx = next(idx for (idx, lon2) in enumerate(self.shape['lons']) if abs(lon-lon2) < EPSILON)
-            lat_idx = next(idx for (idx, lat2) in enumerate(self.shape['lats']) if abs(lat-lat2) < EPSILON)
-        except StopIteration:
+            (lon_idx, lat_idx) = self.grid.index((lon, lat))
+        except ValueError:
             raise ValueError("No preprocessed weather data for this position")
 
-        np_column = self.array[lon_idx][lat_idx][:]
-        column = []
-        for p, cell in zip(self.shape['alts'], np_column):
-            kwargs = {'p': p}
-            for name, val in zip(SHORT_NAMES, cell):
-                kwargs[name] = float(val)
-            cell = Cell(**kwargs)
-            column.append(cell)
-
-        column = Column(
-            grib_model=self.model,
-            position=position,
-            valid_date=self.model.round_time(date),
-            analysis_date=parse(self.shape['analysis_date']),
-            ground_altitude=self.extract_ground_altitude(position),
-            cells=column,
-            extrapolated_pressures=self.extrapolated_pressures)
+        # Columns are shared through the process-wide cache, as long as the forecast isn't updated
+        cache_key = (self.model_name, self.date, lon_idx, lat_idx, self.extrapolated_pressures_key)
+        column = column_cache.get(cache_key, self.forecast.analysis_date)
+        if column is not None:
+            count("column_cache_hits")
+            return column
+
+        with timer("ground"):
+            ground_altitude = self.extract_ground_altitude(position)
+        with timer("column"):
+            values = self.forecast.column(lon_idx, lat_idx)
+            column = Column(
+                grib_model=self.model,
+                position=position,
+                valid_date=self.date,
+                analysis_date=self.forecast.analysis_date,
+                ground_altitude=ground_altitude,
+                p=self.shape['alts'],
+                z=values['z'], u=values['u'], v=values['v'], t=values['t'], r=values['r'],
+                rho=values.get('rho'), z_boundaries=values.get('zb'),
+                extrapolated_pressures=self.extrapolated_pressures)
+        count("columns_built")
+        column_cache.put(cache_key, column)
 
         return column
 
@@ -111,28 +94,9 @@ class ColumnExtractor(object):
         """
         Returns a dict `valid_date -> analysis_date` of weather files available for
         this model, optionally filtered by date (only those more recent in `valid_date`
-        than `date_from`).
+        than `date_from`), as recorded in the forecast catalog.
         :param date_from: optional starting datetime. `valid_date`s older than that are discarded.
+        :param n: optional number of most recent valid dates to return, regardless of `date_from`.
         :return: `valid_date -> analysis_date` dict.
         """
-        model_name = f"{self.model.name}_{self.model.grid_pitch}"
-        results = {}
-        for shape_file in (GRIB_PATH / model_name).glob("*.json"):
-            try:
-                valid_date = datetime.strptime(shape_file.stem, '%Y%m%d%H%M')
-            except ValueError:
-                continue  # Not a forecast file
-            if n is None and date_from is not None and valid_date < date_from:
-                continue
-            try:
-                with shape_file.open() as f:
-                    analysis_date = parse(json.load(f)['analysis_date'])
-            except Exception:
-                continue
-            results[valid_date] = analysis_date
-
-        if n is not None:
-            # Only keep `n` most recent valid dates
-            results = {k: v for k, v in sorted(results.items(), reverse=True)[:n]}
-
-        return results
+        return forecast_catalog.list(self.model_name, date_from=None if n is not None else date_from, n=n)
@@ -0,0 +1,114 @@
+"""
+Conversion of longitudes / latitudes into indexes of preprocessed arrays.
+
+Preprocessed arrays are indexed by longitude then latitude, and the shape files
+describing them list every longitude and latitude of the grid. Rather than
+scanning those lists, a `GridIndex` built once per shape file computes indexes
+arithmetically from each axis' origin, pitch and count, and falls back to a
+binary search if an axis turns out not to be regularly spaced.
+"""
+from bisect import bisect_left
+
+import numpy as np
+
+
+EPSILON = 1e-5  # EPSILON° < 1m
+
+
+class Axis(object):
+    """
+    Sequence of coordinates along one dimension of a grid, sorted in either direction.
+    """
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.count = len(self.values)
+        self.origin = self.values[0] if self.count else 0.
+        self.min = self.values.min() if self.count else 0.
+        self.max = self.values.max() if self.count else 0.
+        self.pitch = (self.values[-1] - self.origin) / (self.count - 1) if self.count > 1 else 0.
+        steps = np.diff(self.values)
+        self.is_regular = self.pitch != 0. and bool(np.all(np.abs(steps - self.pitch) < EPSILON))
+        if not self.is_regular:
+            # Bisect needs increasing coordinates: decreasing axes are searched with negated coordinates.
+            self.sign = -1. if self.count > 1 and self.values[-1] < self.values[0] else 1.
+            self.sorted_values = list(self.sign * self.values)
+
+    def index(self, x):
+        """
+        :param x: coordinate, expected to be on the grid up to `EPSILON`
+        :return: the index of `x` on this axis
+        :raise ValueError: if `x` isn't on the grid
+        """
+        if self.is_regular:
+            idx = int(round((x - self.origin) / self.pitch))
+        else:
+            idx = bisect_left(self.sorted_values, self.sign * x - EPSILON)
+        if 0 <= idx < self.count and abs(self.values[idx] - x) < EPSILON:
+            return idx
+        raise ValueError(f"{x} is not on the grid")
+
+    def indexes(self, xs):
+        """
+        Vectorized version of `index`.
+        :param xs: array of coordinates
+        :return: array of indexes
+        :raise ValueError: if any of the coordinates isn't on the grid
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        if self.is_regular:
+            idx = np.rint((xs - self.origin) / self.pitch).astype(np.intp)
+        else:
+            idx = np.searchsorted(self.sorted_values, self.sign * xs - EPSILON)
+        valid = (0 <= idx) & (idx < self.count)
+        idx = np.where(valid, idx, 0)
+        if self.count == 0 or not np.all(valid & (np.abs(self.values[idx] - xs) < EPSILON)):
+            raise ValueError("Some coordinates are not on the grid")
+        return idx
+
+    def locate(self, xs):
+        """
+        Vectorized location of coordinates between grid points, for interpolations.
+        :param xs: array of coordinates
+        :return: `(indexes, fractions)` arrays: each coordinate lies between grid points
+            `indexes` and `indexes+1`, at `fractions` (within 0...1) of the way.
+        :raise ValueError: if any of the coordinates is outside the grid
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        if self.count < 2 or xs.min() < self.min - EPSILON or xs.max() > self.max + EPSILON:
+            raise ValueError("Some coordinates are outside the grid")
+        if self.is_regular:
+            positions = np.minimum(np.maximum((xs - self.origin) / self.pitch, 0), self.count - 1)
+        else:
+            positions = np.interp(self.sign * xs, self.sorted_values, np.arange(self.count))
+        indexes = np.minimum(np.floor(positions).astype(np.intp), self.count - 2)
+        return indexes, positions - indexes
+
+
+class GridIndex(object):
+    """
+    Longitude and latitude axes of a preprocessed array, as described by its shape file.
+    The same index serves every array sharing those axes, weather forecasts as well as terrain.
+    """
+    def __init__(self, lons, lats):
+        self.lons = Axis(lons)
+        self.lats = Axis(lats)
+
+    @classmethod
+    def from_shape(cls, shape):
+        return cls(shape['lons'], shape['lats'])
+
+    def index(self, position):
+        """
+        :param position: `(lon, lat)`, rounded to the grid pitch
+        :return: `(lon_idx, lat_idx)`
+        :raise ValueError: if the position isn't on the grid
+        """
+        (lon, lat) = position
+        return self.lons.index(lon), self.lats.index(lat)
+
+    def indexes(self, lons, lats):
+        """
+        Vectorized version of `index`.
+        :return: `(lon_indexes, lat_indexes)` arrays
+        """
+        return self.lons.indexes(lons), self.lats.indexes(lats)
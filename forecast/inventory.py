@@ -0,0 +1,88 @@
+"""
+In-memory inventory of the raw GRIB files of a model.
+
+Rather than stat-ing the `.grib2` and `.grib2.part` files of every `FileRef` considered, the model's
+directory is scanned at once, and only scanned again once its modification time changes, i.e.
+when files are created, renamed or removed. In between, refreshing the inventory only stats
+the partial files, whose modification times tell stalled downloads from pending ones.
+"""
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+
+STALLED_DELAY = timedelta(minutes=15)  # Partial downloads not written for that long are considered dead
+
+
+class GribInventory(object):
+
+    def __init__(self, path):
+        """
+        :param path: directory of a model's GRIB files
+        """
+        self.path = path
+        self.directory_mtime_ns = None
+        self.downloaded = {}  # file name => size in bytes
+        self.partial = {}  # file name of the complete file => modification time of its `.part` file
+        self.lock = Lock()
+
+    def refresh(self):
+        """
+        Update the inventory with the current content of the directory.
+        """
+        try:
+            directory_mtime_ns = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            directory_mtime_ns = None
+        with self.lock:
+            if directory_mtime_ns is not None and directory_mtime_ns == self.directory_mtime_ns:
+                for name in list(self.partial):
+                    try:
+                        self.partial[name] = datetime.utcfromtimestamp(os.stat(self.path / (name + ".part")).st_mtime)
+                    except FileNotFoundError:
+                        del self.partial[name]
+                return
+            (downloaded, partial) = ({}, {})
+            if directory_mtime_ns is not None:
+                with os.scandir(self.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".grib2"):
+                            downloaded[entry.name] = entry.stat().st_size
+                        elif entry.name.endswith(".grib2.part"):
+                            partial[entry.name[:-len(".part")]] = datetime.utcfromtimestamp(entry.stat().st_mtime)
+            (self.downloaded, self.partial, self.directory_mtime_ns) = (downloaded, partial, directory_mtime_ns)
+
+    def add(self, path):
+        """
+        Record a file which has just been downloaded into this directory, without scanning it again.
+        """
+        with self.lock:
+            self.downloaded[path.name] = path.stat().st_size
+            self.partial.pop(path.name, None)
+
+    def status(self, fileref, now=None):
+        """
+        :return: status of `fileref`, as defined by `FileRef.status()`, as of the last refresh
+        """
+        now = now or datetime.utcnow()
+        if fileref.analysis_date > now:
+            return "future"
+        name = fileref.file_name
+        if name in self.downloaded:
+            return "downloaded"
+        partial_mtime = self.partial.get(name)
+        if partial_mtime is None:
+            return "missing"
+        return "stalled" if now - partial_mtime > STALLED_DELAY else "pending"
+
+    def estimate_size(self, fileref):
+        """
+        :return: the size in bytes of `fileref`'s file if it's downloaded, otherwise the average size
+            of downloaded files with the same validity offsets, or None if there's none
+        """
+        size = self.downloaded.get(fileref.file_name)
+        if size is None:
+            # File names are made of the analysis date, then the validity offsets
+            offsets_suffix = fileref.file_name.split("_", 1)[1]
+            similar_sizes = [s for (name, s) in self.downloaded.items() if name.split("_", 1)[-1] == offsets_suffix]
+            size = sum(similar_sizes) // len(similar_sizes) if similar_sizes else None
+        return size
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from balloon.settings import ACTIVE_MODELS
+from forecast.catalog import forecast_catalog
+from forecast.models import grib_models
+
+
+class Command(BaseCommand):
+    help = "List the preprocessed valid dates of models, as recorded in the forecast catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-m", "--model", default=None, type=str, help="Name of the weather model. All active models if unspecified")
+        parser.add_argument("-r", "--rebuild", action='store_true', default=False,
+                            help="Rebuild the catalog from preprocessed files, e.g. after some of them have been deleted")
+
+    def handle(self, *args, **options):
+        m = options.get('model')
+        model_names = ACTIVE_MODELS if m is None else [m]
+        for model_name in model_names:
+            if model_name not in grib_models:
+                raise CommandError(f"Unknown GRIB model name {model_name}, valid names are " +
+                                   ", ".join(grib_models.keys()))
+            if options['rebuild']:
+                forecast_catalog.rebuild(model_name)
+            dates = forecast_catalog.list(model_name)
+            print(f"{model_name}: {len(dates)} valid dates")
+            for valid_date, analysis_date in dates.items():
+                print(f"\t{valid_date.isoformat()} from analysis {analysis_date.isoformat()}")
@@ -5,7 +5,8 @@ from dateutil.parser import parse as parse_date
 from django.core.management.base import BaseCommand, CommandError
 
 from forecast.models import grib_models
-from balloon.settings import ACTIVE_MODELS
+from forecast.planner import plan_downloads
+from balloon.settings import ACTIVE_MODELS, DOWNLOAD_THREADS
 
 class Command(BaseCommand):
     help = "Download best previsions covering the specified date range for a model"
@@ -14,6 +15,9 @@ class Command(BaseCommand):
         parser.add_argument("-m", "--model", default=None, type=str, help="Name of the weather model. All active models if unspecified")
         parser.add_argument("date_from", default="", type=str, nargs='?', help="First forecast date to download, default=now")
         parser.add_argument("date_to", default="", type=str, nargs='?', help="Last forecast date to download, default=max forecast")
+        parser.add_argument("-t", "--threads", default=DOWNLOAD_THREADS, type=int, help="Maximum number of simultaneous downloads")
+        parser.add_argument("-p", "--plan", action='store_true', default=False,
+                            help="Only print the files which would be downloaded, and their estimated volume")
 
     def handle(self, *args, **options):
         try:
@@ -39,7 +43,14 @@ class Command(BaseCommand):
             raise CommandError("Cannot decode date")
         # TODO handle timezone-aware dates
 
+        if options['plan']:
+            for m in models:
+                m.inventory.refresh()
+                print(f"Download plan for {m.name} {m.grid_pitch} from {valid_date_from.isoformat()} to {valid_date_to.isoformat()}:")
+                print("\n".join(plan_downloads(m, valid_date_from, valid_date_to).describe()))
+            return
+
         print(f"Downloading models {', '.join(f'{m.name} {m.grid_pitch}' for m in models)} from {valid_date_from.isoformat()} to {valid_date_to.isoformat()}")
         
         for m in models:
-            m.download_forecasts(valid_date_from, valid_date_to)
+            m.download_forecasts(valid_date_from, valid_date_to, threads=options['threads'])
@@ -1,13 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 from django.core.management.base import BaseCommand, CommandError
 
 from balloon.settings import GRIB_PATH, PREPROCESS_BOX
+from core.cache import trajectory_cache
+from forecast.manifest import MANIFEST_NAME, PreprocessManifest
 from forecast.preprocess import preprocess
 
 
 class Command(BaseCommand):
-    help = "Download best previsions covering the specified date range for a model"
+    help = "Preprocess GRIB files which have not been preprocessed yet, or have changed since"
 
     def add_arguments(self, parser):
         parser.add_argument("grib_file", type=str, nargs='*', default=[GRIB_PATH], help="File to preprocess")
@@ -17,6 +20,12 @@ class Command(BaseCommand):
         parser.add_argument("--lon2", type=float, nargs='?', default=PREPROCESS_BOX['lon2'], help="Lowest longitude kept")
         parser.add_argument("-f", "--force", action='store_true', default=False,
                             help="Force re-processing on already processed dates")
+        parser.add_argument("-d", "--derived", action='store_true', default=False,
+                            help="Also store air density and level boundaries, rather than computing them on every request")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of files preprocessed in parallel, by as many processes")
+        parser.add_argument("-n", "--dry-run", action='store_true', default=False,
+                            help="Only list the files which would be preprocessed, and why")
 
     def list_files(self, paths):
         files = []
@@ -29,31 +38,54 @@ class Command(BaseCommand):
                 raise CommandError(f"Invalid input file/directory {p}")
         return files
 
-    def get_processed_files(self, path):
-        try:
-            with (path / "processed.json").open('rb') as f:
-                return set(json.load(f))
-        except Exception:
-            return []
-
-    def set_processed_files(self, path, files):
-        # Convert to list of strings, remove references to missing files
-        filtered_filenames = [f.absolute().__fspath__() for f in files if f.is_file()]
-        try:
-            with (path / "processed.json").open('wb') as f:
-                return json.dump(filtered_filenames, f)
-        except Exception:
-            pass
+    def record_outcome(self, manifest, grib_file_path, options, get_report):
+        """
+        Record the outcome of a preprocessing in `manifest`, and delete the cached trajectories
+        which went through the valid dates it's written.
+        :return: True upon success
+        """
+        report = manifest.record_outcome(grib_file_path, options, get_report)
+        if report is None:
+            return False
+        for (valid_date, status) in report['dates'].items():
+            if status != "skipped":
+                trajectory_cache.invalidate(grib_file_path.parent.name, valid_date)
+        return True
 
     def handle(self, *args, **options):
-        roots = map(Path, options['grib_file'])
-        for r in roots:
-            processed_files = self.get_processed_files(r)
-            files = [f for f in self.list_files([r]) if f not in processed_files]
-            print("Files to preprocess: \n\t"+"\n\t".join(str(f) for f in files))
-            for f in files:
-                preprocess(grib_file_path=f,
-                           lat1=options['lat1'], lat2=options['lat2'],
-                           lon1=options['lon1'], lon2=options['lon2'],
-                           force=options['force'])
-            self.set_processed_files(r, processed_files | files)
+        kwargs = dict(lat1=options['lat1'], lat2=options['lat2'],
+                      lon1=options['lon1'], lon2=options['lon2'],
+                      force=options['force'], derived=options['derived'])
+        # Options which change the preprocessed output, and therefore require files to be preprocessed again
+        manifest_options = dict(kwargs)
+        del manifest_options['force']
+        failures = 0
+        # Shared with `forecast_update`, whatever the files or directories preprocessed
+        manifest = PreprocessManifest.load(GRIB_PATH / MANIFEST_NAME)
+        manifest.prune()
+        for r in map(Path, options['grib_file']):
+            files = []
+            for f in self.list_files([r]):
+                status = "forced" if options['force'] else manifest.status(f, manifest_options)
+                if status != "unchanged":
+                    files.append(f)
+                    print(f"\t{status}: {f}")
+            print(f"{len(files)} file(s) to preprocess in {r}")
+            if options['dry_run']:
+                continue
+
+            if options['jobs'] > 1:
+                # Files are independent; concurrent updates of a same valid date are arbitrated
+                # by `preprocess` itself, which keeps the most recent analysis.
+                with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+                    futures = {executor.submit(preprocess, grib_file_path=f, **kwargs): f for f in files}
+                    for future in as_completed(futures):
+                        f = futures[future]
+                        failures += not self.record_outcome(manifest, f, manifest_options, future.result)
+            else:
+                for f in files:
+                    get_report = lambda: preprocess(grib_file_path=f, **kwargs)
+                    failures += not self.record_outcome(manifest, f, manifest_options, get_report)
+            manifest.save()
+        if failures:
+            raise CommandError(f"{failures} file(s) failed to preprocess")
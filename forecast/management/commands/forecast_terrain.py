@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand, CommandError
 
 from balloon.settings import GRIB_PATH, PREPROCESS_BOX, ACTIVE_MODELS
 from forecast.models import grib_models
+from forecast.preprocess import replace_file
 
 
 class Command(BaseCommand):
@@ -65,16 +66,10 @@ class Command(BaseCommand):
         h, lats, lons = msg.data(**box)
         lats = [x[0] for x in lats]
         lons = list(lons[0])
-        shape = [len(lons), len(lats)]
-        array = np.zeros(shape=shape, dtype=np.int16)
-        for lon_idx in range(len(lons)):
-            for lat_idx in range(len(lats)):
-                datum = h[lat_idx][lon_idx]
-                array[lon_idx][lat_idx] = datum
-        with np_file.open('wb') as f:
-            np.save(f, array)
-        with shape_file.open('w') as f:
-            json.dump({'lats': lats, 'lons': lons}, f)
+        array = np.asarray(h).T.astype(np.int16)  # GRIB fields are indexed by lat, lon
+        # Shape file written last: its modification makes running servers reload the terrain.
+        replace_file(np_file, 'wb', lambda f: np.save(f, array))
+        replace_file(shape_file, 'w', lambda f: json.dump({'lats': lats, 'lons': lons}, f))
         print(f"+ Saved in {np_file} and {shape_file}")
 
     def handle(self, *args, **options):
@@ -0,0 +1,100 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+
+from dateutil.parser import parse as parse_date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from balloon.settings import ACTIVE_MODELS, DOWNLOAD_THREADS, GRIB_PATH, PREPROCESS_BOX
+from core.cache import trajectory_cache
+from forecast.manifest import MANIFEST_NAME, PreprocessManifest
+from forecast.models import grib_models
+from forecast.planner import plan_downloads
+from forecast.preprocess import preprocess
+
+
+class Command(BaseCommand):
+    help = "Download best previsions covering the specified date range, and preprocess each file as soon as it's downloaded"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-m", "--model", default=None, type=str, help="Name of the weather model. All active models if unspecified")
+        parser.add_argument("date_from", default="", type=str, nargs='?', help="First forecast date to download, default=now")
+        parser.add_argument("date_to", default="", type=str, nargs='?', help="Last forecast date to download, default=max forecast")
+        parser.add_argument("-t", "--threads", default=DOWNLOAD_THREADS, type=int, help="Maximum number of simultaneous downloads")
+        parser.add_argument("-p", "--plan", action='store_true', default=False,
+                            help="Only print the files which would be downloaded, and their estimated volume")
+        parser.add_argument("-j", "--jobs", type=int, default=2,
+                            help="Number of files preprocessed in parallel, by as many processes")
+        parser.add_argument("-d", "--derived", action='store_true', default=False,
+                            help="Also store air density and level boundaries, rather than computing them on every request")
+
+    def handle(self, *args, **options):
+        try:
+            m = options.get('model')
+            models = [grib_models[m] for m in ACTIVE_MODELS] if m is None else [grib_models[m]]
+        except KeyError:
+            raise CommandError(f"Unknown GRIB model name {options['model']}, valid names are " +
+                               ", ".join(grib_models.keys()))
+        try:
+            if options['date_from'] != "":
+                valid_date_from = parse_date(options['date_from']).replace(tzinfo=None)
+            else:
+                valid_date_from = datetime.utcnow()
+            if options['date_to'] != "":
+                valid_date_to = parse_date(options['date_to']).replace(tzinfo=None)
+            else:
+                valid_date_to = datetime.utcnow() + max(max(max(m.validity_offsets)) for m in models)
+        except ValueError:
+            raise CommandError("Cannot decode date")
+
+        if options['plan']:
+            for m in models:
+                m.inventory.refresh()
+                print(f"Download plan for {m.name} {m.grid_pitch} from {valid_date_from.isoformat()} to {valid_date_to.isoformat()}:")
+                print("\n".join(plan_downloads(m, valid_date_from, valid_date_to).describe()))
+            return
+
+        kwargs = dict(PREPROCESS_BOX, derived=options['derived'])
+        # Same manifest as `forecast_preprocess`, which then skips those files
+        manifest = PreprocessManifest.load(GRIB_PATH / MANIFEST_NAME)
+        manifest.prune()
+        futures = {}  # future => path of the GRIB file being preprocessed
+        failures = 0
+
+        def collect(timeout):
+            """Record the outcome of preprocessings completed within `timeout` seconds (None to wait for all)."""
+            nonlocal failures
+            (done, _) = wait(futures, timeout=timeout)
+            for future in done:
+                path = futures.pop(future)
+                report = manifest.record_outcome(path, kwargs, future.result)
+                if report is None:
+                    failures += 1
+                    continue
+                # Trajectories which went through the updated valid dates are obsolete
+                for (valid_date, status) in report['dates'].items():
+                    if status != "skipped":
+                        trajectory_cache.invalidate(path.parent.name, valid_date)
+
+        print(f"Updating models {', '.join(f'{m.name} {m.grid_pitch}' for m in models)} " +
+              f"from {valid_date_from.isoformat()} to {valid_date_to.isoformat()}")
+        with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+
+            def on_downloaded(fileref):
+                # Called between downloads: preprocessings run concurrently in other processes.
+                path = Path(fileref.__fspath__())
+                status = manifest.status(path, kwargs)
+                if status != "unchanged":
+                    print(f"\t> Preprocessing {status} file {path}")
+                    futures[executor.submit(preprocess, grib_file_path=path, **kwargs)] = path
+                collect(timeout=0)
+
+            for m in models:
+                m.download_forecasts(valid_date_from, valid_date_to, threads=options['threads'],
+                                     on_downloaded=on_downloaded)
+            while futures:
+                collect(timeout=None)
+        manifest.save()
+        if failures:
+            raise CommandError(f"{failures} file(s) failed to preprocess")
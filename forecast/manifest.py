@@ -0,0 +1,145 @@
+"""
+Record of the GRIB files already preprocessed, so that periodic preprocessing only decodes new ones.
+
+The manifest is a JSON file stored at the root of the preprocessed directory tree. It maps the absolute path
+of each preprocessed GRIB file to:
+
+* its `size`, `mtime_ns` and `sha1` digest when it's been preprocessed;
+* the preprocessing `options` (box and derived variables) it's been preprocessed with. Files
+  preprocessed with derived variables aren't preprocessed again when those aren't requested;
+* its `analysis_date`, and the status of every valid date it contains, as reported by
+  `forecast.preprocess.preprocess_messages()`: "created", "updated" or "skipped".
+
+A file whose size and modification time are unchanged is considered already preprocessed,
+which only costs a `stat()`. Otherwise its content is hashed, so that files which have merely
+been touched or copied over with the same content aren't decoded again.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime
+
+MANIFEST_NAME = "processed.json"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_digest(path):
+    """
+    :return: the hexadecimal SHA-1 digest of the file's content
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PreprocessManifest(object):
+
+    def __init__(self, path, entries=None):
+        """
+        :param path: manifest file path
+        :param entries: dict absolute GRIB file path => entry, as described in the module's documentation
+        """
+        self.path = path
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a manifest; a missing or unreadable one is considered empty, which only causes files
+        to be preprocessed again.
+        """
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+            if not isinstance(entries, dict):  # Legacy manifest: bare list of file names, without any stat
+                entries = {}
+        except (IOError, ValueError):
+            entries = {}
+        return cls(path, entries)
+
+    def save(self):
+        """Atomically rewrite the manifest, so that an interrupted run never leaves it truncated."""
+        tmp_path = self.path.parent / f"{self.path.name}.{os.getpid()}.tmp"
+        with tmp_path.open('w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def status(self, grib_file_path, options):
+        """
+        :param grib_file_path: path of a GRIB file
+        :param options: dict of the preprocessing options which would be used
+        :return: "new" if the file has never been preprocessed, "changed" if its content or the options differ
+            from those it's been preprocessed with, "failed" if its last preprocessing failed,
+            "unchanged" otherwise.
+        """
+        entry = self.entries.get(os.fspath(grib_file_path.absolute()))
+        if entry is None:
+            return "new"
+        if 'error' in entry:
+            return "failed"
+        if not self.options_cover(entry.get('options'), options):
+            return "changed"
+        stat = grib_file_path.stat()
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return "unchanged"
+        if stat.st_size != entry['size'] or file_digest(grib_file_path) != entry['sha1']:
+            return "changed"
+        entry['mtime_ns'] = stat.st_mtime_ns  # Same content: spare the hash next time
+        return "unchanged"
+
+    @staticmethod
+    def options_cover(recorded, options):
+        """
+        :return: True if files preprocessed with the `recorded` options can serve those requested by `options`:
+            same box, and derived variables stored unless they aren't requested.
+        """
+        if recorded is None:
+            return False
+        box = {name: value for (name, value) in recorded.items() if name != 'derived'}
+        requested_box = {name: value for (name, value) in options.items() if name != 'derived'}
+        return box == requested_box and (recorded.get('derived', False) or not options.get('derived', False))
+
+    def record(self, grib_file_path, options, report):
+        """
+        Record the successful preprocessing of a file.
+        :param report: report returned by `forecast.preprocess.preprocess()`
+        """
+        stat = grib_file_path.stat()
+        self.entries[os.fspath(grib_file_path.absolute())] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': file_digest(grib_file_path),
+            'options': options,
+            'analysis_date': report.get('analysis_date'),
+            'dates': {date.isoformat(): status for (date, status) in sorted(report['dates'].items())},
+            'processed': datetime.utcnow().isoformat(timespec='seconds')}
+
+    def record_failure(self, grib_file_path, error):
+        """Record a failed preprocessing; the file will be preprocessed again by the next run."""
+        self.entries[os.fspath(grib_file_path.absolute())] = {
+            'error': str(error),
+            'processed': datetime.utcnow().isoformat(timespec='seconds')}
+
+    def record_outcome(self, grib_file_path, options, get_report):
+        """
+        Record the outcome of a preprocessing, and save the manifest, so that an interrupted run
+        keeps track of what's been done.
+        :param get_report: function returning the preprocessing report, or raising its failure
+        :return: the preprocessing report, or None upon failure
+        """
+        try:
+            report = get_report()
+            self.record(grib_file_path, options, report)
+        except Exception as e:
+            print(f"Failed to preprocess {grib_file_path}: {e}")
+            self.record_failure(grib_file_path, e)
+            report = None
+        self.save()
+        return report
+
+    def prune(self):
+        """Forget files which don't exist anymore, such as GRIB files removed after a couple of days."""
+        for name in [name for name in self.entries if not os.path.isfile(name)]:
+            del self.entries[name]
@@ -1,9 +1,16 @@
-import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from urllib.request import urlopen, HTTPError
+from urllib.error import URLError
+from urllib.request import Request, urlopen, HTTPError
 from pathlib import Path
 
-from balloon.settings import GRIB_PATH
+from balloon.settings import GRIB_PATH, DOWNLOAD_THREADS
+from forecast.inventory import GribInventory
+from forecast.planner import plan_downloads
+
+DOWNLOAD_RETRIES = 5   # Attempts to download a file before giving up
+DOWNLOAD_BACKOFF = 10  # Delay before the first retry in seconds, doubled after each failure
 
 
 class FileRef(object):
@@ -15,14 +22,18 @@ class FileRef(object):
         self.model = model
         self.analysis_date = analysis_date
         self.forecast_offsets = frozenset(forecast_offsets)
+        sorted_offsets = sorted("%02d" % int(delta/timedelta(hours=1)) for delta in self.forecast_offsets)
+        self.file_name = "_".join([analysis_date.strftime('%Y%m%d%H%M')] + sorted_offsets) + ".grib2"
+        self.name = f"{model.name}_{model.grid_pitch}/{self.file_name[:-len('.grib2')]}"
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, FileRef) and self.name == other.name
 
     def __str__(self):
-        sorted_offsets = sorted("%02d" % int(delta/timedelta(hours=1)) for delta in self.forecast_offsets)
-        return f"{self.model.name}_{self.model.grid_pitch}/" + \
-            "_".join([self.analysis_date.strftime('%Y%m%d%H%M')] + sorted_offsets)
+        return self.name
 
     def __fspath__(self):
         return GRIB_PATH / f"{self}.grib2"
@@ -79,6 +90,39 @@ class GribModel(object):
     grid_pitch = 0.5       # Interval between grid points in degrees
     analysis_offsets = ()  # Tuple of offsets from midnight UTC
     validity_offsets = ()  # Tuple of frozensets of offsets from analysis dates
+    MAX_FILEREFS = 10000  # Maximum number of memoized filerefs
+
+    def __init__(self):
+        self._filerefs = {}  # (analysis_date, validity offsets) => FileRef
+        self._inventory = None
+        # Index of the files' validity offsets by offset:
+        # forecast offset => validity offsets of the files containing it, for a same analysis
+        self._validity_offsets_by_offset = {}
+        for validity_offsets_for_file in self.validity_offsets:
+            for offset in validity_offsets_for_file:
+                self._validity_offsets_by_offset.setdefault(offset, []).append(frozenset(validity_offsets_for_file))
+        self._files_by_time_of_day_cache = {}
+
+    @property
+    def inventory(self):
+        """
+        The `GribInventory` of this model's downloaded files, created upon first use; refresh it before use.
+        """
+        if self._inventory is None:
+            self._inventory = GribInventory(GRIB_PATH / f"{self.name}_{self.grid_pitch}")
+        return self._inventory
+
+    def fileref(self, analysis_date, forecast_offsets):
+        """
+        :return: the memoized `FileRef` of this model for `analysis_date` and `forecast_offsets`
+        """
+        key = (analysis_date, frozenset(forecast_offsets))
+        fileref = self._filerefs.get(key)
+        if fileref is None:
+            if len(self._filerefs) >= self.MAX_FILEREFS:
+                self._filerefs.clear()
+            fileref = self._filerefs[key] = FileRef(self, analysis_date, forecast_offsets)
+        return fileref
 
     def list_forecasts(self, validity_date_from, validity_date_to=None):
         """
@@ -86,6 +130,9 @@ class GribModel(object):
         Those files aren't necessarily downloaded yet, and don't even necessarily exist (their analysis
         date might be in the future or in a very recent past).
 
+        Valid dates are enumerated along the model's time pitch; the files which may contain each of them
+        only depend on its time of day, and are looked up in an index computed once per time of day.
+
         :param validity_date_from: first valid date looked for;
         :param validity_date_to: optional last valid date looked for;
             if missing, only one validity date `validity_date_from` is looked for.
@@ -93,21 +140,33 @@ class GribModel(object):
         """
         if validity_date_to is None:
             validity_date_to = validity_date_from
-        results = {}  # valid date => fileref set
-        midnight = validity_date_to.replace(hour=0, minute=0, second=0, microsecond=0)
-        while midnight + max(max(self.validity_offsets)) >= validity_date_from:
-            for analysis_offset in reversed(sorted(self.analysis_offsets)):
-                for validity_offsets_for_file in self.validity_offsets:
-                    fileref = FileRef(self, midnight + analysis_offset, validity_offsets_for_file)
-                    for validity_date in fileref.valid_dates():
-                        if validity_date_from <= validity_date <= validity_date_to:
-                            if validity_date in results:
-                                results[validity_date].append(fileref)
-                            else:
-                                results[validity_date] = [fileref]
-            midnight -= timedelta(days=1)
+        results = {}  # valid date => fileref list
+        midnight = validity_date_from.replace(hour=0, minute=0, second=0, microsecond=0)
+        validity_date = midnight + -((midnight - validity_date_from) // self.time_pitch) * self.time_pitch
+        while validity_date <= validity_date_to:
+            time_of_day = validity_date - validity_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            filerefs = [self.fileref(validity_date - offset, validity_offsets_for_file)
+                        for (offset, validity_offsets_for_file) in self._files_by_time_of_day(time_of_day)]
+            if filerefs:
+                results[validity_date] = filerefs
+            validity_date += self.time_pitch
         return results
 
+    def _files_by_time_of_day(self, time_of_day):
+        """
+        :param time_of_day: time of a valid date, as an offset from midnight
+        :return: list of `(forecast_offset, validity_offsets)` for every file containing a valid date at
+            `time_of_day`, by increasing offset, i.e. decreasing analysis dates
+        """
+        files = self._files_by_time_of_day_cache.get(time_of_day)
+        if files is None:
+            files = []
+            for offset in sorted(self._validity_offsets_by_offset):
+                if (time_of_day - offset) % timedelta(days=1) in self.analysis_offsets:
+                    files += [(offset, v) for v in self._validity_offsets_by_offset[offset]]
+            self._files_by_time_of_day_cache[time_of_day] = files
+        return files
+
     def best_fileref(self, date):
         """
         Return the most recently generated forecast valid for `date` which has been locally downloaded,
@@ -115,8 +174,9 @@ class GribModel(object):
         :param date:
         """
         candidates = list(self.list_forecasts(date).values())[0]
+        self.inventory.refresh()
         for fileref in candidates:
-            if fileref.status() == 'downloaded':
+            if self.inventory.status(fileref) == 'downloaded':
                 return fileref
         return None  # Not found
 
@@ -129,48 +189,57 @@ class GribModel(object):
         print(f"Downloading file for f{combo}")
         raise NotImplementedError("downloading method not implemented")
 
-    def download_forecasts(self, validity_date_from, validity_date_to=None):
+    def download_forecasts(self, validity_date_from, validity_date_to=None, threads=DOWNLOAD_THREADS,
+                           on_downloaded=None):
         """
         Try to download the best forecast for every valid date within the date range.
-        Return a dictionary, valid_date => path of describing downloaded file.
+
+        Files are planned by `forecast.planner.plan_downloads`, and downloaded by a pool of `threads` threads,
+        nearest validity dates first. Whenever the best file for a valid date cannot be downloaded, the next
+        best one is planned in a later round. Stalled partial downloads are resumed rather than restarted.
+
         :param validity_date_from:
         :param validity_date_to:
-        :return:
+        :param threads: maximum number of simultaneous downloads
+        :param on_downloaded: optional function called with each fileref as soon as its file is available locally,
+            whether it's just been downloaded or was already there, from the calling thread; downloads
+            in progress go on meanwhile, so it should return quickly, typically by queuing some work.
+            Files being downloaded by another process aren't reported.
+        :return: a dictionary, valid_date => fileref of the best available file describing it.
         """
+        if validity_date_to is None:
+            validity_date_to = validity_date_from
 
-        # valid_date => list of filerefs containing that valid date, sorted by decreasing analysis date
-        forecasts = self.list_forecasts(validity_date_from, validity_date_to)
-
-        # Create a fileref => path index, to avoid multiple downloads.
-        downloaded = set()  # downloaded fileref set
-
-        # Order the forecasts to download nearest validity dates first
-        for validity_date, fileref_list in sorted(forecasts.items(), key=lambda item: item[0]):
-            print(f"? Looking for {validity_date.isoformat()}:")
-            for fileref in fileref_list:
-                if fileref.analysis_date > datetime.utcnow():
-                    continue  # File produced in the future
-                elif fileref.analysis_date + max(fileref.forecast_offsets) < datetime.utcnow():
-                    continue  # File only forecasts the past
-                elif fileref.status() in ("downloaded", "pending"):
-                    fspath = fileref.__fspath__()
-                    downloaded.add(fileref)
-                else:
-                    # Perform download
-                    fspath = fileref.download()
-                if fspath: # Either found already downloaded/pending, or just downloaded
-                    print(f"\t. Found in {fileref}")
-                    break  # No need to look for older forecast of the same validity_date
-
-        # Recreate the valid date => path result from the combo => path one.
-        # Items are handled by increasing analysis date, so that the latest forecast will erase older ones.
-        result = {}
-        for fileref in downloaded:
-            for validity_date in fileref.valid_dates():
-                if validity_date_from <= validity_date <= validity_date_to:
-                    result[validity_date] = fileref
-                    # TODO Preprocess immediately
-        return result
+        available = set()  # filerefs downloaded, or being downloaded by another process
+        failed = set()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                self.inventory.refresh()
+                # Freshest files for valid dates, skipping failed downloads, nearest validity dates first
+                plan = plan_downloads(self, validity_date_from, validity_date_to, excluded=failed)
+                for fileref in plan.filerefs:
+                    status = plan.statuses[fileref]
+                    if status in ("downloaded", "pending") and fileref not in available:
+                        print(f"\t. {fileref} found")
+                        available.add(fileref)
+                        if status == "downloaded" and on_downloaded is not None:
+                            on_downloaded(fileref)
+                wanted = plan.to_download()  # "missing" or "stalled", in which case it's resumed
+                if not wanted:
+                    break
+                futures = {executor.submit(fileref.download): fileref for fileref in wanted}
+                for future in as_completed(futures):
+                    fileref = futures[future]
+                    if future.result():
+                        self.inventory.add(future.result())
+                        available.add(fileref)
+                        if on_downloaded is not None:
+                            on_downloaded(fileref)
+                    else:
+                        failed.add(fileref)
+
+        # The last plan only selects available files, since every other one has failed
+        return plan.dates
 
     def round_position(self, position):
         """
@@ -228,39 +297,68 @@ class ArpegeCommon(GribModel):
         "referencetime=%(analysis_date)s&" + \
         "format=grib2"
 
-    def download_file(self, fileref):
-        MEGABYTE = 1024 * 1024
+    def file_url(self, fileref):
         offsets = sorted("%02d" % int(d / timedelta(hours=1)) for d in fileref.forecast_offsets)
-        url = self.url_pattern % {
+        return self.url_pattern % {
             'name':          self.name,
             'grid_pitch':    str(self.grid_pitch),
             'first_offset':  offsets[0],
             'last_offset':   offsets[-1],
             'analysis_date': fileref.analysis_date.strftime("%Y-%m-%dT%H:%M:%SZ")}
-        output = Path(str(fileref.__fspath__())+".part")
-        try:
-            print(f"\t? Trying to download {output}\n\tfrom {url}")
-            with urlopen(url) as input:
-                if input.status > 299:
-                    print(f"\t- Error {input.status}: {input.msg}")
+
+    def download_file(self, fileref):
+        """
+        Download a file into a `.part` file, renamed once complete.
+        An existing `.part` file is resumed with an HTTP range request; failed attempts
+        are retried with an exponential backoff, unless the server reports a client error
+        (typically, a file which isn't published yet).
+        :return: path to downloaded file, or None upon failure.
+        """
+        MEGABYTE = 1024 * 1024
+        url = self.file_url(fileref)
+        result = Path(fileref.__fspath__())
+        output = Path(str(result)+".part")
+        restart = False
+        for attempt in range(DOWNLOAD_RETRIES):
+            if attempt > 0:
+                time.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1))
+            try:
+                if restart:  # Range not satisfiable: the partial file is unusable, restart from scratch
+                    output.unlink(missing_ok=True)
+                    restart = False
+                offset = output.stat().st_size if output.is_file() else 0
+                headers = {'Range': f"bytes={offset}-"} if offset > 0 else {}
+                print(f"\t? Trying to download {output}{f' from byte {offset}' if offset else ''}\n\tfrom {url}")
+                with urlopen(Request(url, headers=headers)) as input:
+                    if input.status > 299:
+                        print(f"\t- Error {input.status}: {input.msg}")
+                        return None
+                    output.parent.mkdir(parents=True, exist_ok=True)
+                    # Servers ignoring the range request send the whole file again.
+                    if input.status != 206:
+                        offset = 0
+                    length = input.headers.get('Content-Length')
+                    with output.open('ab' if offset > 0 else 'wb') as output_buffer:
+                        while True:
+                            chunk = input.read(MEGABYTE)
+                            if not chunk:
+                                break
+                            output_buffer.write(chunk)
+                            output_buffer.flush()
+                if length is not None and output.stat().st_size != offset + int(length):
+                    raise IOError("connection closed before the end of the file")
+                output.rename(result)
+                print(f"\t+ Saved to {result}")
+                return result
+            except HTTPError as e:
+                print(f"\t- HTTP error {e.code}: {e.msg}")
+                if e.code == 416:
+                    restart = True
+                elif 400 <= e.code < 500 and e.code not in (408, 429):
                     return None
-                output.parent.mkdir(parents=True, exist_ok=True)
-                with output.open('wb') as output_buffer:
-                    for i in range(sys.maxsize):
-                        sys.stdout.write(f"\r\t+ {i}MB")
-                        sys.stdout.flush()
-                        chunk = input.read(MEGABYTE)
-                        if not chunk:
-                            break
-                        output_buffer.write(chunk)
-                        output_buffer.flush()
-
-            output.rename(fileref.__fspath__())
-            print(f" Saved to {fileref.__fspath__()}")
-            return output
-        except HTTPError as e:
-            print(f"\t- HTTP error {e.code}: {e.msg}")
-            return None
+            except (URLError, OSError) as e:
+                print(f"\t- Download of {output} interrupted: {e}")
+        return None
 
 
 class ArpegeGlobal(ArpegeCommon):
@@ -0,0 +1,108 @@
+"""
+Planning of forecast downloads: which files to download so that every valid date of a range is described
+by the freshest analysis available, without downloading more than needed.
+
+For each valid date, only the files of its most recent analysis are considered, among those already
+produced and not known to have failed; older analyses are only used as fallbacks when downloads of newer
+ones fail. A file usually covers many valid dates, so dates described by a same analysis are grouped,
+and the files covering them are selected greedily, cheapest per newly covered date first, which costs
+one file per distinct (analysis, package) pair when packages don't overlap. Costs are estimated bytes,
+from the sizes of files with the same validity offsets already downloaded, or file counts when unknown.
+"""
+from datetime import datetime
+
+
+class DownloadPlan(object):
+    """
+    Files selected to describe a range of valid dates.
+    """
+    def __init__(self, model, dates, statuses, sizes):
+        """
+        :param model: the `GribModel`
+        :param dates: dict valid date => selected fileref, sorted by valid date
+        :param statuses: dict fileref => status in the model's inventory, as of planning
+        :param sizes: dict fileref => estimated size in bytes, or None if unknown
+        """
+        self.model = model
+        self.dates = dates
+        self.statuses = statuses
+        self.sizes = sizes
+        # Files in order of their first valid date, so that nearest dates are downloaded first
+        self.filerefs = list(dict.fromkeys(dates.values()))
+
+    def to_download(self):
+        """
+        :return: the filerefs which aren't available locally: "missing", or "stalled" and to be resumed
+        """
+        return [f for f in self.filerefs if self.statuses[f] in ("missing", "stalled")]
+
+    def estimated_bytes(self):
+        """
+        :return: `(n_bytes, n_unknown)`, the estimated volume of files to download,
+            and the number of those files whose size can't be estimated
+        """
+        sizes = [self.sizes[f] for f in self.to_download()]
+        return sum(s for s in sizes if s is not None), sum(1 for s in sizes if s is None)
+
+    def describe(self):
+        """
+        :return: a human-readable description of the plan, as a list of lines
+        """
+        lines = []
+        for fileref in self.filerefs:
+            dates = [d for (d, f) in self.dates.items() if f == fileref]
+            size = self.sizes[fileref]
+            lines.append(f"\t{self.statuses[fileref]:10} {fileref} " +
+                         f"({len(dates)} dates from {dates[0].isoformat()} to {dates[-1].isoformat()}, " +
+                         f"{'?' if size is None else f'{size / 1e6:.1f}'}MB)")
+        (n_bytes, n_unknown) = self.estimated_bytes()
+        lines.append(f"{len(self.to_download())}/{len(self.filerefs)} files to download for {len(self.dates)} valid dates, " +
+                     f"{n_bytes / 1e6:.1f}MB" + (f" + {n_unknown} file(s) of unknown size" if n_unknown else ""))
+        return lines
+
+
+def plan_downloads(model, validity_date_from, validity_date_to=None, excluded=(), now=None):
+    """
+    :param model: a `GribModel`, whose inventory must be up to date
+    :param validity_date_from: first valid date
+    :param validity_date_to: optional last valid date
+    :param excluded: filerefs which must not be selected, typically because their download failed
+    :param now: current UTC date, defaults to now
+    :return: a `DownloadPlan`; valid dates without any candidate file are left out
+    """
+    now = now or datetime.utcnow()
+    inventory = model.inventory
+    freshest = {}  # valid date => candidate filerefs of its most recent analysis
+    for validity_date, fileref_list in sorted(model.list_forecasts(validity_date_from, validity_date_to).items()):
+        candidates = [fileref for fileref in fileref_list
+                      if fileref.analysis_date <= now  # Not produced in the future
+                      and fileref.analysis_date + max(fileref.forecast_offsets) >= now  # Not only the past
+                      and fileref not in excluded]
+        if candidates:
+            analysis_date = candidates[0].analysis_date  # Candidates are sorted by decreasing analysis date
+            freshest[validity_date] = [f for f in candidates if f.analysis_date == analysis_date]
+
+    statuses = {f: inventory.status(f, now) for fileref_list in freshest.values() for f in fileref_list}
+    sizes = {f: inventory.estimate_size(f) for f in statuses}
+    known_sizes = [s for s in sizes.values() if s is not None]
+    default_size = sum(known_sizes) / len(known_sizes) if known_sizes else 1
+
+    def cost(fileref):
+        if statuses[fileref] in ("downloaded", "pending"):
+            return 0
+        return sizes[fileref] if sizes[fileref] is not None else default_size
+
+    # Greedy cover of the valid dates, among the files selected for each of them
+    selected = {}
+    uncovered = set(freshest)
+    while uncovered:
+        coverage = {}  # fileref => uncovered valid dates it would cover
+        for validity_date in uncovered:
+            for fileref in freshest[validity_date]:
+                coverage.setdefault(fileref, []).append(validity_date)
+        best = min(coverage, key=lambda f: (cost(f) / len(coverage[f]), min(coverage[f])))
+        for validity_date in coverage[best]:
+            selected[validity_date] = best
+        uncovered.difference_update(coverage[best])
+
+    return DownloadPlan(model, dict(sorted(selected.items())), statuses, sizes)
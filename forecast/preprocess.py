@@ -1,90 +1,234 @@
 """
 Preprocess a GRIB file into a series of numpy arrays, one per valid date,
-indexed in lon / lat / pressure, and containing tuples t / u / v / z / r.
+indexed in variable / lon / lat / pressure, for variables t / u / v / z / r.
 
-Storage format:
+Storage format (version 2):
 
-One file with '.np' suffix contains the numpy array:
+One file with '.np' suffix contains a single `int16` array, made of one contiguous
+sub-array per variable. Each sub-array is indexed by lon / lat / pressure, so that
+the values of a variable over a whole column are contiguous. Values are quantized:
+the physical value is `stored * scale + offset`, with scale and offset given per
+variable in the shape file:
 
-* t as an unsigned 16-bits int
-* u & v as signed bytes in m/s
-* z unsigned short (2 bytes) in meters
-* r a two-bytes half-float
+* t in °K, by 0.01°K steps
+* u & v in m/s, by 0.01m/s steps
+* z in meters above MSL, by 1m steps, from -16767m to 48767m
+* r in percents, by 0.01% steps
+
+Optionally, variables derived from those are stored after them, so that they don't have
+to be recomputed every time a column is extracted:
+
+* rho, air density in kg/m³, by 0.000025kg/m³ steps
+* zb, altitude of each level's upper boundary in meters above MSL, by 1m steps. Boundaries
+  are half-way between levels, and the top level is considered to be in the middle of its cell.
 
 The other with suffix '.json' contains its indexing description:
+* format version
 * list of latitudes in degrees
 * list of longitudes in degrees
 * list of levels in hPa
+* list of variables, in the order of the array's first dimension
+* scales and offsets of each variable
+* analysis date
+
+Files without format version (version 1) contain a recarray indexed by lon / lat / pressure,
+and containing tuples t / u / v / z / r of half-floats. They're still read by `forecast.cache`.
 """
+import fcntl
 import json
+import os
 import pygrib
 import sys
+import time
+from contextlib import contextmanager
 
 import numpy as np
 
+from core.models import air_density_kg_m3
+from forecast.cache import forecast_cache, column_cache
+from forecast.catalog import forecast_catalog
+from forecast.storage import PACKING, STORAGE_TYPE, pack, unpack
+
 
 SHORT_NAMES = tuple("tuvzr")
-DATA_TYPES = [(name, "f2") for name in SHORT_NAMES]
-EPSILON = 1e-5
+DERIVED_NAMES = ('rho', 'zb')
+FORMAT_VERSION = 2
+
+
+def derive(array, altitudes):
+    """
+    Compute derived variables from quantized base variables, such as those which will be read back
+    by `forecast.cache`.
+    :param array: quantized array indexed by variable (as in `SHORT_NAMES`), lon, lat, level
+    :param altitudes: pressures of levels in hPa, in increasing order
+    :return: quantized array indexed by derived variable (as in `DERIVED_NAMES`), lon, lat, level
+    """
+    (t, z, r) = (unpack(name, array[SHORT_NAMES.index(name)]) for name in "tzr")
+    rho = air_density_kg_m3(np.asarray(altitudes, dtype=np.float64), t, r)
+    # Levels are sorted by increasing pressure, hence by decreasing altitude
+    zb = np.empty_like(z)
+    zb[..., 1:] = (z[..., 1:] + z[..., :-1]) / 2
+    zb[..., 0] = z[..., 0] + (z[..., 0] - z[..., 1]) / 2
+    return np.stack((pack('rho', rho), pack('zb', zb)))
+
+
+def replace_file(path, mode, write):
+    """
+    Write a file with `write(f)` in a temporary file, then atomically move it to `path`.
+    Processes which have memory-mapped the previous version keep reading it consistently,
+    instead of seeing it truncated and rewritten under their feet.
+    """
+    tmp_path = path.parent / f"{path.name}.{os.getpid()}.tmp"
+    with tmp_path.open(mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def output_lock(output_path):
+    """
+    Exclusive lock on a preprocessed files directory, shared with concurrent preprocessing processes.
+    Held while checking whether a valid date must be (re)written, and writing it.
+    """
+    with (output_path / ".preprocess.lock").open('w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def previous_analysis_date(shape_file_path):
+    """
+    :return: the analysis date of already preprocessed files, as an ISO string, or "" if there's none.
+    """
+    try:
+        with shape_file_path.open() as f:
+            return json.load(f).get('analysis_date', "")
+    except IOError:
+        return ""
 
 
-def preprocess(grib_file_path, lat1, lat2, lon1, lon2, force=False):
-    # TODO ARPEGE INDEXED 0...360 rather than -180...180, boxes across 0 not supported
+def box_indexes(lats, lons, lat1, lat2, lon1, lon2):
+    """
+    Select the rows and columns of a regular GRIB grid which lie within a box.
+    :param lats: 2D latitudes array, as returned by `pygrib.gribmessage.latlons()`
+    :param lons: 2D longitudes array, same shape as `lats`, within 0...360
+    :param lat1, lat2, lon1, lon2: box limits, included. Boxes across the 0 meridian have `lon2 < lon1`.
+    :return: `(lat_indexes, lon_indexes)` arrays, in the order in which they must appear in the box
+    """
+    lat_axis = lats[:, 0]
+    lon_axis = lons[0, :]
+    lat_indexes = np.flatnonzero((lat1 <= lat_axis) & (lat_axis <= lat2))
+    if lon1 <= lon2:
+        lon_indexes = np.flatnonzero((lon1 <= lon_axis) & (lon_axis <= lon2))
+    else:  # Across the 0 meridian: eastern part of the grid first, then western part
+        lon_indexes = np.concatenate((np.flatnonzero(lon1 <= lon_axis), np.flatnonzero(lon_axis <= lon2)))
+    return lat_indexes, lon_indexes
+
+
+def preprocess(grib_file_path, lat1, lat2, lon1, lon2, force=False, derived=False):
+    """
+    Preprocess every valid date of a GRIB file, within a lat/lon box, into `.np` / `.json` files
+    saved in the same directory.
+    :return: see `preprocess_messages()`
+    """
     with pygrib.open(grib_file_path.__fspath__()) as f:
         messages = f.select(shortName=SHORT_NAMES, typeOfLevel='isobaricInhPa')
-        dates = set(m.validDate for m in messages)
-        altitudes = sorted(set(m.level for m in messages))
-        alt_idx_dict = {l: i for (i, l) in enumerate(altitudes)}
-        if lon2 < lon1:  # Across the 0 meridian
-            left = messages[0].data(lat1=lat1, lat2=lat2, lon1=lon1, lon2=360 - EPSILON)[1:]
-            right = messages[0].data(lat1=lat1, lat2=lat2, lon1=0, lon2=lon2)[1:]
-            lats, lons = (np.concatenate((l, r), axis=1) for l, r in zip(left, right))
-        else:
-            box = dict(lat1=lat1, lat2=lat2, lon1=lon1, lon2=lon2)
-            lats, lons = messages[0].data(**box)[1:]
-            print(f"preprocessing {grib_file_path} within {box}")
-        analysis_date = messages[0].analDate.isoformat()
-        lats = [x[0] for x in lats]
-        lons = list(lons[0])
-        shape = [len(lons), len(lats), len(altitudes)]
-
-        for date in dates:
-            basename = date.strftime("%Y%m%d%H%M")
-            np_file_path = grib_file_path.parent / (basename+".np")
-            shape_file_path = grib_file_path.parent / (basename+".json")
-            if not force and shape_file_path.is_file():
-                # Check if there is a preprocessed file at least as recent as this one.
-                with shape_file_path.open() as f:
-                    previous_analysis = json.load(f).get('analysis_date', "")
-                if previous_analysis >= analysis_date:
-                    print(f"\t- preprocessed data for {date.isoformat()} is more recent ({previous_analysis} vs. {analysis_date})")
-                    continue
-                else:
-                    print(f"\t+ Update files for {date.isoformat()} ({previous_analysis} => {analysis_date})")
+        print(f"preprocessing {grib_file_path} within {dict(lat1=lat1, lat2=lat2, lon1=lon1, lon2=lon2)}")
+        return preprocess_messages(messages, grib_file_path.parent, lat1, lat2, lon1, lon2, force, derived)
+
+
+def preprocess_messages(messages, output_path, lat1, lat2, lon1, lon2, force=False, derived=False):
+    """
+    Preprocess GRIB messages into `.np` / `.json` files, one pair per valid date.
+
+    Messages are grouped by valid date once, and each field is decoded exactly once,
+    with the sub-box extracted by indexing the decoded field rather than through
+    `gribmessage.data()`, which recomputes the whole lat/lon grid at every call.
+    Valid dates for which more recent preprocessed files exist are not decoded at all.
+
+    :param messages: `pygrib.gribmessage`s, or any objects offering the same
+        `shortName`, `level`, `validDate`, `analDate`, `values` and `latlons()` API.
+    :param output_path: directory where files are written, named after the model.
+    :param force: reprocess dates even if there are more recent preprocessed files.
+    :param derived: also store the variables of `DERIVED_NAMES`.
+    :return: a report dict, with the `analysis_date` of messages as an ISO string, the number of `decodes`
+        performed, the `elapsed` time in seconds and the status of each valid date in `dates`,
+        among "created", "updated" and "skipped".
+    """
+    # TODO ARPEGE INDEXED 0...360 rather than -180...180
+    start_time = time.perf_counter()
+    report = {'decodes': 0, 'dates': {}}
+
+    messages_by_date = {}
+    for m in messages:
+        messages_by_date.setdefault(m.validDate, []).append(m)
+    altitudes = sorted(set(m.level for m in messages))
+    alt_idx_dict = {l: i for (i, l) in enumerate(altitudes)}
+
+    grid_lats, grid_lons = messages[0].latlons()
+    lat_indexes, lon_indexes = box_indexes(grid_lats, grid_lons, lat1, lat2, lon1, lon2)
+    lats = [float(grid_lats[i, 0]) for i in lat_indexes]
+    lons = [float(grid_lons[0, i]) for i in lon_indexes]
+    box = np.ix_(lat_indexes, lon_indexes)
+    analysis_date = messages[0].analDate.isoformat()
+    report['analysis_date'] = analysis_date
+    shape = [len(lons), len(lats), len(altitudes)]
+    variables = SHORT_NAMES + DERIVED_NAMES if derived else SHORT_NAMES
+
+    for date, date_messages in sorted(messages_by_date.items()):
+        basename = date.strftime("%Y%m%d%H%M")
+        np_file_path = output_path / (basename+".np")
+        shape_file_path = output_path / (basename+".json")
+        if not force and shape_file_path.is_file():
+            # Check if there is a preprocessed file at least as recent as this one.
+            previous_analysis = previous_analysis_date(shape_file_path)
+            if previous_analysis >= analysis_date:
+                print(f"\t- preprocessed data for {date.isoformat()} is more recent ({previous_analysis} vs. {analysis_date})")
+                report['dates'][date] = "skipped"
+                continue
             else:
-                print(f"\t+ Create files for {date.isoformat()}:")
-            array = np.recarray(shape=shape, dtype=DATA_TYPES)
-            for m in messages:
-                if m.validDate != date:
-                    continue
-                sys.stdout.write(f"\r\t\tindexing {m.shortName}@{m.level}hPa")
-                sys.stdout.flush()
-                alt_idx = alt_idx_dict[m.level]
-                if lon1 < lon2:
-                    data = m.data(**box)[0]
-                else:
-                    left = messages[0].data(lat1=lat1, lat2=lat2, lon1=lon1, lon2=360 - EPSILON)[0]
-                    right = messages[0].data(lat1=lat1, lat2=lat2, lon1=0, lon2=lon2)[0]
-                    data = np.concatenate((left, right), axis=1)
-                for lon_idx in range(len(lons)):
-                    for lat_idx in range(len(lats)):
-                        datum = data[lat_idx][lon_idx]
-                        if m.shortName == 'z':
-                            datum = int(datum/9.81)  # Convert geopotential in m²/s² into meters above MSL
-                        array[lon_idx][lat_idx][alt_idx][m.shortName] = datum
-            with np_file_path.open('wb') as f:
-                np.save(f, array)
-            with shape_file_path.open('w') as f:
-                json.dump({'lats': lats, 'lons': lons, 'alts': altitudes, 'analysis_date': analysis_date}, f)
-            print("")
+                print(f"\t+ Update files for {date.isoformat()} ({previous_analysis} => {analysis_date})")
+                report['dates'][date] = "updated"
+        else:
+            print(f"\t+ Create files for {date.isoformat()}:")
+            report['dates'][date] = "created"
+        array = np.zeros(shape=[len(SHORT_NAMES)] + shape, dtype=STORAGE_TYPE)
+        for m in date_messages:
+            sys.stdout.write(f"\r\t\tindexing {m.shortName}@{m.level}hPa")
+            sys.stdout.flush()
+            data = np.asarray(m.values)[box]
+            report['decodes'] += 1
+            if m.shortName == 'z':
+                data = data / 9.81  # Convert geopotential in m²/s² into meters above MSL
+            # GRIB fields are indexed by lat, lon; arrays by variable, lon, lat, level
+            array[SHORT_NAMES.index(m.shortName), :, :, alt_idx_dict[m.level]] = pack(m.shortName, data.T)
+        if derived:
+            array = np.concatenate((array, derive(array, altitudes)))
+        with output_lock(output_path):
+            # Another process may have written a more recent analysis while this one was decoding.
+            previous_analysis = previous_analysis_date(shape_file_path)
+            if not force and previous_analysis >= analysis_date:
+                print(f"\n\t- preprocessed data for {date.isoformat()} has been updated concurrently ({previous_analysis})")
+                report['dates'][date] = "skipped"
+                continue
+            # Shape file written last: its modification signals readers that the date has been updated,
+            # and `ForecastCache.get` loads them in the same order.
+            replace_file(np_file_path, 'wb', lambda f: np.save(f, array))
+            replace_file(shape_file_path, 'w', lambda f: json.dump({
+                'format': FORMAT_VERSION, 'lats': lats, 'lons': lons, 'alts': altitudes,
+                'variables': variables,
+                'scales': {name: PACKING[name][0] for name in variables},
+                'offsets': {name: PACKING[name][1] for name in variables},
+                'analysis_date': analysis_date}, f))
+            forecast_catalog.put(output_path.name, date, analysis_date)
+        forecast_cache.invalidate(output_path.name, date)
+        column_cache.invalidate(output_path.name, date)
+        print("")
 
+    report['elapsed'] = time.perf_counter() - start_time
+    n_written = sum(1 for status in report['dates'].values() if status != "skipped")
+    print(f"Preprocessed {n_written}/{len(messages_by_date)} dates in {report['elapsed']:.1f}s, " +
+          f"{report['decodes']} fields decoded ({len(lons)}×{len(lats)} points × {len(altitudes)} levels)")
+    return report
@@ -0,0 +1,35 @@
+"""
+Quantization of forecast values into the integers of preprocessed arrays, shared by
+`forecast.preprocess`, which writes them, and `forecast.tile`, which serves them as is.
+See the storage format in `forecast.preprocess`.
+"""
+import numpy as np
+
+STORAGE_TYPE = np.int16
+PACKING = {  # variable => (scale, offset)
+    't': (0.01, 250.),
+    'u': (0.01, 0.),
+    'v': (0.01, 0.),
+    'z': (1., 16000.),
+    'r': (0.01, 0.),
+    'rho': (0.000025, 0.7),
+    'zb': (1., 16000.),
+}
+
+
+def pack(name, values):
+    """
+    Quantize physical values of variable `name` into `STORAGE_TYPE` integers.
+    Out of range values are clipped.
+    """
+    (scale, offset) = PACKING[name]
+    limits = np.iinfo(STORAGE_TYPE)
+    return np.clip(np.rint((values - offset) / scale), limits.min, limits.max).astype(STORAGE_TYPE)
+
+
+def unpack(name, stored):
+    """
+    Convert quantized values of variable `name` back into physical values.
+    """
+    (scale, offset) = PACKING[name]
+    return stored * scale + offset
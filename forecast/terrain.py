@@ -0,0 +1,95 @@
+"""
+Ground altitudes of GRIB models, as preprocessed by `forecast_terrain`.
+
+Each model's `terrain.np` is memory-mapped once per process, then answers
+point and vectorized batch queries. The terrain is reloaded whenever its shape
+file is rewritten, e.g. by `forecast_terrain --force`.
+"""
+import json
+import os
+from threading import Lock
+
+import numpy as np
+
+from balloon.settings import GRIB_PATH
+from forecast.grid import GridIndex
+
+
+class Terrain(object):
+    """
+    Ground altitude above MSL, in meters, of every grid point of a GRIB model.
+    """
+    def __init__(self, model):
+        self.model = model
+        model_name = f"{model.name}_{model.grid_pitch}"
+        self.np_file_path = GRIB_PATH / model_name / "terrain.np"
+        self.shape_file_path = GRIB_PATH / model_name / "terrain.json"
+        self.array = None
+        self.grid = None
+        self.mtime_ns = None  # Modification time of the shape file when it's been loaded
+        self.lock = Lock()
+
+    def _update(self):
+        """
+        Ensure that the terrain array is loaded and up-to-date with files on disk.
+        :return: `(array, grid)`, consistent with each other even if another thread reloads them.
+        """
+        try:
+            mtime_ns = os.stat(self.shape_file_path).st_mtime_ns
+        except IOError:
+            raise ValueError("No preprocessed terrain for this model")
+        with self.lock:
+            if self.array is None or self.mtime_ns != mtime_ns:
+                try:
+                    with self.shape_file_path.open('r') as f:
+                        shape = json.load(f)
+                    self.array = np.load(self.np_file_path, mmap_mode='r')
+                except IOError:
+                    raise ValueError("No preprocessed terrain for this model")
+                self.grid = GridIndex.from_shape(shape)
+                self.mtime_ns = mtime_ns
+            return self.array, self.grid
+
+    def altitude(self, position):
+        """
+        :param position: `(lon, lat)`
+        :return: altitude above MSL in meters of the nearest grid point
+        """
+        (array, grid) = self._update()
+        try:
+            (lon_idx, lat_idx) = grid.index(self.model.round_position(position))
+        except ValueError:
+            raise ValueError("No preprocessed data for this position")
+        return int(array[lon_idx, lat_idx])
+
+    def altitudes(self, lons, lats):
+        """
+        Vectorized version of `altitude`.
+        :param lons: array of longitudes
+        :param lats: array of latitudes, same shape as `lons`
+        :return: integer array of altitudes above MSL in meters
+        """
+        (array, grid) = self._update()
+        pitch = self.model.grid_pitch
+        try:
+            (lon_idx, lat_idx) = grid.indexes(np.round(np.asarray(lons) / pitch) * pitch,
+                                              np.round(np.asarray(lats) / pitch) * pitch)
+        except ValueError:
+            raise ValueError("No preprocessed data for some positions")
+        return array[lon_idx, lat_idx].astype(np.int64)
+
+
+_terrains = {}  # model name => Terrain
+_terrains_lock = Lock()
+
+
+def get_terrain(model):
+    """
+    :param model: a `GribModel`
+    :return: the process-wide `Terrain` of this model
+    """
+    model_name = f"{model.name}_{model.grid_pitch}"
+    with _terrains_lock:
+        if model_name not in _terrains:
+            _terrains[model_name] = Terrain(model)
+        return _terrains[model_name]
@@ -0,0 +1,99 @@
+"""
+Bulk extraction of forecast fields over a lon/lat sub-box, for a selection of levels.
+
+Tiles are sliced directly from the memory-mapped preprocessed arrays, and kept
+quantized: values are returned as `int16`, along with the scale and offset of
+each variable, as in the storage format described in `forecast.preprocess`.
+Legacy (format 1) arrays are quantized on the fly with the same parameters.
+"""
+import io
+import json
+
+import numpy as np
+
+from forecast.grid import EPSILON
+from forecast.storage import PACKING, STORAGE_TYPE, pack
+
+DEFAULT_VARIABLES = ('u', 'v', 't', 'z')
+MAX_VALUES = 16 * 1024 * 1024  # 32MB of int16 values
+
+
+def _axis_indexes(axis, x1, x2):
+    """
+    :return: a selection of the grid points of `axis` within `x1...x2`, suitable to index arrays:
+        a slice when they're contiguous, which memory-mapped arrays serve without copying, or an index array.
+        And the array of their indexes.
+    """
+    indexes = np.flatnonzero((x1 - EPSILON <= axis.values) & (axis.values <= x2 + EPSILON))
+    if len(indexes) == 0:
+        raise ValueError("No grid point within the requested box")
+    if indexes[-1] - indexes[0] + 1 == len(indexes):
+        return slice(int(indexes[0]), int(indexes[-1]) + 1), indexes
+    return indexes, indexes
+
+
+def extract_tile(forecast, lon1, lon2, lat1, lat2, levels=None, variables=DEFAULT_VARIABLES):
+    """
+    :param forecast: a `forecast.cache.Forecast`
+    :param lon1, lon2, lat1, lat2: box limits, included
+    :param levels: pressures in hPa of the levels to extract, every level if None
+    :param variables: names of the variables to extract
+    :return: `(values, description)`: `values` is an `int16` array indexed by variable, lon, lat, level;
+        `description` is a dict with the `lons`, `lats`, `levels` and `variables` along those axes,
+        and the `scales` and `offsets` giving physical values as `values * scale + offset`.
+    :raise ValueError: if the box is empty or too large, or if a level or a variable doesn't exist
+    """
+    alts = forecast.shape['alts']
+    if levels is None:
+        levels = alts
+    try:
+        level_indexes = [alts.index(level) for level in levels]
+    except ValueError:
+        raise ValueError(f"Available levels are {', '.join(str(a) for a in alts)}")
+    unknown_variables = [name for name in variables if name not in forecast.variables]
+    if unknown_variables:
+        raise ValueError(f"Unknown variables {', '.join(unknown_variables)}")
+    (lon_selection, lon_indexes) = _axis_indexes(forecast.grid.lons, lon1, lon2)
+    (lat_selection, lat_indexes) = _axis_indexes(forecast.grid.lats, lat1, lat2)
+    n_values = len(variables) * len(lon_indexes) * len(lat_indexes) * len(level_indexes)
+    if n_values > MAX_VALUES:
+        raise ValueError(f"Too large a tile, {n_values} values requested for at most {MAX_VALUES}")
+
+    # Index each dimension separately: combined index arrays would be broadcast against each other
+    if forecast.format == 1:
+        records = forecast.array[lon_selection][:, lat_selection][..., level_indexes]
+        values = np.stack([pack(name, records[name].astype(np.float64)) for name in variables])
+        (scales, offsets) = ([PACKING[name][0] for name in variables], [PACKING[name][1] for name in variables])
+    else:
+        variable_indexes = [forecast.variables.index(name) for name in variables]
+        values = np.stack([forecast.array[i, lon_selection][:, lat_selection][..., level_indexes]
+                           for i in variable_indexes]).astype(STORAGE_TYPE, copy=False)
+        scales = [float(forecast.scales[i]) for i in variable_indexes]
+        offsets = [float(forecast.offsets[i]) for i in variable_indexes]
+
+    return values, {
+        'lons': forecast.grid.lons.values[lon_indexes].tolist(),
+        'lats': forecast.grid.lats.values[lat_indexes].tolist(),
+        'levels': list(levels),
+        'variables': list(variables),
+        'scales': scales,
+        'offsets': offsets,
+    }
+
+
+def to_npz(values, description, metadata):
+    """
+    Serialize a tile as an uncompressed NumPy `.npz` archive: values are already quantized,
+    and left to HTTP compression if any.
+    :return: the archive's bytes, with entries `values`, `lons`, `lats`, `levels`, `scales`, `offsets`,
+        and `metadata`, a JSON string describing variables and dates.
+    """
+    f = io.BytesIO()
+    np.savez(f, values=values,
+             lons=np.array(description['lons']),
+             lats=np.array(description['lats']),
+             levels=np.array(description['levels']),
+             scales=np.array(description['scales']),
+             offsets=np.array(description['offsets']),
+             metadata=np.array(json.dumps(dict(metadata, variables=description['variables']))))
+    return f.getvalue()
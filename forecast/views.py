@@ -1,12 +1,19 @@
+import hashlib
 import os
 from datetime import datetime
 from dateutil.parser import parse as parse_date
 
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 
+from forecast.cache import forecast_cache
 from forecast.extract import ColumnExtractor
 from . import models as m
 from . import extract
+from . import tile as forecast_tile
+
+TILE_MAX_AGE = 300  # Seconds during which clients may reuse a tile without revalidating it
 
 
 def list_files(request, grib_model):
@@ -41,8 +48,65 @@ def altitude(request, grib_model):
     try:
         longitude = float(request.GET['longitude'])
         latitude = float(request.GET['latitude'])
-        return JsonResponse(ColumnExtractor(grib_model).extract_ground_altitude((longitude, latitude)))
+        return JsonResponse(ColumnExtractor(grib_model).extract_ground_altitude((longitude, latitude)), safe=False)
     except KeyError as e:
         return HttpResponseBadRequest(f"Missing parameter {e.args[0]}")
     except ValueError as e:
         return HttpResponseBadRequest(e.args[0])
+
+
+def _parse_date(date_string):
+    """Return an UTC, timezone-naive date, as `core.views` does"""
+    return parse_date(date_string).astimezone().replace(tzinfo=None)
+
+
+def _tile_forecast(request, grib_model):
+    """
+    :return: `(model, forecast)` requested by a tile request
+    :raise KeyError, ValueError: if parameters are missing or invalid
+    """
+    model = m.grib_models[grib_model]
+    date = _parse_date(request.GET['date'])
+    return model, forecast_cache.get(model, model.round_time(date))
+
+
+def _tile_etag(request, grib_model):
+    """
+    Tiles only change when their forecast is preprocessed from a new analysis.
+    """
+    try:
+        (model, forecast) = _tile_forecast(request, grib_model)
+    except (KeyError, ValueError):
+        return None  # Let the view report the error
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.GET.items()))
+    key = f"{grib_model}|{forecast.analysis_date.isoformat()}|{query}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+@condition(etag_func=_tile_etag)
+def tile(request, grib_model):
+    """
+    Forecast fields over a lon/lat box, for some levels, as a NumPy `.npz` archive of quantized values;
+    see `forecast.tile`. Parameters: `date`, `lon1`, `lon2`, `lat1`, `lat2`, optional comma-separated
+    `levels` in hPa (all of them by default) and `variables` (u, v, t, z by default).
+    """
+    params = request.GET
+    try:
+        (model, forecast) = _tile_forecast(request, grib_model)
+        box = {name: float(params[name]) for name in ('lon1', 'lon2', 'lat1', 'lat2')}
+        levels = [int(x) for x in params['levels'].split(",")] if 'levels' in params else None
+        variables = params['variables'].split(",") if 'variables' in params else forecast_tile.DEFAULT_VARIABLES
+        (values, description) = forecast_tile.extract_tile(forecast, levels=levels, variables=variables, **box)
+    except KeyError as e:
+        return HttpResponseBadRequest(f"Parameter {e.args[0]} missing or invalid")
+    except ValueError as e:
+        return HttpResponseBadRequest(f"Invalid parameter: {e.args[0]}")
+
+    metadata = {'model': grib_model,
+                'analysis_date': forecast.analysis_date.isoformat(),
+                'valid_date': model.round_time(_parse_date(params['date'])).isoformat()}
+    response = HttpResponse(forecast_tile.to_npz(values, description, metadata),
+                            content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="tile.npz"'
+    patch_cache_control(response, public=True, max_age=TILE_MAX_AGE)
+    return response
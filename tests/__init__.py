@@ -0,0 +1,23 @@
+"""
+Tests, run from the repository's root without any downloaded forecast:
+
+    python -m unittest
+
+`GRIB_PATH` points to a temporary directory, so that the files, catalog and caches written
+by the code under test never mix with those of the installation. Test modules import it
+first, so that it's set before Django's settings are loaded, however they're discovered.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+GRIB_PATH = Path(tempfile.mkdtemp(prefix="balloon-tests-"))
+atexit.register(shutil.rmtree, GRIB_PATH, ignore_errors=True)
+os.environ['BALLOON_GRIB_PATH'] = str(GRIB_PATH)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "balloon.settings")
+
+import django  # noqa: E402 Settings must be configured first
+
+django.setup()
@@ -0,0 +1,49 @@
+"""
+GRIB-like messages, with the subset of the `pygrib.gribmessage` API used by `forecast.preprocess`.
+"""
+import numpy as np
+
+LEVELS = (500, 850, 1000)
+G = 9.81
+
+
+class FakeMessage(object):
+    """
+    Field of a GRIB message on a regular grid, whose values are computed upon access, as GRIB fields
+    are decoded. Accesses are counted in `decodes`.
+    """
+    def __init__(self, shortName, level, validDate, analDate, lons, lats):
+        self.shortName = shortName
+        self.level = level
+        self.validDate = validDate
+        self.analDate = analDate
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.decodes = 0
+
+    def latlons(self):
+        (lons, lats) = np.meshgrid(self.lons, self.lats)
+        return lats, lons
+
+    @property
+    def values(self):
+        self.decodes += 1
+        (lats, lons) = self.latlons()
+        z = 44330.8 * (1 - (self.level / 1013.25) ** 0.190263)  # Standard atmosphere
+        return {
+            'z': np.full(lats.shape, z * G),
+            't': np.full(lats.shape, 288.15 - 0.0065 * z),
+            'u': 5 + np.sin(np.radians(lats)),
+            'v': np.cos(np.radians(lons)),
+            'r': np.full(lats.shape, 50.),
+        }[self.shortName]
+
+
+def messages(lons, lats, valid_dates, analysis_date, levels=LEVELS, names="tuvzr"):
+    """
+    :param lons: longitudes of the grid, within 0...360
+    :param lats: latitudes of the grid, decreasing as in ARPEGE files
+    :return: list of `FakeMessage`s, for every valid date, level and variable
+    """
+    return [FakeMessage(name, level, valid_date, analysis_date, lons, lats)
+            for valid_date in valid_dates for level in levels for name in names]
@@ -0,0 +1,102 @@
+import io
+import threading
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from unittest import mock
+
+from tests import GRIB_PATH  # noqa: F401 Configures a temporary GRIB_PATH
+from forecast import models
+from forecast.models import FileRef, grib_models
+
+CONTENT = bytes(range(256)) * 64
+
+
+class GribHandler(BaseHTTPRequestHandler):
+    """Serve `CONTENT`, honoring range requests if the server's `accept_ranges`, or fail with its `error`."""
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+        if server.error:
+            self.send_error(server.error)
+            return
+        start = 0
+        if self.headers.get('Range') and server.accept_ranges:
+            start = int(self.headers['Range'][len("bytes="):-len("-")])
+            if start >= len(CONTENT):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.end_headers()
+        self.wfile.write(CONTENT[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), GribHandler)
+        self.server.ranges = []
+        self.server.accept_ranges = True
+        self.server.error = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.model = grib_models['ARPEGE_0.5']
+        self.fileref = FileRef(self.model, datetime(2020, 1, 1), [timedelta(hours=0)])
+        self.result = Path(self.fileref.__fspath__())
+        self.part = Path(str(self.result) + ".part")
+        self.result.parent.mkdir(parents=True, exist_ok=True)
+        url = f"http://127.0.0.1:{self.server.server_port}/{self.fileref.file_name}"
+        patches = [mock.patch.object(self.model, 'file_url', lambda fileref: url),
+                   mock.patch.object(models, 'DOWNLOAD_BACKOFF', 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for path in (self.result, self.part):
+            path.unlink(missing_ok=True)
+
+    def download(self):
+        with redirect_stdout(io.StringIO()):
+            return self.model.download_file(self.fileref)
+
+    def test_download(self):
+        self.assertEqual(self.download(), self.result)
+        self.assertEqual(self.result.read_bytes(), CONTENT)
+        self.assertFalse(self.part.exists())
+        self.assertEqual(self.server.ranges, [None])
+
+    def test_resume_partial_file(self):
+        self.part.write_bytes(CONTENT[:1000])
+        self.assertEqual(self.download(), self.result)
+        self.assertEqual(self.result.read_bytes(), CONTENT)
+        self.assertEqual(self.server.ranges, ["bytes=1000-"])
+
+    def test_range_ignored(self):
+        self.server.accept_ranges = False
+        self.part.write_bytes(b"\0" * 1000)
+        self.assertEqual(self.download(), self.result)
+        self.assertEqual(self.result.read_bytes(), CONTENT)
+
+    def test_range_not_satisfiable(self):
+        self.part.write_bytes(b"\0" * (len(CONTENT) + 10))
+        self.assertEqual(self.download(), self.result)
+        self.assertEqual(self.result.read_bytes(), CONTENT)
+        self.assertEqual(self.server.ranges, [f"bytes={len(CONTENT) + 10}-", None])
+
+    def test_not_found(self):
+        self.server.error = 404
+        self.assertIsNone(self.download())
+        self.assertFalse(self.result.exists())
+        self.assertEqual(self.server.ranges, [None])
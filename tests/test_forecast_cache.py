@@ -0,0 +1,73 @@
+import io
+import os
+import shutil
+import threading
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+from tests import GRIB_PATH
+from tests import fixtures
+from forecast.cache import ForecastCache
+from forecast.preprocess import preprocess_messages
+
+ANALYSIS_DATE = datetime(2020, 1, 1)
+VALID_DATE = ANALYSIS_DATE + timedelta(hours=6)
+MODEL = SimpleNamespace(name="CACHE_TEST", grid_pitch=0.5)
+BASENAME = VALID_DATE.strftime("%Y%m%d%H%M")
+
+
+def preprocess(output_path, analysis_date, derived):
+    output_path.mkdir(exist_ok=True)
+    msgs = fixtures.messages(np.arange(0., 10., 0.5), np.arange(52., 42., -0.5), [VALID_DATE], analysis_date)
+    with redirect_stdout(io.StringIO()):
+        preprocess_messages(msgs, output_path, lat1=45, lat2=50, lon1=2, lon2=6, derived=derived)
+
+
+class ForecastCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_path = GRIB_PATH / f"{MODEL.name}_{MODEL.grid_pitch}"
+        self.staging_path = GRIB_PATH / "cache_test_staging"
+        preprocess(self.output_path, ANALYSIS_DATE, derived=False)
+        preprocess(self.staging_path, ANALYSIS_DATE + timedelta(hours=6), derived=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+        shutil.rmtree(self.staging_path)
+
+    def replace(self, extension):
+        """Replace a file of the output directory the way `forecast_preprocess` does."""
+        tmp_path = self.output_path / f"{BASENAME}{extension}.tmp"
+        shutil.copyfile(self.staging_path / (BASENAME + extension), tmp_path)
+        os.replace(tmp_path, self.output_path / (BASENAME + extension))
+
+    def test_array_replaced_before_shape(self):
+        # The writer has replaced the array, and is about to replace the shape file
+        shape_file_path = self.output_path / (BASENAME + ".json")
+        old_mtime_ns = os.stat(shape_file_path).st_mtime_ns
+        self.replace(".np")
+        os.utime(self.output_path / (BASENAME + ".np"), ns=(old_mtime_ns + 10**9, old_mtime_ns + 10**9))
+        writer = threading.Timer(0.02, self.replace, (".json",))
+        writer.start()
+        try:
+            forecast = ForecastCache(max_bytes=10**9).get(MODEL, VALID_DATE)
+        finally:
+            writer.join()
+        self.assertEqual(forecast.analysis_date, ANALYSIS_DATE + timedelta(hours=6))
+        self.assertEqual(forecast.array.shape[0], len(forecast.variables))
+
+    def test_array_newer_than_stable_shape(self):
+        # Files copied out of order aren't waited for forever
+        np_file_path = self.output_path / (BASENAME + ".np")
+        mtime_ns = os.stat(np_file_path).st_mtime_ns + 10**9
+        os.utime(np_file_path, ns=(mtime_ns, mtime_ns))
+        forecast = ForecastCache(max_bytes=10**9).get(MODEL, VALID_DATE)
+        self.assertEqual(forecast.analysis_date, ANALYSIS_DATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from tests import GRIB_PATH
+from forecast.manifest import MANIFEST_NAME, PreprocessManifest
+
+BOX = dict(lat1=40., lat2=50., lon1=-5., lon2=10.)
+
+
+class PreprocessManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grib_file_path = GRIB_PATH / "manifest_test.grib2"
+        self.grib_file_path.write_bytes(b"GRIB")
+        self.manifest = PreprocessManifest(GRIB_PATH / MANIFEST_NAME)
+
+    def tearDown(self):
+        self.grib_file_path.unlink()
+
+    def record(self, **options):
+        self.manifest.record(self.grib_file_path, options, {'analysis_date': None, 'dates': {}})
+
+    def test_derived_variables_kept_when_not_requested(self):
+        self.record(derived=True, **BOX)
+        self.assertEqual(self.manifest.status(self.grib_file_path, dict(BOX, derived=False)), "unchanged")
+        self.assertEqual(self.manifest.status(self.grib_file_path, dict(BOX, derived=True)), "unchanged")
+
+    def test_missing_derived_variables(self):
+        self.record(derived=False, **BOX)
+        self.assertEqual(self.manifest.status(self.grib_file_path, dict(BOX, derived=True)), "changed")
+
+    def test_other_box(self):
+        self.record(derived=True, **BOX)
+        self.assertEqual(self.manifest.status(self.grib_file_path, dict(BOX, lat2=55., derived=False)), "changed")
+
+
+if __name__ == '__main__':
+    unittest.main()
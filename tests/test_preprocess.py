@@ -0,0 +1,66 @@
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from tests import GRIB_PATH
+from tests import fixtures
+from forecast.preprocess import preprocess_messages, SHORT_NAMES
+from forecast.storage import unpack
+
+ANALYSIS_DATE = datetime(2020, 1, 1)
+VALID_DATES = [ANALYSIS_DATE + timedelta(hours=3 * i) for i in range(2)]
+
+
+def messages(lons, lats):
+    return fixtures.messages(lons, lats, VALID_DATES, ANALYSIS_DATE)
+
+
+class PreprocessMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_path = GRIB_PATH / self._testMethodName
+        self.output_path.mkdir()
+
+    def preprocess(self, msgs, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return preprocess_messages(msgs, self.output_path, **kwargs)
+
+    def shape(self, valid_date):
+        with (self.output_path / valid_date.strftime("%Y%m%d%H%M.json")).open() as f:
+            return json.load(f)
+
+    def test_each_message_decoded_once(self):
+        msgs = messages(np.arange(0., 10., 0.5), np.arange(52., 42., -0.5))
+        report = self.preprocess(msgs, lat1=45, lat2=50, lon1=2, lon2=6)
+        self.assertEqual(report['decodes'], len(msgs))
+        self.assertEqual([m.decodes for m in msgs], [1] * len(msgs))
+        self.assertEqual(set(report['dates'].values()), {"created"})
+        shape = self.shape(VALID_DATES[0])
+        self.assertEqual(shape['lons'], list(np.arange(2., 6.5, 0.5)))
+        self.assertEqual(shape['lats'], list(np.arange(50., 44.5, -0.5)))
+        array = np.load(self.output_path / VALID_DATES[0].strftime("%Y%m%d%H%M.np"))
+        self.assertEqual(array.shape, (len(SHORT_NAMES), 9, 11, len(fixtures.LEVELS)))
+        # Levels are sorted by increasing pressure, values quantized by 0.01°K steps
+        t_1000 = next(m for m in msgs if m.shortName == 't' and m.level == 1000).values[0, 0]
+        np.testing.assert_allclose(unpack('t', array[SHORT_NAMES.index('t'), :, :, -1]), t_1000, atol=0.01)
+
+    def test_box_across_meridian(self):
+        msgs = messages(np.arange(0., 360., 0.5), np.arange(52., 42., -0.5))
+        report = self.preprocess(msgs, lat1=45, lat2=50, lon1=358, lon2=2)
+        self.assertEqual(report['decodes'], len(msgs))
+        self.assertEqual([m.decodes for m in msgs], [1] * len(msgs))
+        # Eastern part of the grid first, so that longitudes are contiguous
+        self.assertEqual(self.shape(VALID_DATES[0])['lons'], [358., 358.5, 359., 359.5, 0., 0.5, 1., 1.5, 2.])
+
+    def test_more_recent_dates_not_decoded(self):
+        msgs = messages(np.arange(0., 10., 0.5), np.arange(52., 42., -0.5))
+        self.preprocess(msgs, lat1=45, lat2=50, lon1=2, lon2=6)
+        report = self.preprocess(msgs, lat1=45, lat2=50, lon1=2, lon2=6)
+        self.assertEqual(report['decodes'], 0)
+        self.assertEqual(set(report['dates'].values()), {"skipped"})
+        report = self.preprocess(msgs, lat1=45, lat2=50, lon1=2, lon2=6, force=True)
+        self.assertEqual(report['decodes'], len(msgs))
@@ -0,0 +1,16 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+from tests import GRIB_PATH  # noqa: F401 Configures a temporary GRIB_PATH
+from core.trajectory import make_trajectory_point
+
+
+class TrajectoryPointTest(unittest.TestCase):
+
+    def test_temperature_in_celsius(self):
+        column = SimpleNamespace(position=(2.5, 48.5), valid_date=datetime(2020, 1, 1))
+        cell = SimpleNamespace(u_ms=5., v_ms=-2., t_K=223.15, z_m=10000., z0_m=9900., height_m=200.,
+                               p_hPa=265., rho_kg_m3=0.414)
+        (point, _, _) = make_trajectory_point(column, cell, (2.5, 48.5), datetime(2020, 1, 1), 5.)
+        self.assertEqual(point['temp'], -50)